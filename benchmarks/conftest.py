@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+#
+# Data shared by the benchmarks
+#
+
+import json
+
+import numpy as np
+import pytest
+import requests
+
+from wapi.util import TS
+
+START = 1262300400000  # 2010-01-01T00:00:00+01:00
+STEP = 15 * 60 * 1000
+
+SIZES = [1000, 100000, 1000000]
+
+
+def make_ts(size, tag=None, seed=1):
+    """A MIN15 series with size points, and some missing values"""
+    values = np.random.RandomState(seed).random_sample(size)
+    values[::1000] = np.nan
+    timestamps = START + np.arange(size, dtype=np.int64) * STEP
+    return TS(id=seed, name='pro de spv ec00 mwh/h cet min15 f', frequency='MIN15', time_zone='CET', tag=tag,
+              points=(timestamps, values))
+
+
+def make_metadata(count):
+    """A search result with count curves, as returned by the API"""
+    curve_types = ['TIME_SERIES', 'TAGGED', 'INSTANCES', 'TAGGED_INSTANCES']
+    return [{'id': n, 'name': 'tt de con ec{:05d} °c cet min15 f'.format(n), 'frequency': 'MIN15',
+             'time_zone': 'CET', 'curve_type': curve_types[n % 4], 'categories': ['TT', 'CON'],
+             'area': 'DE', 'commodity': 'POW', 'unit': '°c', 'created': '2017-05-12T10:00:00Z',
+             'modified': '2020-01-01T00:00:00Z',
+             'accessRange': {'begin': '2010-01-01T00:00:00+01:00', 'end': None}} for n in range(count)]
+
+
+def make_response(result, status_code=200):
+    """A requests.Response with result as its JSON body"""
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = json.dumps(result).encode()
+    return response
+
+
+@pytest.fixture(scope='module', params=SIZES, ids=lambda size: '{}pts'.format(size))
+def ts(request):
+    return make_ts(request.param)
@@ -0,0 +1,20 @@
+#
+# Benchmark of the time to import wapi
+#
+
+import subprocess
+import sys
+
+import pytest
+
+
+def _import(module):
+    subprocess.check_call([sys.executable, '-c', 'import {}'.format(module)])
+
+
+@pytest.mark.benchmark(group='import')
+@pytest.mark.parametrize('module', ['wapi', 'pandas'])
+def test_import(benchmark, module):
+    # Each round starts a new interpreter, so includes its startup time;
+    # pandas is there for comparison
+    benchmark.pedantic(_import, args=(module,), rounds=10, warmup_rounds=1)
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+#
+# Benchmarks of the decoding of JSON responses, with the JSON codecs and
+# the streaming decoder
+#
+
+import json
+
+import pytest
+
+from wapi import codec, stream
+
+from conftest import make_metadata, make_ts
+
+
+def _series_response(size, tag=None, seed=1):
+    ts = make_ts(size, tag=tag, seed=seed)
+    res = {'id': ts.id, 'name': ts.name, 'frequency': ts.frequency, 'time_zone': 'CET', 'points': ts.points}
+    if tag is not None:
+        res['tag'] = tag
+    return res
+
+
+@pytest.fixture(scope='module', params=['series', 'tagged', 'search'],
+                ids=['series 250k points', 'tagged 51x5k points', 'search 1000 curves'])
+def body(request):
+    if request.param == 'series':
+        response = _series_response(250000)
+    elif request.param == 'tagged':
+        response = [_series_response(5000, tag='{:02d}'.format(n), seed=n) for n in range(51)]
+    else:
+        response = make_metadata(1000)
+    return json.dumps(response).encode()
+
+
+def _stream_decode(body):
+    return stream.decode(body[n:n + stream.CHUNK_SIZE] for n in range(0, len(body), stream.CHUNK_SIZE))
+
+
+@pytest.mark.benchmark(group='json')
+@pytest.mark.parametrize('decoder', ['json', 'orjson', 'stream'])
+def test_decode(benchmark, body, decoder):
+    if decoder == 'stream':
+        decode = _stream_decode
+    else:
+        if decoder == 'orjson':
+            pytest.importorskip('orjson')
+        decode = codec.get_codec(decoder).loads
+    benchmark.extra_info['MB'] = len(body) / 1e6
+    res = benchmark(decode, body)
+    assert res is not None
@@ -0,0 +1,59 @@
+#
+# Benchmarks of the handling of API responses and events
+#
+
+import json
+import tracemalloc
+import types
+
+import pytest
+
+import wapi
+from wapi.events import CurveEvent
+
+from conftest import make_metadata, make_response
+
+
+@pytest.fixture(scope='module')
+def session():
+    return wapi.Session()
+
+
+@pytest.mark.benchmark(group='search')
+@pytest.mark.parametrize('count', [100, 10000])
+def test_handle_multi_curve_response(benchmark, session, count):
+    response = make_response(make_metadata(count))
+    curves = benchmark(session.handle_multi_curve_response, response)
+    assert len(curves) == count
+
+
+@pytest.mark.benchmark(group='search')
+def test_build_curves(benchmark, session):
+    metadata = make_metadata(10000)
+    # Memory held by the curve objects, on top of the metadata dicts
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    curves = [session._build_curve(m) for m in metadata]
+    benchmark.extra_info['bytes_per_curve'] = (tracemalloc.get_traced_memory()[0] - start) / len(curves)
+    tracemalloc.stop()
+    curves = benchmark(lambda: [session._build_curve(m) for m in metadata])
+    assert len(curves) == 10000
+
+
+def _sse_events(count):
+    events = []
+    for n in range(count):
+        data = {'id': n, 'created': '2020-01-01T12:00:00.123+01:00', 'operation': 'modify',
+                'range': {'begin': '2020-01-02T00:00:00+01:00', 'end': '2020-01-03T00:00:00+01:00'}}
+        if n % 2:
+            data['tag'] = 'a'
+            data['issue_date'] = '2020-01-01T00:00:00+01:00'
+        events.append(types.SimpleNamespace(event='curve_event', data=json.dumps(data)))
+    return events
+
+
+@pytest.mark.benchmark(group='events')
+def test_curve_events(benchmark):
+    events = _sse_events(1000)
+    res = benchmark(lambda: [CurveEvent(e) for e in events])
+    assert len(res) == 1000 and res[-1].issue_date is not None
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+#
+# Benchmarks of the conversions and helpers in wapi.util
+#
+
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from wapi import util
+from wapi.util import TS
+
+from conftest import make_ts
+
+
+@pytest.mark.benchmark(group='to_pandas')
+def test_to_pandas(benchmark, ts):
+    series = benchmark(ts.to_pandas)
+    assert len(series) == len(ts.timestamps)
+
+
+def _to_pandas_loop(ts, points):
+    # The conversion before it was vectorized, with a timezone aware
+    # datetime for each point
+    index = []
+    values = []
+    for row in points:
+        index.append(datetime.datetime.fromtimestamp(row[0] / 1000.0, ts.tz))
+        values.append(row[1])
+    res = pd.Series(name=ts.fullname, index=index, data=values)
+    return res.asfreq(ts._map_freq(ts.frequency))
+
+
+@pytest.mark.benchmark(group='to_pandas')
+def test_to_pandas_loop(benchmark, ts):
+    series = benchmark.pedantic(_to_pandas_loop, args=(ts, ts.points), rounds=3)
+    expected = ts.to_pandas()
+    assert series.index.equals(expected.index)
+    assert np.allclose(series.values.astype(float), expected.values.astype(float), equal_nan=True)
+
+
+@pytest.mark.benchmark(group='from_pandas')
+def test_from_pandas(benchmark, ts):
+    series = ts.to_pandas()
+    res = benchmark(TS.from_pandas, series)
+    assert len(res.values) == len(series)
+
+
+@pytest.fixture(scope='module')
+def ts_list():
+    return [make_ts(100000, seed=n) for n in range(10)]
+
+
+@pytest.mark.benchmark(group='aggregate')
+@pytest.mark.parametrize('func', [TS.sum, TS.mean, TS.median], ids=['sum', 'mean', 'median'])
+def test_aggregate(benchmark, ts_list, func):
+    res = benchmark(func, ts_list, 'aggregate')
+    assert len(res.values) == 100000
+
+
+@pytest.mark.benchmark(group='tags_to_DF')
+def test_tags_to_DF(benchmark):
+    tagged = [make_ts(10000, tag='{:02d}'.format(n), seed=n) for n in range(51)]
+    df = benchmark(util.tags_to_DF, tagged)
+    assert df.shape == (10000, 51)
+
+
+@pytest.mark.benchmark(group='parsetime')
+@pytest.mark.parametrize('value', ['2018-01-01', '2018-01-01T00:00:00+01:00', '2018-01-01T00:00:00.000Z',
+                                   '2018-01-01 12:30'])
+def test_parsetime(benchmark, value):
+    res = benchmark(util.parsetime, value)
+    assert res.year == 2018
+
+
+@pytest.mark.benchmark(group='parsetime')
+def test_parsetime_tz(benchmark):
+    res = benchmark(util.parsetime, '2018-01-01T00:00:00+01:00', 'Europe/Oslo')
+    assert res.tzinfo is not None
+
+
+@pytest.mark.benchmark(group='parsetime')
+def test_parserange(benchmark):
+    res = benchmark(util.parserange, {'begin': '2020-01-02T00:00:00+01:00', 'end': '2020-01-03T00:00:00+01:00'},
+                    'CET')
+    assert res[0] < res[1]
+
+
+@pytest.mark.benchmark(group='parse_tz')
+@pytest.mark.parametrize('time_zone', ['CET', 'Europe/Oslo', 'PST', 'unknown'])
+def test_parse_tz(benchmark, time_zone):
+    assert benchmark(util.parse_tz, time_zone) is not None
+
+
+@pytest.mark.benchmark(group='frequency')
+def test_map_freq(benchmark):
+    frequencies = list(util._TS_FREQ_TABLE) + ['D', 'min15', 'h']
+    res = benchmark(lambda: [TS._rev_map_freq(TS._map_freq(f)) for f in frequencies])
+    assert res[:len(util._TS_FREQ_TABLE)] == list(util._TS_FREQ_TABLE)
+
+
+@pytest.mark.benchmark(group='make_arg')
+@pytest.mark.parametrize('value', ['tt de con ec00 °c cet min15 f', datetime.date(2018, 1, 1),
+                                   ['tt de con ec{:02d} °c cet min15 f'.format(n) for n in range(100)]],
+                         ids=['name', 'date', '100 names'])
+def test_make_arg(benchmark, value):
+    res = benchmark(util.make_arg, 'name', value)
+    assert res.startswith('name=')
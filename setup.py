@@ -1,6 +1,6 @@
 # encoding: utf-8
 #
-import os, sys
+import os
 from setuptools import setup
 
 here = os.path.abspath(os.path.dirname(__file__))
@@ -15,17 +15,20 @@ install_requires = [
     'pandas >= 0.21',
     'future >= 0.16',
 ]
-if sys.version_info < (3,):
-    install_requires.append('configparser >= 3.5')
 
 setup(
     name='wapi-python',
     packages=['wapi'],
     install_requires=install_requires,
+    python_requires='>=3.7',
+    extras_require={
+        'async': ['aiohttp >= 3.6'],
+    },
     tests_require=[
         'pytest',
         'pytest-cov >= 2.5',
         'requests-mock >= 1.3',
+        'aiohttp >= 3.6',
     ],
     version=version,
     description='Volue Insight API python library',
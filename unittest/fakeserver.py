@@ -0,0 +1,307 @@
+#
+# A local stand-in for the Volue Insight API, for benchmarks and load tests
+#
+# Run it on its own with
+#
+#     PYTHONPATH=. python unittest/fakeserver.py [port]
+#
+# or start it from a test or benchmark:
+#
+#     with FakeServer(curves=make_curves(100, size=8760), latency=0.01) as server:
+#         session = server.session()
+#         data = session.get_curve(name='fake_curve_0').get_data()
+#
+
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+import wapi
+from wapi import util
+
+
+START = 1577833200000  # 2020-01-01T00:00:00+01:00, default start of the series
+MAX_POINTS = 10 ** 7   # Most points returned in one response
+
+# Shortest length of each step, in milliseconds, to estimate the number of points in a range
+_MIN_STEP = {'seconds': 1000, 'days': 23 * 3600 * 1000, 'months': 28 * 24 * 3600 * 1000}
+
+
+class FakeCurve(object):
+    """
+    A synthetic curve.  A data request without a range gets ``size`` points
+    from START, and one with a range gets the points of the frequency in
+    that range.  Tagged curves have the given tags, and instance curves
+    ``instances`` issue dates, one day apart, ending at START.
+    """
+
+    def __init__(self, id, name, curve_type=util.TIME_SERIES, frequency='H', time_zone='CET', size=24,
+                 tags=('a', 'b'), instances=5):
+        self.id = id
+        self.name = name
+        self.curve_type = curve_type
+        self.frequency = frequency
+        self.time_zone = time_zone
+        self.size = size
+        self.tags = list(tags) if curve_type in (util.TAGGED, util.TAGGED_INSTANCES) else []
+        self.tz = util.parse_tz(time_zone)
+        if curve_type in (util.INSTANCES, util.TAGGED_INSTANCES):
+            self.issue_dates = [START - n * 86400000 for n in reversed(range(instances))]
+        else:
+            self.issue_dates = []
+
+    def metadata(self):
+        return {'id': self.id, 'name': self.name, 'curve_type': self.curve_type,
+                'frequency': self.frequency, 'time_zone': self.time_zone,
+                'accessRange': {'begin': self._isoformat(START), 'end': self._isoformat(self._end())}}
+
+    def timestamps(self, data_from=None, data_to=None):
+        first = START if data_from is None else self._millis(data_from)
+        if data_to is None:
+            timestamps = util.regular_timestamps(first, self.size, self.frequency, self.tz)
+        else:
+            last = self._millis(data_to)
+            unit, step = util._FREQ_STEP[self.frequency.upper()]
+            size = min(MAX_POINTS, max(0, (last - first) // (_MIN_STEP[unit] * step) + 1))
+            timestamps = util.regular_timestamps(first, size, self.frequency, self.tz)
+            timestamps = timestamps[timestamps < last]
+        return timestamps[:MAX_POINTS]
+
+    def series(self, data_from=None, data_to=None, tag=None, issue_date=None, with_data=True):
+        result = {'id': self.id, 'name': self.name, 'frequency': self.frequency,
+                  'time_zone': self.time_zone}
+        if tag is not None:
+            result['tag'] = tag
+        if issue_date is not None:
+            result['issue_date'] = self._isoformat(issue_date)
+        if with_data:
+            timestamps = self.timestamps(data_from, data_to)
+            values = np.round(np.sin(timestamps / 3.6e6) * 100 + self.id, 3)
+            result['points'] = [[t, v] for t, v in zip(timestamps.tolist(), values.tolist())]
+        return result
+
+    def _end(self):
+        return int(util.regular_timestamps(START, self.size + 1, self.frequency, self.tz)[-1])
+
+    def _millis(self, value):
+        return util.to_millis(util.parsetime(value, tz=self.tz))
+
+    def _isoformat(self, millis):
+        return util.from_millis(millis, self.tz).isoformat()
+
+
+def make_curves(count, size=24, frequency='H', curve_types=(util.TIME_SERIES,), **kwargs):
+    """Make count curves named fake_curve_<n>, cycling through the curve types"""
+    return [FakeCurve(n + 1, 'fake_curve_{}'.format(n), curve_types[n % len(curve_types)], frequency,
+                      size=size, **kwargs) for n in range(count)]
+
+
+class FakeServer(object):
+    """
+    A local HTTP server answering like the Volue Insight API, for the
+    curves given.
+
+    Parameters
+    ----------
+
+    curves: list, optional
+        The :class:`FakeCurve` objects served, by default one curve of
+        each type.
+    latency: float, optional
+        Seconds to wait before answering each request.
+    error_rate: float, optional
+        Fraction of the API requests answered with 503.
+    events: int, optional
+        Number of curve events sent on an event stream before it closes.
+    event_interval: float, optional
+        Seconds between the events.
+    port: int, optional
+        Port to listen on, by default a free one.
+    seed: int, optional
+        Seed for the errors, so runs can be repeated.
+    """
+
+    def __init__(self, curves=None, latency=0.0, error_rate=0.0, events=10, event_interval=0.01, port=0,
+                 seed=0):
+        if curves is None:
+            curves = make_curves(4, curve_types=(util.TIME_SERIES, util.TAGGED, util.INSTANCES,
+                                                 util.TAGGED_INSTANCES))
+        self.curves = {c.id: c for c in curves}
+        self.by_name = {c.name.lower(): c for c in curves}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.events = events
+        self.event_interval = event_interval
+        self.requests = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', port), _make_handler(self))
+        self._httpd.daemon_threads = True
+        self._worker = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self._httpd.server_port)
+
+    def start(self):
+        self._worker = threading.Thread(target=self._httpd.serve_forever)
+        self._worker.daemon = True
+        self._worker.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def session(self, **kwargs):
+        """A :class:`wapi.Session` logged in to this server"""
+        return wapi.Session(urlbase=self.url, auth_urlbase=self.url, client_id='client', client_secret='secret',
+                            **kwargs)
+
+    def _fail(self):
+        # Whether to fail a request, counting it
+        with self._lock:
+            self.requests += 1
+            failed = self.error_rate > 0 and self._random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+            return failed
+
+    def get(self, path, query):
+        """Answer an API request, returning (status, JSON result)"""
+        parts = path.strip('/').split('/')[1:]
+        if parts == ['curves']:
+            names = [n.lower() for n in query.get('name', [])]
+            found = [c for c in self.curves.values() if not names or c.name.lower() in names]
+            return 200, [c.metadata() for c in found]
+        if parts == ['curves', 'get']:
+            curve = self._find(query)
+            return (200, curve.metadata()) if curve else (404, 'Curve not found')
+        kind = parts[0] if parts else None
+        tagged = len(parts) > 1 and parts[1] == 'tagged'
+        rest = parts[2:] if tagged else parts[1:]
+        if kind not in ('series', 'instances') or not rest or not rest[0].isdigit():
+            return 404, 'Not found'
+        curve = self.curves.get(int(rest[0]))
+        if curve is None:
+            return 404, 'Curve not found'
+        action = rest[1] if len(rest) > 1 else None
+        if action == 'tags':
+            return 200, curve.tags
+        data_from = _arg(query, 'from')
+        data_to = _arg(query, 'to')
+        tags = query.get('tag') or (curve.tags[:1] if tagged else [None])
+        if kind == 'series':
+            result = [curve.series(data_from, data_to, tag=t) for t in tags]
+            return 200, result if tagged else result[0]
+        with_data = _arg(query, 'with_data', 'false' if action is None else 'true') == 'true'
+        if action == 'get':
+            issue_date = curve._millis(_arg(query, 'issue_date'))
+            result = [curve.series(data_from, data_to, t, issue_date, with_data) for t in tags]
+        elif action in ('latest', 'relative', 'absolute'):
+            # Always the latest instance, for the first tag
+            issue_date = curve.issue_dates[-1] if curve.issue_dates else None
+            return 200, curve.series(data_from, data_to, tags[0], issue_date, with_data)
+        else:
+            result = [curve.series(data_from, data_to, t, d, with_data)
+                      for d in reversed(curve.issue_dates) for t in tags]
+            return 200, result
+        return 200, result if tagged else result[0]
+
+    def _find(self, query):
+        if 'id' in query:
+            return self.curves.get(int(query['id'][0]))
+        return self.by_name.get(_arg(query, 'name', '').lower())
+
+
+def _arg(query, key, default=None):
+    values = query.get(key)
+    return values[0] if values else default
+
+
+def _make_handler(server):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            if urlparse(self.path).path != '/oauth2/token':
+                return self._send(404, 'Not found')
+            self._send(200, {'token_type': 'Bearer', 'access_token': 'faketoken', 'expires_in': 3600})
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            if server.latency:
+                time.sleep(server.latency)
+            if self.headers.get('Authorization') != 'Bearer faketoken':
+                return self._send(401, 'Not authorized')
+            if url.path == '/api/events':
+                return self._send_events(query)
+            if server._fail():
+                return self._send(503, 'Service unavailable')
+            status, result = server.get(url.path, query)
+            self._send(status, result)
+
+        def _send(self, status, result):
+            body = json.dumps(result).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_events(self, query):
+            ids = [int(i) for i in query.get('id', [])] or list(server.curves)
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            for n in range(server.events):
+                curve = server.curves.get(ids[n % len(ids)])
+                begin = START + n * 3600000
+                data = {'id': ids[n % len(ids)], 'created': util.from_millis(int(time.time() * 1000),
+                                                                             curve.tz).isoformat(),
+                        'operation': 'modify',
+                        'range': {'begin': curve._isoformat(begin), 'end': curve._isoformat(begin + 3600000)}}
+                message = 'id: {}\nevent: curve_event\ndata: {}\n\n'.format(n, json.dumps(data))
+                try:
+                    self.wfile.write(message.encode())
+                    self.wfile.flush()
+                except (IOError, OSError):
+                    return
+                time.sleep(server.event_interval)
+            # Ask the client to wait before reconnecting
+            self.wfile.write(b'retry: 60000\n\n')
+            self.close_connection = True
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    with FakeServer(curves=make_curves(100, size=8760, curve_types=(util.TIME_SERIES, util.TAGGED,
+                                                                    util.INSTANCES, util.TAGGED_INSTANCES)),
+                    port=port) as fake:
+        print('Serving the fake API on {}'.format(fake.url))
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,230 @@
+import asyncio
+import json
+import threading
+
+import pytest
+
+import wapi
+
+aiohttp = pytest.importorskip('aiohttp')
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from wapi import aio
+
+
+def make_app(calls):
+    async def token(request):
+        calls.append('token')
+        return web.json_response({'token_type': 'Bearer', 'access_token': 'secrettoken',
+                                  'expires_in': 1000})
+
+    async def get_curve(request):
+        calls.append('curve')
+        if request.headers.get('Authorization') != 'Bearer secrettoken':
+            return web.Response(status=403)
+        return web.json_response({'id': 5, 'name': request.query['name'], 'frequency': 'H',
+                                  'time_zone': 'CET', 'curve_type': 'TIME_SERIES'})
+
+    async def search(request):
+        metadata = [{'id': 5, 'name': 'testcurve5', 'frequency': 'H', 'time_zone': 'CET',
+                     'curve_type': 'TIME_SERIES'},
+                    {'id': 7, 'name': 'testcurve7', 'frequency': 'D', 'time_zone': 'CET',
+                     'curve_type': 'INSTANCES'}]
+        return web.json_response(metadata)
+
+    async def series(request):
+        calls.append('series')
+        return web.json_response({'id': 5, 'frequency': 'H', 'points': [[140000000000, 10.0]],
+                                  'query': dict(request.query)})
+
+    async def latest(request):
+        return web.json_response({'id': 7, 'frequency': 'H', 'issue_date': '2016-01-01T00:00Z',
+                                  'points': [[140000000000, 10.0]]})
+
+    async def flaky(request):
+        calls.append('flaky')
+        if calls.count('flaky') < 3:
+            return web.Response(status=503)
+        return web.json_response(['ok'])
+
+    issue_dates = ['2016-01-0{}'.format(n) for n in range(1, 6)]
+
+    async def tagged_tags(request):
+        return web.json_response(['a', 'b'])
+
+    async def tagged_latest(request):
+        return web.json_response({'id': 10, 'frequency': 'H', 'tag': 'a', 'issue_date': issue_dates[-1],
+                                  'points': [[140000000000, 10.0]] * 5})
+
+    async def tagged_instances(request):
+        calls.append('instances')
+        first = request.query.get('issue_date_from', issue_dates[0])
+        last = request.query.get('issue_date_to', '9999')
+        tags = request.query.getall('tag')
+        return web.json_response([{'id': 10, 'frequency': 'H', 'tag': t, 'issue_date': d}
+                                  for d in reversed(issue_dates) if first <= d < last for t in tags])
+
+    app = web.Application()
+    app.router.add_post('/oauth2/token', token)
+    app.router.add_get('/api/curves/get', get_curve)
+    app.router.add_get('/api/curves', search)
+    app.router.add_get('/api/series/5', series)
+    app.router.add_get('/api/instances/7/latest', latest)
+    app.router.add_get('/api/series/tagged/9/tags', flaky)
+    app.router.add_get('/api/instances/tagged/10/tags', tagged_tags)
+    app.router.add_get('/api/instances/tagged/10/latest', tagged_latest)
+    app.router.add_get('/api/instances/tagged/10', tagged_instances)
+    return app
+
+
+def run_with_session(test, calls):
+    async def runner():
+        server = TestServer(make_app(calls))
+        await server.start_server()
+        urlbase = str(server.make_url('/'))
+        try:
+            async with aio.AsyncSession(urlbase=urlbase, auth_urlbase=urlbase,
+                                        client_id='clientid', client_secret='verysecret') as s:
+                return await test(s)
+        finally:
+            await server.close()
+    return asyncio.run(runner())
+
+
+def test_async_get_data():
+    calls = []
+
+    async def test(s):
+        c = await s.get_curve(name='testcurve5')
+        assert isinstance(c, aio.TimeSeriesCurve)
+        assert isinstance(c, wapi.curves.TimeSeriesCurve)
+        assert c.name == 'testcurve5'
+        d = await c.get_data(data_from='2018-01-01', data_to='2018-01-02', function='AVERAGE')
+        assert isinstance(d, wapi.util.TS)
+        assert d.frequency == 'H'
+        assert d.query == {'from': '2018-01-01', 'to': '2018-01-02', 'function': 'AVERAGE'}
+
+    run_with_session(test, calls)
+    # Login is done once, when the first request is made
+    assert calls == ['token', 'curve', 'series']
+
+
+def test_async_unsupported():
+    with pytest.raises(wapi.session.ConfigException):
+        aio.AsyncSession(stream_data=True)
+    with pytest.raises(wapi.session.SessionException):
+        aio.AsyncSession().events([])
+
+
+def test_async_data_cache(tmp_path):
+    calls = []
+    threads = []
+
+    class DiskCache(wapi.cache.DiskCache):
+        def _load(self, key):
+            threads.append(threading.get_ident())
+            return super(DiskCache, self)._load(key)
+
+        def _save(self, key, entry):
+            threads.append(threading.get_ident())
+            return super(DiskCache, self)._save(key, entry)
+
+    async def test(s):
+        s.data_cache = DiskCache(str(tmp_path))
+        c = await s.get_curve(name='testcurve5')
+        for _ in range(2):
+            d = await c.get_data(data_from='1974-01-01', data_to='1975-01-01')
+            assert d.points == [[140000000000, 10.0]]
+        # The files are read and written off the event loop
+        assert threads and threading.get_ident() not in threads
+
+    run_with_session(test, calls)
+    assert calls.count('series') == 1
+
+
+def test_async_refresh_ahead():
+    calls = []
+
+    async def test(s):
+        c = await s.get_curve(name='testcurve5')
+        s.auth.refresh_at = 0  # simulating token about to expire
+        await c.get_data()
+        # The refresh runs in the background, in a task kept by the session
+        task = s.auth._refresh_task
+        assert task is not None
+        await task
+        assert s.auth.refresh_at > 0
+
+    run_with_session(test, calls)
+    assert calls.count('token') == 2
+
+
+def test_async_concurrent_requests():
+    calls = []
+
+    async def test(s):
+        names = ['curve{}'.format(n) for n in range(50)]
+        curves = await asyncio.gather(*[s.get_curve(name=n) for n in names])
+        assert [c.name for c in curves] == names
+        data = await asyncio.gather(*[c.get_data() for c in curves])
+        assert all(isinstance(d, wapi.util.TS) for d in data)
+
+    run_with_session(test, calls)
+    assert calls.count('token') == 1
+    assert calls.count('series') == 50
+
+
+def test_async_search_and_instances():
+    calls = []
+
+    async def test(s):
+        c = await s.search(name=['testcurve5', 'testcurve7'])
+        assert isinstance(c[0], aio.TimeSeriesCurve)
+        assert isinstance(c[1], aio.InstanceCurve)
+        res = await c[1].get_latest()
+        assert isinstance(res, wapi.util.TS)
+        assert res.issue_date == '2016-01-01T00:00Z'
+
+    run_with_session(test, calls)
+
+
+def test_async_retry(monkeypatch):
+    monkeypatch.setattr(wapi.session, 'RETRY_DELAY', 0.00001)
+    calls = []
+
+    async def test(s):
+        s.metrics = wapi.metrics.Metrics()
+        c = s.make_curve(9, 'TAGGED')
+        assert await c.get_tags() == ['ok']
+        assert s.metrics.get('wapi_retries_total', endpoint='/api/series/tagged/{id}/tags') == 2
+        assert s.metrics.get('wapi_requests_total', status='503') == 2
+        assert s.metrics.get('wapi_stage_seconds', stage='decode') == 1
+
+    run_with_session(test, calls)
+    assert calls.count('flaky') == 3
+
+
+def test_async_get_data_many():
+    calls = []
+
+    async def test(s):
+        results, errors = await s.get_data_many(['testcurve5', 'testcurve7', 'missing'], max_workers=2)
+        assert isinstance(results['testcurve5'], wapi.util.TS)
+        assert isinstance(errors['testcurve7'], wapi.util.CurveException)
+        assert isinstance(errors['missing'], wapi.session.MetadataException)
+
+    run_with_session(test, calls)
+
+
+def test_async_iter_history():
+    calls = []
+
+    async def test(s):
+        c = s.make_curve(10, 'TAGGED_INSTANCES')
+        return [(ts.issue_date, ts.tag) async for ts in c.iter_history(max_points_per_request=20)]
+
+    res = run_with_session(test, calls)
+    assert res == [('2016-01-0{}'.format(n), t) for n in range(1, 6) for t in ['a', 'b']]
+    # The list of instances, then two instances with two tags per call
+    assert calls.count('instances') == 4
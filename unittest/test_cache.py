@@ -0,0 +1,182 @@
+import json
+import os
+import types
+
+import numpy as np
+import pytz
+
+from wapi import cache, events, util
+from wapi.util import TS
+
+HOUR = 3600 * 1000
+
+
+def make_ts(begin, end, tag=None):
+    timestamps = np.arange(begin, end, HOUR)
+    return TS(id=5, name='testcurve5', frequency='H', time_zone='CET', tag=tag,
+              points=(timestamps, timestamps.astype(np.float64)))
+
+
+def test_subtract():
+    assert cache._subtract(0, 10, []) == [(0, 10)]
+    assert cache._subtract(0, 10, [(2, 4), (6, 8)]) == [(0, 2), (4, 6), (8, 10)]
+    assert cache._subtract(0, 10, [(-5, 3), (3, 12)]) == []
+    assert cache._subtract(5, 10, [(0, 6), (20, 30)]) == [(6, 10)]
+
+
+def test_entry_store_and_invalidate():
+    entry = cache._Entry()
+    assert entry.extract(0, 10 * HOUR) is None
+    entry.store(5 * HOUR, 10 * HOUR, make_ts(5 * HOUR, 10 * HOUR))
+    entry.store(0, 5 * HOUR, make_ts(0, 5 * HOUR))
+    assert entry.missing(0, 12 * HOUR) == [(10 * HOUR, 12 * HOUR)]
+    ts = entry.extract(2 * HOUR, 7 * HOUR)
+    assert ts.name == 'testcurve5'
+    assert ts.timestamps.tolist() == list(range(2 * HOUR, 7 * HOUR, HOUR))
+    entry.invalidate(3 * HOUR, 4 * HOUR)
+    assert entry.missing(0, 10 * HOUR) == [(3 * HOUR, 4 * HOUR)]
+    assert 3 * HOUR not in entry.timestamps
+    # Old data is fetched again when max_age is given
+    assert entry.missing(0, 10 * HOUR, max_age=-1) == [(0, 10 * HOUR)]
+
+
+def fetch_plan(fetched, tag=None):
+    def plan(begin, end):
+        b = 0 if begin is None else util.to_millis(begin)
+        e = 10 * HOUR if end is None else util.to_millis(end)
+        fetched.append((b, e))
+        return [None], lambda results: make_ts(b, e, tag)
+    return plan
+
+
+def test_disk_cache(tmp_path):
+    tz = pytz.timezone('CET')
+    c = cache.DiskCache(str(tmp_path))
+    begin = util.from_millis(0, tz)
+    fetched = []
+    queries, combine = c.plan(5, None, begin, util.from_millis(10 * HOUR, tz), {}, fetch_plan(fetched))
+    assert len(queries) == 1
+    assert len(combine([None]).timestamps) == 10
+    # A new cache on the same directory only fetches what is missing
+    c = cache.DiskCache(str(tmp_path))
+    queries, combine = c.plan(5, None, begin, util.from_millis(15 * HOUR, tz), {}, fetch_plan(fetched))
+    assert fetched == [(0, 10 * HOUR), (10 * HOUR, 15 * HOUR)]
+    ts = combine([None])
+    assert ts.timestamps.tolist() == list(range(0, 15 * HOUR, HOUR))
+    queries, combine = c.plan(5, None, begin, util.from_millis(15 * HOUR, tz), {}, fetch_plan(fetched))
+    assert queries == [] and len(combine([]).values) == 15
+    assert (c.hits, c.misses) == (1, 1)
+    # Aggregations are only reused for the same range
+    options = {'function': 'AVERAGE', 'frequency': 'D'}
+    c.plan(5, None, begin, util.from_millis(15 * HOUR, tz), options, fetch_plan(fetched))
+    assert fetched[-1] == (0, 15 * HOUR)
+    c.invalidate(5, begin=util.from_millis(2 * HOUR, tz), end=util.from_millis(3 * HOUR, tz))
+    c.plan(5, None, begin, util.from_millis(15 * HOUR, tz), {}, fetch_plan(fetched))
+    assert fetched[-1] == (2 * HOUR, 3 * HOUR)
+    c.invalidate(5)
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_disk_cache_eviction(tmp_path):
+    tz = pytz.timezone('CET')
+    c = cache.DiskCache(str(tmp_path), max_size=5000)
+    begin = util.from_millis(0, tz)
+    for tag in ['a', 'b', 'c']:
+        queries, combine = c.plan(5, tag, begin, util.from_millis(100 * HOUR, tz), {}, fetch_plan([], tag))
+        combine([None])
+    # Each entry takes more than 2500 bytes, only the last one is kept
+    assert [k[1] for k in c._keys(5)] == ['c']
+
+
+def test_memory_cache_lru():
+    tz = pytz.timezone('CET')
+    c = cache.MemoryCache(max_size=4000)
+    begin = util.from_millis(0, tz)
+    end = util.from_millis(100 * HOUR, tz)
+    for tag in ['a', 'b']:
+        queries, combine = c.plan(5, tag, begin, end, {}, fetch_plan([], tag))
+        combine([None])
+    # Each entry takes 1600 bytes, and using 'a' makes 'b' the least
+    # recently used
+    queries, combine = c.plan(5, 'a', begin, end, {}, fetch_plan([]))
+    assert queries == [] and combine([]).tag == 'a'
+    queries, combine = c.plan(5, 'c', begin, end, {}, fetch_plan([], 'c'))
+    combine([None])
+    assert sorted(k[1] for k in c._keys(5)) == ['a', 'c']
+
+
+def test_memory_cache_copies():
+    tz = pytz.timezone('CET')
+    c = cache.MemoryCache()
+    begin = util.from_millis(0, tz)
+    end = util.from_millis(10 * HOUR, tz)
+    c.plan(5, None, begin, end, {}, fetch_plan([]))[1]([None])
+    ts = c.plan(5, None, begin, end, {}, fetch_plan([]))[1]([])
+    ts.values *= 2
+    ts.timestamps[0] = -1
+    ts = c.plan(5, None, begin, end, {}, fetch_plan([]))[1]([])
+    assert ts.values.tolist() == ts.timestamps.astype(np.float64).tolist()
+    assert ts.timestamps[0] == 0
+
+
+def curve_event(id, **data):
+    sse = types.SimpleNamespace(data=json.dumps(dict(id=id, created='2018-01-01T00:00:00+01:00',
+                                                     operation='modify', **data)))
+    return events.CurveEvent(sse)
+
+
+def test_handle_event():
+    tz = pytz.timezone('CET')
+    c = cache.MemoryCache()
+    begin = util.from_millis(0, tz)
+    end = util.from_millis(10 * HOUR, tz)
+    for tag in ['a', 'b']:
+        queries, combine = c.plan(5, tag, begin, end, {}, fetch_plan([], tag))
+        combine([None])
+    queries, combine = c.plan(5, None, None, None, {}, fetch_plan([]), issue_date=0)
+    combine([None])
+    c.handle_event(curve_event(5, tag='a', range={'begin': '1970-01-01T03:00:00+01:00',
+                                                  'end': '1970-01-01T05:00:00+01:00'}))
+    fetched = []
+    c.plan(5, 'a', begin, end, {}, fetch_plan(fetched))
+    c.plan(5, 'b', begin, end, {}, fetch_plan(fetched))
+    assert fetched == [(2 * HOUR, 4 * HOUR)]
+    # Events for other curves and other instances change nothing
+    c.handle_event(curve_event(6))
+    c.handle_event(curve_event(5, issue_date='1970-01-01T02:00:00+01:00'))
+    c.handle_event(curve_event(5, range={'empty': True}))
+    assert (5, None, 0) in [k[:3] for k in c._keys(5)]
+    c.handle_event(curve_event(5, issue_date='1970-01-01T01:00:00+01:00'))
+    assert (5, None, 0) not in [k[:3] for k in c._keys(5)]
+
+
+def test_invalidate_while_fetching():
+    tz = pytz.timezone('CET')
+    c = cache.MemoryCache()
+    queries, combine = c.plan(5, None, util.from_millis(0, tz), util.from_millis(10 * HOUR, tz), {},
+                              fetch_plan([]))
+    c.invalidate(5)
+    # The data is returned, but may be stale and is not kept
+    assert len(combine([None]).values) == 10
+    assert c._keys(5) == []
+
+
+def test_metadata_cache(tmp_path):
+    path = str(tmp_path / 'curves.json')
+    c = cache.MetadataCache(path, max_entries=3)
+    c.add_curve({'id': 5, 'name': 'TestCurve5'})
+    c.put(c.search_key('/api/curves?name=testcurve5'), [{'id': 5, 'name': 'TestCurve5'}])
+    assert c.get(c.curve_key(name='testcurve5'))['id'] == 5
+    # The least recently used entry is evicted
+    c.add_curve({'id': 6, 'name': 'testcurve6'})
+    assert c.get(c.curve_key(id=5)) is None
+    assert (c.hits, c.misses) == (1, 1)
+    c.save()
+    c = cache.MetadataCache(path, max_entries=3)
+    assert c.get(c.curve_key(id=6))['name'] == 'testcurve6'
+    c.invalidate(name='TESTCURVE5')
+    assert c.get(c.search_key('/api/curves?name=testcurve5')) is None
+    assert c.get(c.curve_key(name='testcurve5')) is None
+    # Old entries are looked up again
+    c.max_age = -1
+    assert c.get(c.curve_key(id=6)) is None
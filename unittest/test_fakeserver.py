@@ -0,0 +1,70 @@
+import pytest
+
+import wapi
+from wapi import util
+
+from fakeserver import FakeServer, make_curves
+
+
+@pytest.fixture
+def server():
+    curves = make_curves(4, size=48, curve_types=(util.TIME_SERIES, util.TAGGED, util.INSTANCES,
+                                                  util.TAGGED_INSTANCES))
+    with FakeServer(curves) as server:
+        yield server
+
+
+def test_curves(server):
+    s = server.session()
+    c = s.get_curve(name='fake_curve_0')
+    assert isinstance(c, wapi.curves.TimeSeriesCurve)
+    curve_list, missing = s.get_curves(['fake_curve_1', 'fake_curve_3', 'missing'])
+    assert [c.curve_type for c in curve_list] == [util.TAGGED, util.TAGGED_INSTANCES]
+    assert missing == ['missing']
+    with pytest.raises(wapi.session.MetadataException):
+        s.get_curve(name='missing')
+
+
+def test_data(server):
+    s = server.session()
+    ts = s.get_curve(name='fake_curve_0').get_data()
+    assert len(ts.values) == 48
+    ts = s.get_curve(name='fake_curve_0').get_data(data_from='2020-01-02', data_to='2020-01-03')
+    assert len(ts.values) == 24
+    tagged = s.get_curve(name='fake_curve_1')
+    assert tagged.get_tags() == ['a', 'b']
+    assert [t.tag for t in tagged.get_data(tag=['a', 'b'])] == ['a', 'b']
+    inst = s.get_curve(name='fake_curve_2')
+    latest = inst.get_latest()
+    assert latest.issue_date is not None and len(latest.values) == 48
+    assert len(inst.search_instances()) == 5
+    assert inst.get_instance(issue_date=latest.issue_date, with_data=False).values is None
+    tagged_inst = s.get_curve(name='fake_curve_3')
+    assert tagged_inst.get_latest(tags='b').tag == 'b'
+
+
+def test_iter_data(server):
+    s = server.session()
+    tagged = s.get_curve(name='fake_curve_1')
+    chunks = list(tagged.iter_data(tag=['a', 'b'], data_from='2020-01-01', data_to='2020-01-11', chunk=50))
+    assert [[ts.tag for ts in chunk] for chunk in chunks] == [['a', 'b']] * 5
+    timestamps = [t for chunk in chunks for t in chunk[0].timestamps.tolist()]
+    assert len(timestamps) == 240 and timestamps == sorted(timestamps)
+
+
+def test_errors():
+    with FakeServer(make_curves(1), error_rate=0.2, seed=1) as server:
+        s = server.session(retry_policy=wapi.retry.RetryPolicy(retries=10, backoff=0, budget=None))
+        for n in range(10):
+            assert len(s.get_curve(name='fake_curve_0').get_data().values) == 24
+        assert server.errors > 0
+        assert s.retry_policy.stats()['retries'] == server.errors
+
+
+def test_events(server):
+    s = server.session()
+    curves = [s.get_curve(name='fake_curve_0'), s.get_curve(name='fake_curve_2')]
+    with s.events(curves, timeout=5) as listener:
+        events = [listener.get() for _ in range(4)]
+    assert [e.id for e in events] == [1, 3, 1, 3]
+    assert all(isinstance(e, wapi.events.CurveEvent) and e.range is not None for e in events)
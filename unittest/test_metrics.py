@@ -0,0 +1,54 @@
+from urllib.request import urlopen
+
+import numpy as np
+
+from wapi import metrics
+
+
+def test_endpoint():
+    assert metrics.endpoint('/api/series/5?from=2018-01-01') == '/api/series/{id}'
+    assert metrics.endpoint('https://api.host/api/instances/tagged/10/get?tag=a') == '/api/instances/tagged/{id}/get'
+    assert metrics.endpoint('rtsp://auth.host/oauth2/token') == '/oauth2/token'
+
+
+def test_count_points():
+    assert metrics.count_points({'points': [[1, 2.0], [2, 3.0]]}) == 2
+    assert metrics.count_points([{'points': (np.arange(3), np.zeros(3))}, {'id': 5}]) == 3
+    assert metrics.count_points(['tag']) == 0
+
+
+def test_prometheus_text():
+    m = metrics.Metrics(buckets=(0.1, 1.0))
+    m.observe_request('/api/series/{id}', 'GET', 200, 0.05, 100)
+    m.observe_request('/api/series/{id}', 'GET', 500, 2.0, 10)
+    m.observe_retry('/api/series/{id}')
+    m.observe_stage('decode', '/api/series/{id}', 0.5)
+    m.observe_points('/api/series/{id}', 24)
+    assert m.get('wapi_requests_total') == 2
+    assert m.get('wapi_requests_total', status='500') == 1
+    assert m.get('wapi_request_seconds', method='GET') == 2
+    text = m.to_prometheus()
+    lines = text.splitlines()
+    assert '# TYPE wapi_request_seconds histogram' in lines
+    assert 'wapi_requests_total{endpoint="/api/series/{id}",method="GET",status="200"} 1' in lines
+    assert 'wapi_request_seconds_bucket{endpoint="/api/series/{id}",method="GET",le="0.1"} 1' in lines
+    assert 'wapi_request_seconds_bucket{endpoint="/api/series/{id}",method="GET",le="+Inf"} 2' in lines
+    assert 'wapi_request_seconds_sum{endpoint="/api/series/{id}",method="GET"} 2.05' in lines
+    assert 'wapi_stage_seconds_count{stage="decode",endpoint="/api/series/{id}"} 1' in lines
+    assert 'wapi_response_bytes_total{endpoint="/api/series/{id}"} 110' in lines
+    assert 'wapi_points_total{endpoint="/api/series/{id}"} 24' in lines
+    m.clear()
+    assert m.get('wapi_requests_total') == 0
+
+
+def test_serve():
+    m = metrics.Metrics()
+    m.observe_retry('/api/curves')
+    server = m.serve()
+    try:
+        response = urlopen('http://127.0.0.1:{}/metrics'.format(server.server_port))
+        assert response.headers['Content-Type'].startswith('text/plain')
+        assert 'wapi_retries_total{endpoint="/api/curves"} 1' in response.read().decode()
+    finally:
+        server.shutdown()
+        server.server_close()
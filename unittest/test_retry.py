@@ -0,0 +1,48 @@
+import email.utils
+import time
+
+from wapi import retry
+
+
+class Response:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+def test_retry_after():
+    assert retry.retry_after(Response(503)) is None
+    assert retry.retry_after(Response(503, {'Retry-After': '2'})) == 2.0
+    date = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert 25 < retry.retry_after(Response(503, {'Retry-After': date})) <= 30
+    assert retry.retry_after(Response(503, {'Retry-After': 'soon'})) is None
+
+
+def test_backoff():
+    policy = retry.RetryPolicy(retries=4, backoff=1.0, max_delay=5.0, jitter=False)
+    assert [policy.retry_delay(n, Response(500)) for n in range(5)] == [1.0, 2.0, 4.0, 5.0, None]
+    assert policy.retry_delay(0, Response(404)) is None
+    assert policy.retry_delay(0, Response(200)) is None
+    assert policy.retry_delay(0, error=IOError()) == 1.0
+    policy = retry.RetryPolicy(backoff=1.0)
+    assert all(0 <= policy.retry_delay(2, Response(502)) <= 4.0 for _ in range(5))
+
+
+def test_retry_after_honored():
+    policy = retry.RetryPolicy(backoff=0.1, max_delay=10.0, jitter=False)
+    assert policy.retry_delay(0, Response(429, {'Retry-After': '3'})) == 3.0
+    # A longer wait than max_delay is not retried
+    assert policy.retry_delay(0, Response(429, {'Retry-After': '60'})) is None
+    assert policy.stats() == {'requests': 0, 'retries': 1, 'exhausted': 1, 'throttled': 0}
+
+
+def test_budget():
+    policy = retry.RetryPolicy(backoff=0, budget=2, budget_ratio=0.5)
+    assert policy.retry_delay(0, Response(503)) == 0
+    assert policy.retry_delay(0, Response(503)) == 0
+    assert policy.retry_delay(0, Response(503)) is None
+    # Requests earn new retries
+    policy.start()
+    policy.start()
+    assert policy.retry_delay(0, Response(503)) == 0
+    assert policy.stats() == {'requests': 2, 'retries': 3, 'exhausted': 0, 'throttled': 1}
@@ -1,4 +1,7 @@
 from unittest.mock import Mock, patch, MagicMock
+import os
+import threading
+import time
 
 import pytest
 import requests
@@ -11,6 +14,10 @@ class MockResponse:
     def __init__(self, status_code, content="Mock content"):
         self.status_code = status_code
         self.content = content
+        self.closed = False
+
+    def close(self):
+        self.closed = True
         
 
 def make_wapi_session():
@@ -167,3 +174,143 @@ def test_data_request__fail_too_many_times(requests_mock, auth_mock):
     assert len(validation_called) == 5
     assert requests_mock.Session.return_value.request.call_count == 0
 
+
+@patch.object(wapi.session.requests.Session, "request")
+def test_token_refresh__concurrent__single_flight(mock_request):
+    token_calls = []
+
+    def mock_request_effect(**kwargs):
+        if kwargs["method"] == "POST":
+            token_calls.append(kwargs)
+            time.sleep(0.05)
+            return MockResponse(200, content=json.dumps({"access_token": "a", "token_type": "b", "expires_in": 1000}).encode())
+        return MockResponse(200, "curves")
+
+    mock_request.side_effect = mock_request_effect
+    session = make_wapi_session()
+    session.auth.valid_until = 0  # simulating token expiring
+
+    threads = [threading.Thread(target=session.data_request, args=('GET', None, '/curves')) for _ in range(32)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(token_calls) == 2
+
+
+@patch.object(wapi.session.requests.Session, "request")
+def test_token_refresh__ahead__background(mock_request):
+    tokens = iter(["a", "c"])
+    headers = []
+
+    def mock_request_effect(**kwargs):
+        if kwargs["method"] == "POST":
+            token = next(tokens)
+            if token == "c":
+                time.sleep(0.05)
+            return MockResponse(200, content=json.dumps({"access_token": token, "token_type": "b", "expires_in": 1000}).encode())
+        headers.append(kwargs["headers"])
+        return MockResponse(200, "curves")
+
+    mock_request.side_effect = mock_request_effect
+    session = make_wapi_session()
+    session.auth.refresh_at = 0  # simulating token about to expire
+
+    # The request goes ahead with the old token, which is refreshed in the background
+    session.data_request('GET', None, '/curves')
+    assert headers == [{'Authorization': 'b a'}]
+    for _ in range(100):
+        if session.auth.token == "c":
+            break
+        time.sleep(0.01)
+    assert session.auth.get_headers(None) == {'Authorization': 'b c'}
+    assert session.auth.refresh_at > time.time()
+
+
+@patch.object(wapi.session.requests.Session, "request")
+def test_token_refresh__ahead__no_wait(mock_request):
+    tokens = iter(["a", "c"])
+
+    def mock_request_effect(**kwargs):
+        if kwargs["method"] == "POST":
+            token = next(tokens)
+            if token == "c":
+                time.sleep(0.5)  # A slow token endpoint
+            return MockResponse(200, content=json.dumps({"access_token": token, "token_type": "b", "expires_in": 1000}).encode())
+        return MockResponse(200, "curves")
+
+    mock_request.side_effect = mock_request_effect
+    session = make_wapi_session()
+    session.auth.refresh_at = 0  # simulating token about to expire
+
+    # Neither the request starting the refresh nor the ones during it wait for the token
+    start = time.time()
+    for _ in range(3):
+        session.data_request('GET', None, '/curves')
+    assert time.time() - start < 0.25
+    assert session.auth.token == "a"
+    for _ in range(100):
+        if session.auth.token == "c":
+            break
+        time.sleep(0.01)
+    assert session.auth.token == "c"
+
+
+@patch.object(wapi.session.requests.Session, "request")
+def test_token_cache__shared__single_login(mock_request, tmp_path):
+    tokens = iter(["a", "c"])
+
+    def mock_request_effect(**kwargs):
+        if kwargs["method"] == "POST":
+            return MockResponse(200, content=json.dumps({"access_token": next(tokens), "token_type": "b", "expires_in": 1000}).encode())
+        return MockResponse(200, "curves")
+
+    mock_request.side_effect = mock_request_effect
+    path = str(tmp_path / 'tokens.json')
+    sessions = [wapi.session.Session(urlbase='https://volueinsight.com', auth_urlbase='https://auth.vs.com',
+                                     client_id='client1', client_secret='secret1', token_cache=path)
+                for _ in range(3)]
+    assert mock_request.call_count == 1
+    assert all(s.auth.get_headers(None) == {'Authorization': 'b a'} for s in sessions)
+    assert oct(os.stat(path).st_mode & 0o777) == oct(0o600)
+    assert 'secret1' not in open(path).read()
+
+    # A token due for a refresh is fetched again, and shared
+    sessions[0].auth.token_cache.store(wapi.auth.TokenCache.key('client1', 'https://auth.vs.com'),
+                                       {'token': 'a', 'token_type': 'b', 'valid_until': time.time() + 10,
+                                        'refresh_at': 0})
+    session = wapi.session.Session(urlbase='https://volueinsight.com', auth_urlbase='https://auth.vs.com',
+                                   client_id='client1', client_secret='secret1', token_cache=path)
+    assert session.auth.get_headers(None) == {'Authorization': 'b c'}
+    assert wapi.auth.TokenCache(path).load(wapi.auth.TokenCache.key('client1', 'https://auth.vs.com'))['token'] == 'c'
+
+
+@patch('wapi.session.auth', MagicMock())
+@patch('wapi.session.requests')
+def test_send_data_request__retry_after__honored(requests_mock):
+    responses = [MockResponse(429), MockResponse(200)]
+    responses[0].headers = {'Retry-After': '0.01'}
+    requests_mock.Session.return_value.request.side_effect = responses
+
+    session = make_wapi_session()
+    session.retry_policy = wapi.retry.RetryPolicy(backoff=0)
+    response = session.send_data_request("GET", "http://urlbase", "/url")
+
+    assert response.status_code == 200
+    assert session.retry_policy.stats() == {'requests': 1, 'retries': 1, 'exhausted': 0, 'throttled': 0}
+
+
+@patch('wapi.session.auth', MagicMock())
+@patch('wapi.session.requests')
+def test_send_data_request__retry__closes_response(requests_mock):
+    responses = [MockResponse(503), MockResponse(200)]
+    requests_mock.Session.return_value.request.side_effect = responses
+
+    session = make_wapi_session()
+    session.retry_policy = wapi.retry.RetryPolicy(backoff=0)
+    response = session.send_data_request("GET", "http://urlbase", "/url", stream=True)
+
+    # The streamed body of the retried response is never read, so its
+    # connection is released before the next attempt
+    assert response is responses[1] and not response.closed
+    assert responses[0].closed
@@ -0,0 +1,60 @@
+import json
+
+import numpy as np
+import pytest
+
+from wapi import stream
+from wapi.util import TS
+
+
+def chunked(body, size):
+    return [body[n:n + size] for n in range(0, len(body), size)]
+
+
+def check_points(decoded, points):
+    timestamps, values = decoded
+    assert timestamps.dtype == np.int64
+    assert timestamps.tolist() == [p[0] for p in points]
+    assert [None if np.isnan(v) else v for v in values.tolist()] == [p[1] for p in points]
+
+
+@pytest.mark.parametrize('size', [1, 3, 7, 64, 100000])
+def test_decode_series(size):
+    points = [[1514761200000 + n * 3600000, n * 1.5] for n in range(300)]
+    points[10][1] = None
+    doc = {'id': 5, 'name': 'a "points": [[1, 2]] name', 'frequency': 'H', 'points': points,
+           'query': {'points': 'x'}}
+    res = stream.decode(chunked(json.dumps(doc).encode(), size))
+    check_points(res.pop('points'), points)
+    doc.pop('points')
+    assert res == doc
+    # And with whitespace in the points
+    res = stream.decode(chunked(json.dumps(dict(doc, points=points), indent=2).encode(), size))
+    check_points(res['points'], points)
+
+
+@pytest.mark.parametrize('size', [1, 5, 100000])
+def test_decode_list(size):
+    docs = [{'tag': 'a', 'points': [[0, 1.0], [3600000, -2e-3]]},
+            {'tag': 'b', 'points': []},
+            {'tag': 'c', 'points': None},
+            {'tag': 'd'}]
+    res = stream.decode(chunked(json.dumps(docs).encode(), size))
+    check_points(res[0]['points'], docs[0]['points'])
+    check_points(res[1]['points'], [])
+    assert res[2]['points'] is None
+    assert res[3] == {'tag': 'd'}
+    ts = TS(frequency='H', input_dict=res[0])
+    assert ts.points == docs[0]['points']
+
+
+def test_decode_errors():
+    with pytest.raises(ValueError):
+        stream.decode([b'{"points": [[1, 2, 3]]}'])
+    with pytest.raises(ValueError):
+        stream.decode([b'{"points": [[1, 2], [3'])
+    # Rows of the wrong size, even when the number of fields is even
+    for chunks in [[b'{"points": [[1, 2, 3], [4, 5, 6]]}'], [b'{"points": [[1], [2]]}'],
+                   [b'{"points": [[1, 2, 3], ', b'[4, 5, 6]]}'], [b'{"points": [[], [1, 2]]}']]:
+        with pytest.raises(ValueError):
+            stream.decode(chunks)
@@ -1,5 +1,15 @@
+import datetime
+import subprocess
+import sys
+
+import dateutil.parser
+import dateutil.relativedelta
+import numpy as np
+import pandas as pd
 import pytest
+import pytz
 
+from wapi import util
 from wapi.curves import TimeSeriesCurve
 from wapi.util import TS
 
@@ -88,3 +98,193 @@ def test_median_ts(ts1, ts2, ts3):
 
     for dp1, dp2 in zip(points, summed.points):
         assert dp1 == dp2
+
+
+def test_split_range_dst():
+    tz = pytz.timezone('CET')
+    begin = util.to_datetime('2020-03-27', tz)
+    end = util.to_datetime(datetime.datetime(2020, 4, 2), tz)
+    windows = util.split_range(begin, end, 'MIN15', 2400)
+    # 2400 points is 24 days of 25 hours, but the range is shorter
+    assert windows == [(begin, end)]
+    windows = util.split_range(begin, end, 'MIN15', 200)
+    # Split on whole local days, also across the change to summer time
+    assert [(b.isoformat(), e.isoformat()) for b, e in windows] == [
+        ('2020-03-27T00:00:00+01:00', '2020-03-29T00:00:00+01:00'),
+        ('2020-03-29T00:00:00+01:00', '2020-03-31T00:00:00+02:00'),
+        ('2020-03-31T00:00:00+02:00', '2020-04-02T00:00:00+02:00')]
+
+
+def test_split_range_sub_day():
+    tz = pytz.timezone('CET')
+    begin = util.to_datetime('2020-03-28', tz)
+    end = util.to_datetime('2020-03-31', tz)
+    # Less than a day per request, in windows of whole minutes
+    windows = util.split_range(begin, end, 'MIN', 1000)
+    assert all(e - b <= datetime.timedelta(minutes=1000) for b, e in windows)
+    assert windows[0] == (begin, util.to_datetime('2020-03-28T16:40', tz))
+    assert [b for b, _ in windows[1:]] == [e for _, e in windows[:-1]] and windows[-1][1] == end
+    assert sum(int((e - b).total_seconds()) // 60 for b, e in windows) == 71 * 60
+    # Also across the change to summer time
+    assert windows[1] == (util.to_datetime('2020-03-28T16:40', tz), util.to_datetime('2020-03-29T10:20', tz))
+    with pytest.raises(ValueError):
+        util.split_range(begin, end, 'H', 0)
+
+
+def test_split_range_months():
+    tz = pytz.timezone('CET')
+    windows = util.split_range(util.to_datetime('2020-01-01', tz), util.to_datetime('2021-01-01', tz), 'M', 5)
+    assert [(b.month, e.month) for b, e in windows] == [(1, 6), (6, 11), (11, 1)]
+    assert util.split_range(util.to_datetime('2020-01-01', tz), util.to_datetime('2021-01-01', tz), 'ANY', 5) is None
+
+
+def test_to_pandas_dst_and_missing():
+    # Hourly values across the change to summer time in CET, with a missing value
+    start = 1585440000000  # 2020-03-29T00:00:00Z
+    points = [[start + n * 3600000, float(n)] for n in range(4)]
+    points[2][1] = None
+    ts = TS(id=4, frequency='H', time_zone='CET', points=points)
+    pd_series = ts.to_pandas()
+    assert [t.isoformat() for t in pd_series.index] == [
+        '2020-03-29T01:00:00+01:00', '2020-03-29T03:00:00+02:00',
+        '2020-03-29T04:00:00+02:00', '2020-03-29T05:00:00+02:00']
+    assert pd_series.isnull().tolist() == [False, False, True, False]
+    assert TS.from_pandas(pd_series).frequency == 'H'
+    with pytest.raises(ValueError):
+        TS(id=4, frequency='H', points=[[start, 1.0, 2.0]]).to_pandas()
+
+
+def test_from_pandas_points():
+    index = pd.date_range('2020-10-25', periods=5, freq='h', tz='CET') + pd.Timedelta(milliseconds=500)
+    pd_series = pd.Series([1, 2, np.nan, 4, 5], index=index, name='42')
+    ts = TS.from_pandas(pd_series)
+    assert ts.id == 42
+    assert ts.frequency == 'H'
+    # Timestamps are truncated to whole seconds, and NaN is None
+    assert ts.points == [[1603576800000, 1.0], [1603580400000, 2.0], [1603584000000, None],
+                         [1603587600000, 4.0], [1603591200000, 5.0]]
+    assert all(type(v) is float for _, v in ts.points if v is not None)
+
+
+def test_ts_arrays(ts1):
+    assert ts1.timestamps.dtype == np.int64
+    assert ts1.values.tolist() == [80.0, 90.0, 70.0, 120.0]
+    ts = TS(id=1, frequency='D', input_dict={'points': [[0, 1], [86400000, None]]})
+    assert ts.timestamps.tolist() == [0, 86400000]
+    assert np.isnan(ts.values[1])
+    assert ts.points == [[0, 1.0], [86400000, None]]
+    # Setting the arrays replaces the points
+    ts.points = (np.array([0]), np.array([2.0]))
+    assert ts.points == [[0, 2.0]]
+    ts.values = [3.0]
+    assert ts.points == [[0, 3.0]]
+    ts.points = []
+    assert ts.points == [] and len(ts.to_pandas()) == 0
+    ts.points = None
+    assert ts.points is None and ts.values is None
+    # Timestamps without values
+    ts.timestamps = [0, 86400000]
+    assert ts.timestamps.tolist() == [0, 86400000] and ts.values is None
+
+
+def test_ts_points_in_place(ts1, ts2):
+    # Changes to the list of points are seen by the arrays and conversions
+    ts1.points[0][1] = 100
+    ts1.points.append([10454400000, None])
+    assert ts1.values[0] == 100.0 and np.isnan(ts1.values[-1])
+    assert ts1.timestamps.tolist()[-1] == 10454400000
+    assert ts1.to_pandas().tolist()[:4] == [100.0, 90.0, 70.0, 120.0]
+    assert TS.sum([ts1, ts2], 'sum').points[0] == [0, 220.0]
+    points = ts1.points
+    del points[1:]
+    assert len(ts1.values) == 1 and ts1.points is points
+    # Setting the arrays hands out a new list
+    ts1.values = [5.0]
+    assert ts1.points == [[0, 5.0]] and ts1.points is not points
+    ts1.points.append([1, 2, 3])
+    with pytest.raises(ValueError):
+        ts1.to_pandas()
+
+
+def test_ts_regular_index():
+    tz = pytz.timezone('CET')
+    # Daily values across the change to summer time, and monthly values
+    days = [tz.localize(datetime.datetime(2020, 3, 27 + n)) for n in range(3)]
+    months = [tz.localize(datetime.datetime(2020, 1 + n, 1)) for n in range(12)]
+    for frequency, dates in [('D', days), ('M', months)]:
+        timestamps = [int(d.timestamp()) * 1000 for d in dates]
+        ts = TS(id=1, frequency=frequency, time_zone='CET', points=[[t, 1.0] for t in timestamps])
+        assert ts._timestamps is None
+        assert ts.timestamps.tolist() == timestamps
+        assert [t.to_pydatetime() for t in ts.to_pandas().index] == dates
+    # Fixed steps use pandas.date_range, with the same index as the timestamps
+    ts = TS(id=1, frequency='MIN15', time_zone='CET',
+            points=[[1603584000000 + n * 900000, float(n)] for n in range(20)])
+    assert ts._timestamps is None
+    pd_series = ts.to_pandas()
+    assert pd_series.index.equals(pd.to_datetime(ts.timestamps, unit='ms', utc=True).tz_convert('CET'))
+    # Gaps keep the timestamps
+    ts.points = [[0, 1.0], [900000, 2.0], [2700000, 3.0]]
+    assert ts._regular is None
+    assert ts.to_pandas().isnull().tolist() == [False, False, True, False]
+
+
+@pytest.mark.parametrize('time_zone, local, frequency', [
+    ('Europe/Oslo', datetime.datetime(2018, 3, 20, 2, 30), 'D'),     # Skipped at the change to summer time
+    ('Europe/Oslo', datetime.datetime(2018, 10, 20, 2, 30), 'D'),    # Twice at the change to winter time
+    ('America/Sao_Paulo', datetime.datetime(2018, 10, 1), 'W'),      # Midnight skipped
+    ('CET', datetime.datetime(2020, 1, 31), 'M'),                    # Shorter months
+    ('CET', datetime.datetime(2019, 8, 31, 6), 'Q'),
+    ('Europe/London', datetime.datetime(2020, 2, 29), 'Y'),
+    ('UTC', datetime.datetime(2020, 1, 1), 'S'),
+])
+def test_regular_timestamps_calendar(time_zone, local, frequency):
+    # The same as stepping in local time and localizing each time-stamp
+    tz = pytz.timezone(time_zone)
+    unit, step = util._FREQ_STEP[frequency]
+    step = dateutil.relativedelta.relativedelta(**{'days' if unit == 'days' else 'months': step})
+    expected = [util.to_millis(tz.localize(local + step * n)) for n in range(200)]
+    start = util.to_millis(tz.localize(local))
+    assert util.regular_timestamps(start, 200, frequency, tz).tolist() == expected
+
+
+def test_ts_regular_values():
+    ts = TS(id=1, frequency='D', time_zone='CET', points=(util.regular_timestamps(0, 10, 'D', util.parse_tz('CET')),
+                                                          np.arange(10.0)))
+    # The timestamps are generated once, and kept when the values change
+    timestamps = ts.timestamps
+    assert ts.timestamps is timestamps
+    ts.values = np.arange(10.0) * 2
+    assert ts._regular is not None and ts.timestamps is timestamps
+    assert ts.points[1] == [int(timestamps[1]), 2.0]
+
+
+def test_import_without_pandas():
+    # pandas is only imported by the conversions
+    code = 'import sys, wapi; assert "pandas" not in sys.modules; wapi.util.TS(id=1, frequency="Y").to_pandas(); ' \
+           'assert "pandas" in sys.modules'
+    subprocess.check_call([sys.executable, '-c', code])
+
+
+@pytest.mark.parametrize('datestr', ['2018-01-01', '2018-01-01T12:30', '2018-01-01 12:30:15',
+                                     '2018-03-25T02:30:00', '2018-01-01T00:00:00+01:00',
+                                     '2018-01-01T00:00:00.123Z', '2018-06-01T00:00:00.123456-05:00',
+                                     '2018-01-01T00:00:00.5+01:00', 'Jan 1 2018 10:00', '20180101'])
+@pytest.mark.parametrize('tz', [None, 'Europe/Oslo'])
+def test_parsetime_iso_fast_path(datestr, tz):
+    # The same time and offset as parsing with dateutil
+    expected = dateutil.parser.parse(datestr)
+    if expected.tzinfo is None:
+        expected = util.parse_tz(tz or 'CET').localize(expected)
+    elif tz is not None:
+        expected = expected.astimezone(util.parse_tz(tz))
+    d = util.parsetime(datestr, tz=tz)
+    assert d == expected
+    assert d.utcoffset() == expected.utcoffset()
+
+
+def test_parse_tz_cached():
+    assert util.parse_tz('Europe/Oslo') is util.parse_tz('Europe/Oslo')
+    assert util.parse_tz('PST').zone == 'US/Pacific'
+    assert util.parse_tz('unknown').zone == 'CET'
+    assert TS._map_freq('min15') == '15min' and TS._rev_map_freq('15min') == 'MIN15'
@@ -1,8 +1,10 @@
+import io
 import json
 import os
 
 import pytest
 import requests_mock
+import threading
 import time
 
 import wapi
@@ -167,6 +169,24 @@ def test_time_series(ts_curve):
     assert c.frequency == 'H'
     assert c.time_zone == 'CET'
 
+def test_curve_metadata_attributes(session):
+    s,m = session
+    metadata = {'id': 5, 'name': 'testcurve5', 'frequency': 'H', 'time_zone': 'CET', 'curve_type': 'TIME_SERIES'}
+    c = s._build_curve(metadata)
+    assert not hasattr(c, '__dict__')
+    assert c.hasMetadata and c.name == 'testcurve5' and c.tz.zone == 'CET'
+    assert 'frequency' in dir(c)
+    with pytest.raises(AttributeError):
+        c.unit
+    # Setting metadata leaves the original dict alone
+    c.time_zone = 'Europe/Oslo'
+    assert c.tz.zone == 'Europe/Oslo'
+    assert metadata['time_zone'] == 'CET'
+    c = wapi.curves.TimeSeriesCurve(5, None, s)
+    assert not c.hasMetadata and str(c) == 'UNKNOWN(5)'
+    # The default time zone, when it is not in the metadata
+    assert not hasattr(c, 'time_zone') and c.tz.zone == 'CET'
+
 def test_ts_data(ts_curve):
     c,s,m = ts_curve
     datapoints = {'id': 5, 'frequency': 'H', 'points': [[140000000000, 10.0]]}
@@ -175,6 +195,16 @@ def test_ts_data(ts_curve):
     assert isinstance(d, wapi.util.TS)
     assert d.frequency == 'H'
 
+def test_ts_data_stream(ts_curve):
+    c,s,m = ts_curve
+    s.stream_data = True
+    datapoints = {'id': 5, 'frequency': 'H', 'points': [[140000000000, 10.0], [140003600000, None]]}
+    m.register_uri('GET', prefix + '/series/5?from=1&to=2', text=json.dumps(datapoints))
+    d = c.get_data(data_from=1, data_to=2)
+    assert isinstance(d, wapi.util.TS)
+    assert d.points == datapoints['points']
+    assert m.last_request.stream
+
 
 @pytest.fixture
 def tagged_curve(session):
@@ -411,3 +441,363 @@ def test_events(session, ts_curve, inst_curve):
             assert isinstance(event, wapi.events.CurveEvent)
             assert event.id == id
             assert isinstance(event.curve, wapi.curves.BaseCurve)
+
+
+def test_get_data_many(session):
+    s, m = session
+    metadata = [{'id': 5, 'name': 'testcurve5',
+                 'frequency': 'H', 'time_zone': 'CET',
+                 'curve_type': 'TIME_SERIES'},
+                {'id': 6, 'name': 'testcurve6',
+                 'frequency': 'H', 'time_zone': 'CET',
+                 'curve_type': 'TIME_SERIES'},
+                {'id': 7, 'name': 'testcurve7',
+                 'frequency': 'D', 'time_zone': 'CET',
+                 'curve_type': 'INSTANCES'}]
+    m.register_uri('GET', prefix + '/curves?name=testcurve5&name=testcurve6&name=testcurve7&name=missing',
+                   text=json.dumps(metadata))
+    datapoints = {'id': 5, 'frequency': 'H', 'points': [[140000000000, 10.0]]}
+    m.register_uri('GET', prefix + '/series/5?from=1&to=2&function=SUM', text=json.dumps(datapoints))
+    m.register_uri('GET', prefix + '/series/6?from=1&to=2&function=SUM', status_code=403, text='denied')
+    results, errors = s.get_data_many(['testcurve5', 'testcurve6', 'testcurve7', 'missing'],
+                                      data_from=1, data_to=2, function='SUM', max_workers=2)
+    assert list(results) == ['testcurve5']
+    assert isinstance(results['testcurve5'], wapi.util.TS)
+    assert isinstance(errors['testcurve6'], wapi.util.CurveException)
+    assert isinstance(errors['testcurve7'], wapi.util.CurveException)
+    assert isinstance(errors['missing'], wapi.session.MetadataException)
+
+
+def test_ts_data_chunked(ts_curve):
+    c,s,m = ts_curve
+    c.accessRange = {'begin': '2018-01-01T00:00:00+01:00', 'end': '2018-01-11T00:00:00+01:00'}
+    hour = 3600 * 1000
+    start = 1514761200000  # 2018-01-01T00:00+01:00
+
+    def series(request, context):
+        begin = wapi.util.parsetime(request.qs['from'][0])
+        end = wapi.util.parsetime(request.qs['to'][0])
+        first = int(begin.timestamp() * 1000)
+        last = int(end.timestamp() * 1000)
+        return {'id': 5, 'frequency': 'H', 'points': [[t, float(t)] for t in range(first, last, hour)]}
+    m.register_uri('GET', prefix + '/series/5', json=series)
+    d = c.get_data(max_points_per_request=100)
+    assert isinstance(d, wapi.util.TS)
+    # 4 days per request (allowing for 25-hour days), so 3 requests for 10 days
+    assert len([r for r in m.request_history if r.path == '/api/series/5']) == 3
+    assert [p[0] for p in d.points] == list(range(start, start + 240 * hour, hour))
+    assert all(p[0] == p[1] for p in d.points)
+
+
+def test_ts_data_chunked_unknown_range(ts_curve):
+    c,s,m = ts_curve
+    c.accessRange = {'begin': None, 'end': None}
+    m.register_uri('GET', prefix + '/series/5', json={'id': 5, 'frequency': 'H', 'points': []})
+    # A limit cannot be kept without a range, so nothing is fetched
+    with pytest.raises(wapi.util.CurveException):
+        c.get_data(max_points_per_request=100)
+    with pytest.raises(wapi.util.CurveException):
+        c.get_data(data_from='2018-01-01', max_points_per_request=100)
+    assert not [r for r in m.request_history if r.path == '/api/series/5']
+    # Given ends are enough
+    c.get_data(data_from='2018-01-01', data_to='2018-01-02', max_points_per_request=100)
+    assert len([r for r in m.request_history if r.path == '/api/series/5']) == 1
+
+
+def test_ts_iter_data(ts_curve):
+    c,s,m = ts_curve
+    hour = 3600 * 1000
+    start = 1514761200000  # 2018-01-01T00:00+01:00
+
+    requested = []
+    second = threading.Event()
+
+    def series(request, context):
+        requested.append(request.qs['from'][0][:10])
+        if len(requested) == 2:
+            second.set()
+        first = int(wapi.util.parsetime(request.qs['from'][0]).timestamp() * 1000)
+        last = int(wapi.util.parsetime(request.qs['to'][0]).timestamp() * 1000)
+        return {'id': 5, 'frequency': 'H', 'points': [[t, float(t)] for t in range(first, last, hour)]}
+    m.register_uri('GET', prefix + '/series/5', json=series)
+    chunks = c.iter_data(data_from='2018-01-01', data_to='2018-01-11', chunk=100)
+    first = next(chunks)
+    # The next chunk is fetched while the first one is processed, and only
+    # that one
+    assert second.wait(5)
+    assert requested == ['2018-01-01', '2018-01-05']
+    assert len(first.points) == 96
+    res = [first] + list(chunks)
+    assert [len(ts.points) for ts in res] == [96, 96, 48]
+    assert [p[0] for ts in res for p in ts.points] == list(range(start, start + 240 * hour, hour))
+    assert len([r for r in m.request_history if r.path == '/api/series/5']) == 3
+
+def test_inst_iter_history(inst_curve):
+    c,s,m = inst_curve
+    issue_dates = ['2016-01-0{}'.format(n) for n in range(1, 6)]
+    points = [[140000000000 + n * 3600000, 10.0] for n in range(10)]
+
+    def latest(request, context):
+        return {'frequency': 'H', 'points': points, 'id': 7, 'issue_date': issue_dates[-1]}
+
+    def instances(request, context):
+        first = request.qs.get('issue_date_from', [issue_dates[0]])[0]
+        last = request.qs.get('issue_date_to', ['9999'])[0]
+        with_data = request.qs['with_data'][0] == 'true'
+        # Newest first, as returned by the API
+        return [{'frequency': 'H', 'points': points if with_data else None, 'id': 7, 'issue_date': d}
+                for d in reversed(issue_dates) if first <= d < last]
+    m.register_uri('GET', prefix + '/instances/7/latest', json=latest)
+    m.register_uri('GET', prefix + '/instances/7', json=instances)
+    res = list(c.iter_history(max_points_per_request=25))
+    assert [ts.issue_date for ts in res] == issue_dates
+    assert all(len(ts.points) == 10 for ts in res)
+    # One call for the list of instances, and two instances per call after that
+    assert len([r for r in m.request_history if r.path == '/api/instances/7']) == 4
+
+
+def test_json_codec(session):
+    s,m = session
+
+    class CountingCodec(wapi.codec.JsonCodec):
+        dumped = 0
+        loaded = 0
+
+        def dumps(self, obj):
+            self.dumped += 1
+            return super(CountingCodec, self).dumps(obj)
+
+        def loads(self, data):
+            self.loaded += 1
+            return super(CountingCodec, self).loads(data)
+
+    s.json_codec = CountingCodec()
+    m.register_uri('PUT', prefix + '/series/5', text='{"res": "ok"}')
+    m.register_uri('GET', prefix + '/units', text='{"res": "ok"}')
+    s.data_request('PUT', s.urlbase, '/api/series/5', data={'points': [[0, 1.0]]})
+    assert json.loads(m.last_request.body) == {'points': [[0, 1.0]]}
+    assert m.last_request.headers['content-type'] == 'application/json'
+    # The body is only encoded once
+    assert s.json_codec.dumped == 1
+    assert s.get_attribute('units') == {'res': 'ok'}
+    assert s.json_codec.loaded == 1
+    assert isinstance(wapi.codec.get_codec('json'), wapi.codec.JsonCodec)
+    with pytest.raises(ValueError):
+        wapi.codec.get_codec('unknown')
+
+
+def test_ts_data_cached(ts_curve, tmp_path):
+    c,s,m = ts_curve
+    s.data_cache = wapi.cache.DiskCache(str(tmp_path))
+    hour = 3600 * 1000
+    start = 1514761200000  # 2018-01-01T00:00+01:00
+
+    def series(request, context):
+        first = int(wapi.util.parsetime(request.qs['from'][0]).timestamp() * 1000)
+        last = int(wapi.util.parsetime(request.qs['to'][0]).timestamp() * 1000)
+        return {'id': 5, 'name': 'testcurve5', 'frequency': 'H', 'time_zone': 'CET',
+                'points': [[t, float(t)] for t in range(first, last, hour)]}
+    m.register_uri('GET', prefix + '/series/5', json=series)
+    d = c.get_data(data_from='2018-01-03', data_to='2018-01-05')
+    assert len(d.points) == 48
+    d = c.get_data(data_from='2018-01-01', data_to='2018-01-11', max_points_per_request=100)
+    assert d.name == 'testcurve5'
+    assert [p[0] for p in d.points] == list(range(start, start + 240 * hour, hour))
+    assert all(p[0] == p[1] for p in d.points)
+    # Only the missing parts are fetched, the second one in two requests
+    ranges = [(r.qs['from'][0][:10], r.qs['to'][0][:10]) for r in m.request_history if r.path == '/api/series/5']
+    assert ranges[0] == ('2018-01-03', '2018-01-05')
+    assert sorted(ranges[1:]) == [('2018-01-01', '2018-01-03'), ('2018-01-05', '2018-01-09'),
+                                  ('2018-01-09', '2018-01-11')]
+    d = c.get_data(data_from='2018-01-02', data_to='2018-01-04')
+    assert len(d.points) == 48
+    assert len([r for r in m.request_history if r.path == '/api/series/5']) == 4
+
+
+def test_ts_data_cached_open_range(ts_curve):
+    c,s,m = ts_curve
+    s.data_cache = wapi.cache.MemoryCache()
+    c.accessRange = {'begin': '2018-01-01T00:00:00+01:00', 'end': '2018-01-02T00:00:00+01:00'}
+    datapoints = {'id': 5, 'frequency': 'H', 'points': [[1514761200000, 1.0]]}
+    m.register_uri('GET', prefix + '/series/5', json=datapoints)
+    # The access range may be out of date, so open ended requests always go
+    # to the API
+    for _ in range(2):
+        assert c.get_data().points == [[1514761200000, 1.0]]
+        assert c.get_data(data_from='2018-01-01').points == [[1514761200000, 1.0]]
+    assert len([r for r in m.request_history if r.path == '/api/series/5']) == 4
+    assert s.data_cache.hits == s.data_cache.misses == 0
+
+
+def test_tagged_data_cached(tagged_curve, tmp_path):
+    c,s,m = tagged_curve
+    s.data_cache = wapi.cache.DiskCache(str(tmp_path))
+
+    def series(request, context):
+        return [{'id': 9, 'tag': t, 'frequency': 'H', 'points': [[1514761200000, 1.0]]}
+                for t in request.qs['tag']]
+    m.register_uri('GET', prefix + '/series/tagged/9', json=series)
+    d = c.get_data(tag=['a', 'b'], data_from='2018-01-01', data_to='2018-01-02')
+    assert [ts.tag for ts in d] == ['a', 'b']
+    d = c.get_data(tag='b', data_from='2018-01-01', data_to='2018-01-02')
+    assert d.tag == 'b'
+    # One request per tag, and none for the cached tag
+    assert len([r for r in m.request_history if r.path == '/api/series/tagged/9']) == 2
+
+
+def test_tagged_data_cached_empty(tagged_curve):
+    c,s,m = tagged_curve
+    s.data_cache = wapi.cache.MemoryCache()
+
+    def series(request, context):
+        if request.qs['from'][0].startswith('2018-01-01'):
+            return []
+        return [{'id': 9, 'tag': 'a', 'frequency': 'D', 'points': [[1514847600000, 1.0]]}]
+    m.register_uri('GET', prefix + '/series/tagged/9', json=series)
+    # An empty result is the same as without the cache, and is cached too
+    for _ in range(2):
+        assert c.get_data(tag='a', data_from='2018-01-01', data_to='2018-01-02') == []
+        assert c.get_data(tag=['a', 'b'], data_from='2018-01-01', data_to='2018-01-02') == []
+    # One request for each of the tags
+    assert len([r for r in m.request_history if r.path == '/api/series/tagged/9']) == 2
+    # Also when only some of the fragments are empty
+    d = c.get_data(tag='a', data_from='2018-01-01', data_to='2018-01-03', max_points_per_request=24)
+    assert d.tag == 'a' and d.points == [[1514847600000, 1.0]]
+
+
+def test_inst_instance_cached(inst_curve):
+    c,s,m = inst_curve
+    s.data_cache = wapi.cache.MemoryCache()
+    inst = {'frequency': 'H', 'points': [[1451606400000, 10.0]],
+            'name': 'inst_name', 'id': 7,
+            'issue_date': '2016-01-01T00:00Z'}
+    m.register_uri('GET', prefix + '/instances/7/get', text=json.dumps(inst))
+    for issue_date in ['2016-01-01T00:00Z', '2016-01-01T01:00+01:00']:
+        res = c.get_instance(issue_date=issue_date, data_from='2016-01-01', data_to='2016-01-02')
+        assert res.name == 'inst_name'
+        assert res.points == [[1451606400000, 10.0]]
+    # Other ranges and instances without data are fetched again
+    c.get_instance(issue_date='2016-01-01T00:00Z')
+    c.get_instance(issue_date='2016-01-01T00:00Z', with_data=False)
+    assert len([r for r in m.request_history if r.path == '/api/instances/7/get']) == 3
+
+
+def test_tagged_inst_instance_cached(tagged_inst_curve, tmp_path):
+    c,s,m = tagged_inst_curve
+    s.data_cache = wapi.cache.DiskCache(str(tmp_path))
+
+    def instance(request, context):
+        return [{'id': 10, 'tag': t, 'frequency': 'H', 'issue_date': '2016-01-01T00:00Z',
+                 'points': [[1451606400000, 1.0]]} for t in request.qs['tag']]
+    m.register_uri('GET', prefix + '/instances/tagged/10/get', json=instance)
+    res = c.get_instance(issue_date='2016-01-01T00:00Z', tag=['a', 'b'])
+    assert [ts.tag for ts in res] == ['a', 'b']
+    res = c.get_instance(issue_date='2016-01-01T00:00Z', tag='b')
+    assert res.tag == 'b' and res.points == [[1451606400000, 1.0]]
+    assert len([r for r in m.request_history if r.path == '/api/instances/tagged/10/get']) == 2
+
+
+def test_cache_watch(ts_curve):
+    c,s,m = ts_curve
+    s.data_cache = wapi.cache.MemoryCache()
+    hour = 3600 * 1000
+
+    def series(request, context):
+        first = int(wapi.util.parsetime(request.qs['from'][0]).timestamp() * 1000)
+        last = int(wapi.util.parsetime(request.qs['to'][0]).timestamp() * 1000)
+        return {'id': 5, 'name': 'testcurve5', 'frequency': 'H', 'time_zone': 'CET',
+                'points': [[t, float(t)] for t in range(first, last, hour)]}
+    m.register_uri('GET', prefix + '/series/5', json=series)
+    c.get_data(data_from='2018-01-01', data_to='2018-01-03')
+    d = {'id': 5, 'created': '2018-01-05T00:00:00+01:00', 'operation': 'modify',
+         'range': {'begin': '2018-01-02T00:00:00+01:00', 'end': '2018-01-02T06:00:00+01:00'}}
+    m.register_uri('GET', prefix + '/events?id=5',
+                   text='id: 0\nevent: curve_event\ndata: {}\n\n'.format(json.dumps(d)))
+    with s.data_cache.watch(s, [c]) as watcher:
+        for n in range(100):
+            if s.data_cache._generations[5]:
+                break
+            time.sleep(0.01)
+        assert watcher.error is None
+    c.get_data(data_from='2018-01-01', data_to='2018-01-03')
+    # Only the changed hours are fetched again
+    ranges = [(r.qs['from'][0][:13], r.qs['to'][0][:13]) for r in m.request_history
+              if r.path == '/api/series/5']
+    assert ranges == [('2018-01-01t00', '2018-01-03t00'), ('2018-01-02t00', '2018-01-02t06')]
+
+
+def test_metadata_cached(session):
+    s, m = session
+    s.metadata_cache = wapi.cache.MetadataCache()
+    metadata = [{'id': 5, 'name': 'testcurve5', 'frequency': 'H', 'time_zone': 'CET',
+                 'curve_type': 'TIME_SERIES'},
+                {'id': 7, 'name': 'testcurve7', 'frequency': 'D', 'time_zone': 'CET',
+                 'curve_type': 'INSTANCES'}]
+    m.register_uri('GET', prefix + '/curves?name=testcurve5&name=testcurve7', text=json.dumps(metadata))
+    m.register_uri('GET', prefix + '/curves/get?name=testcurve6', text=json.dumps(dict(metadata[0], id=6,
+                                                                                       name='testcurve6')))
+    for n in range(2):
+        res = s.search(name=['testcurve5', 'testcurve7'])
+        assert [c.id for c in res] == [5, 7]
+    # The curves found are known by name
+    c = s.get_curve(name='TestCurve7')
+    assert isinstance(c, wapi.curves.InstanceCurve)
+    assert s.get_curve(name='testcurve6').id == 6
+    assert s.get_curve(name='testcurve6').id == 6
+    paths = [r.path for r in m.request_history if r.path.startswith('/api/curves')]
+    assert paths == ['/api/curves', '/api/curves/get']
+    s.metadata_cache.invalidate(name='testcurve5')
+    s.search(name=['testcurve5', 'testcurve7'])
+    assert len([r for r in m.request_history if r.path == '/api/curves']) == 2
+
+
+def test_get_curves(session, monkeypatch):
+    s, m = session
+    monkeypatch.setattr(wapi.session, 'MAX_URL_LENGTH', 120)
+
+    def search(request, context):
+        return [{'id': int(n[-1]), 'name': n, 'frequency': 'H', 'time_zone': 'CET',
+                 'curve_type': 'TIME_SERIES'} for n in request.qs['name'] if n != 'missing']
+    m.register_uri('GET', prefix + '/curves', json=search)
+    names = ['testcurve{}'.format(n) for n in range(1, 8)]
+    curve_list, missing = s.get_curves(['missing'] + names[::-1] + ['TestCurve1'])
+    assert [c.id for c in curve_list] == [7, 6, 5, 4, 3, 2, 1, 1]
+    assert missing == ['missing']
+    searches = [r for r in m.request_history if r.path == '/api/curves']
+    assert len(searches) > 1
+    assert all(len(r.url) <= 120 for r in searches)
+    assert sorted(n for r in searches for n in r.qs['name']) == sorted(names + ['missing'])
+
+
+def test_transport_config():
+    config = io.StringIO('[common]\nauth_type = None\ntimeout = 20\nconnect_timeout = 3.5\n'
+                         'pool_connections = 4\npool_maxsize = 64\nkeep_alive = false\n')
+    s = wapi.Session()
+    s.read_config_file(config)
+    adapter = s._session.get_adapter('https://api.volueinsight.com/api/curves')
+    assert (adapter._pool_connections, adapter._pool_maxsize) == (4, 64)
+    assert s._session.headers['Connection'] == 'close'
+    assert s._request_timeout() == (3.5, 20.0)
+    s = wapi.Session(timeout=10, pool_maxsize=16)
+    assert s._session.get_adapter('http://test.host')._pool_maxsize == 16
+    assert 'Connection' not in s._session.headers
+    assert s._request_timeout() == 10
+
+
+def test_metrics(ts_curve, monkeypatch):
+    c,s,m = ts_curve
+    monkeypatch.setattr(s.retry_policy, 'backoff', 0)
+    s.metrics = wapi.metrics.Metrics()
+    datapoints = {'id': 5, 'name': 'testcurve5', 'frequency': 'H', 'time_zone': 'CET',
+                  'points': [[1514761200000, 1.0], [1514764800000, 2.0]]}
+    m.register_uri('GET', prefix + '/series/5', [{'status_code': 503, 'text': 'busy'},
+                                                 {'text': json.dumps(datapoints)}])
+    c.get_data(data_from='2018-01-01', data_to='2018-01-02')
+    met = s.metrics
+    assert met.get('wapi_requests_total', endpoint='/api/series/{id}', status='503') == 1
+    assert met.get('wapi_requests_total', endpoint='/api/series/{id}', status='200') == 1
+    assert met.get('wapi_retries_total', endpoint='/api/series/{id}') == 1
+    assert met.get('wapi_points_total', endpoint='/api/series/{id}') == 2
+    assert met.get('wapi_response_bytes_total', endpoint='/api/series/{id}') == len(json.dumps(datapoints)) + 4
+    for stage in ['auth', 'decode', 'convert']:
+        assert met.get('wapi_stage_seconds', stage=stage, endpoint='/api/series/{id}') == 1
@@ -0,0 +1,566 @@
+#
+# Asyncio support, based on aiohttp
+#
+
+import asyncio
+import base64
+import collections
+import functools
+import itertools
+import json
+import time
+
+try:
+    from urllib.parse import urljoin
+except ImportError:
+    from urlparse import urljoin
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+from past.types import basestring
+
+from . import auth, curves, metrics, session, util
+
+
+MAX_CONNECTIONS = 100  # Default limit on simultaneous connections
+
+
+class AsyncResponse(object):
+    """
+    A fully read response, with the parts of the :class:`requests.Response`
+    interface used by the library.
+    """
+    def __init__(self, status_code, content, headers):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode()
+
+    def json(self):
+        return json.loads(self.content.decode())
+
+    def iter_content(self, chunk_size=1):
+        for pos in range(0, len(self.content), chunk_size):
+            yield self.content[pos:pos + chunk_size]
+
+
+class AsyncOAuth(auth.OAuth):
+    """
+    OAuth authentication for :class:`AsyncSession`.  Login is deferred until
+    the first request, as it needs a running event loop.
+    """
+
+    def __init__(self, session, client_id, client_secret, auth_urlbase, token_cache=None):
+        super(AsyncOAuth, self).__init__(session, client_id, client_secret, auth_urlbase, lazy=True,
+                                         token_cache=token_cache)
+        self._lock = None
+        self._refresh_task = None
+
+    async def validate_auth(self):
+        """Check valid_until and fetch new token if needed"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        if not self._needs_refresh():
+            if self._refresh_due() and not self._refreshing:
+                self._refreshing = True
+                # Keep a reference, or the task may be garbage collected
+                self._refresh_task = asyncio.ensure_future(self._refresh())
+            return
+        # Only one task refreshes the token, the others wait for it
+        async with self._lock:
+            if self._needs_refresh():
+                await self._authenticate()
+
+    async def _refresh(self):
+        async with self._lock:
+            old_token = (self.token, self.token_type, self.valid_until)
+            try:
+                if self._refresh_due():
+                    await self._authenticate()
+            except Exception:
+                # Keep using the old token, and refresh it when it expires
+                self.token, self.token_type, self.valid_until = old_token
+                self.refresh_at = None
+            finally:
+                self._refreshing = False
+
+    async def _authenticate(self):
+        # The cache is not locked here, as that would block the event loop
+        if self._load_cached_token():
+            return
+        await self._login()
+        self._store_cached_token()
+
+    async def _login(self):
+        now = time.time()
+        try:
+            response = await self.session.send_data_request('POST', self.auth_urlbase, self._token_url(),
+                                                            rawdata=self._token_data(),
+                                                            authval=self._token_auth())
+            self._update_token(response, now)
+        except Exception:
+            self._clear_token()
+            raise
+
+
+class _AsyncCurve(object):
+    __slots__ = ()
+
+    async def _load_data(self, url, failmsg, urlbase=None):
+        if urlbase is None:
+            urlbase = self._session.urlbase
+        response = await self._session.data_request('GET', urlbase, url)
+        if self._session.metrics is None:
+            return self._handle_data_response(response, failmsg)
+        start = time.time()
+        result = self._handle_data_response(response, failmsg)
+        self._observe_decode(url, result, time.time() - start)
+        return result
+
+    async def _run_query(self, query):
+        url, failmsg, convert = query
+        result = await self._load_data(url, failmsg)
+        if result is None or convert is None:
+            return result
+        if self._session.metrics is None:
+            return convert(result)
+        start = time.time()
+        converted = convert(result)
+        self._session.metrics.observe_stage('convert', metrics.endpoint(url), time.time() - start)
+        return converted
+
+    async def _run_queries(self, queries):
+        return await asyncio.gather(*[self._run_query(q) for q in queries])
+
+    async def _run_plan(self, get_plan, *args, **kwargs):
+        # A data cache may read and write files while planning and
+        # combining, which is done in the default executor, off the loop.
+        if self._session.data_cache is None:
+            queries, combine = get_plan(*args, **kwargs)
+            return combine(await self._run_queries(queries))
+        loop = asyncio.get_event_loop()
+        queries, combine = await loop.run_in_executor(None, functools.partial(get_plan, *args, **kwargs))
+        results = await self._run_queries(queries)
+        return await loop.run_in_executor(None, combine, results)
+
+    async def _iter_queries(self, queries, lookahead=None):
+        if lookahead is None:
+            lookahead = self._session.max_workers
+        queries = iter(queries)
+        pending = collections.deque(asyncio.ensure_future(self._run_query(q))
+                                    for q in itertools.islice(queries, lookahead))
+        try:
+            while pending:
+                result = await pending.popleft()
+                for q in itertools.islice(queries, 1):
+                    pending.append(asyncio.ensure_future(self._run_query(q)))
+                yield result
+        finally:
+            for job in pending:
+                job.cancel()
+
+    async def access(self):
+        return await self._run_query(self._access_query())
+
+
+class TimeSeriesCurve(_AsyncCurve, curves.TimeSeriesCurve):
+    __slots__ = ()
+
+    async def get_data(self, *args, **kwargs):
+        """Async version of :meth:`wapi.curves.TimeSeriesCurve.get_data`"""
+        return await self._run_plan(self._get_data_plan, *args, **kwargs)
+
+    async def iter_data(self, data_from=None, data_to=None, time_zone=None, filter=None, function=None,
+                        frequency=None, output_time_zone=None, chunk=util.MAX_POINTS_PER_REQUEST, prefetch=1):
+        """Async version of :meth:`wapi.curves.TimeSeriesCurve.iter_data`"""
+        options = dict(time_zone=time_zone, filter=filter, function=function, frequency=frequency,
+                       output_time_zone=output_time_zone)
+        async for ts in self._iter_queries(self._iter_data_queries(data_from, data_to, options, chunk), prefetch):
+            if ts is not None:
+                yield ts
+
+
+class TaggedCurve(_AsyncCurve, curves.TaggedCurve):
+    __slots__ = ()
+
+    async def get_tags(self):
+        """Async version of :meth:`wapi.curves.TaggedCurve.get_tags`"""
+        return await self._run_query(self._get_tags_query())
+
+    async def get_data(self, *args, **kwargs):
+        """Async version of :meth:`wapi.curves.TaggedCurve.get_data`"""
+        return await self._run_plan(self._get_data_plan, *args, **kwargs)
+
+    async def iter_data(self, tag=None, data_from=None, data_to=None, time_zone=None, filter=None, function=None,
+                        frequency=None, output_time_zone=None, chunk=util.MAX_POINTS_PER_REQUEST, prefetch=1):
+        """Async version of :meth:`wapi.curves.TaggedCurve.iter_data`"""
+        options = dict(time_zone=time_zone, filter=filter, function=function, frequency=frequency,
+                       output_time_zone=output_time_zone)
+        queries = self._iter_data_queries(tag, data_from, data_to, options, chunk)
+        async for res in self._iter_queries(queries, prefetch):
+            if res is not None:
+                yield res
+
+
+class InstanceCurve(_AsyncCurve, curves.InstanceCurve):
+    __slots__ = ()
+
+    async def search_instances(self, *args, **kwargs):
+        """Async version of :meth:`wapi.curves.InstanceCurve.search_instances`"""
+        return await self._run_query(self._search_instances_query(*args, **kwargs))
+
+    async def get_instance(self, *args, **kwargs):
+        """Async version of :meth:`wapi.curves.InstanceCurve.get_instance`"""
+        return await self._run_plan(self._get_instance_plan, *args, **kwargs)
+
+    async def get_latest(self, *args, **kwargs):
+        """Async version of :meth:`wapi.curves.InstanceCurve.get_latest`"""
+        return await self._run_query(self._get_latest_query(*args, **kwargs))
+
+    async def get_relative(self, *args, **kwargs):
+        """Async version of :meth:`wapi.curves.InstanceCurve.get_relative`"""
+        return await self._run_query(self._get_relative_query(*args, **kwargs))
+
+    async def get_absolute(self, *args, **kwargs):
+        """Async version of :meth:`wapi.curves.InstanceCurve.get_absolute`"""
+        return await self._run_query(self._get_absolute_query(*args, **kwargs))
+
+    async def iter_history(self, issue_date_from=None, issue_date_to=None,
+                           max_points_per_request=util.MAX_POINTS_PER_REQUEST, **data_args):
+        """Async version of :meth:`wapi.curves.InstanceCurve.iter_history`"""
+        latest, instances = await self._run_queries([
+            self._get_latest_query(issue_date_from=issue_date_from, issue_date_to=issue_date_to, **data_args),
+            self._search_instances_query(issue_date_from=issue_date_from, issue_date_to=issue_date_to)])
+        if latest is None:
+            return
+        pages = curves._history_pages(instances, curves._ts_size(latest), max_points_per_request,
+                                      issue_date_to)
+        queries = [self._search_instances_query(issue_date_from=first, issue_date_to=last, with_data=True,
+                                                **data_args) for issue_dates, first, last in pages]
+        n = 0
+        async for result in self._iter_queries(queries):
+            for ts in curves._page_in_order(result, pages[n][0]):
+                yield ts
+            n += 1
+
+
+class TaggedInstanceCurve(_AsyncCurve, curves.TaggedInstanceCurve):
+    __slots__ = ()
+
+    async def get_tags(self):
+        """Async version of :meth:`wapi.curves.TaggedInstanceCurve.get_tags`"""
+        return await self._run_query(self._get_tags_query())
+
+    async def search_instances(self, *args, **kwargs):
+        """Async version of :meth:`wapi.curves.TaggedInstanceCurve.search_instances`"""
+        return await self._run_query(self._search_instances_query(*args, **kwargs))
+
+    async def get_instance(self, *args, **kwargs):
+        """Async version of :meth:`wapi.curves.TaggedInstanceCurve.get_instance`"""
+        return await self._run_plan(self._get_instance_plan, *args, **kwargs)
+
+    async def get_latest(self, *args, **kwargs):
+        """Async version of :meth:`wapi.curves.TaggedInstanceCurve.get_latest`"""
+        return await self._run_query(self._get_latest_query(*args, **kwargs))
+
+    async def get_relative(self, *args, **kwargs):
+        """Async version of :meth:`wapi.curves.TaggedInstanceCurve.get_relative`"""
+        return await self._run_query(self._get_relative_query(*args, **kwargs))
+
+    async def get_absolute(self, *args, **kwargs):
+        """Async version of :meth:`wapi.curves.TaggedInstanceCurve.get_absolute`"""
+        return await self._run_query(self._get_absolute_query(*args, **kwargs))
+
+    async def iter_history(self, tags=None, issue_date_from=None, issue_date_to=None,
+                           max_points_per_request=util.MAX_POINTS_PER_REQUEST, **data_args):
+        """Async version of :meth:`wapi.curves.TaggedInstanceCurve.iter_history`"""
+        if tags is None:
+            tags = await self.get_tags()
+        elif isinstance(tags, basestring):
+            tags = [tags]
+        if not tags:
+            return
+        latest, instances = await self._run_queries([
+            self._get_latest_query(tags=tags[0], issue_date_from=issue_date_from, issue_date_to=issue_date_to,
+                                   **data_args),
+            self._search_instances_query(tags=tags[0], issue_date_from=issue_date_from,
+                                         issue_date_to=issue_date_to)])
+        if latest is None:
+            return
+        pages = curves._history_pages(instances, curves._ts_size(latest) * len(tags), max_points_per_request,
+                                      issue_date_to)
+        queries = [self._search_instances_query(tags=tags, issue_date_from=first, issue_date_to=last,
+                                                with_data=True, **data_args)
+                   for issue_dates, first, last in pages]
+        n = 0
+        async for result in self._iter_queries(queries):
+            for ts in curves._page_in_order(result, pages[n][0], tags):
+                yield ts
+            n += 1
+
+
+class AsyncSession(session.Session):
+    """ Establish an asyncio connection to Volue Insight API
+
+    Works like :class:`wapi.session.Session`, but all calls talking to the
+    API are coroutines, and the curve objects returned have coroutine
+    versions of the data access methods.  This makes it possible to keep
+    many requests in flight from a single event loop::
+
+        async with AsyncSession(config_file='config.ini') as s:
+            curves = await asyncio.gather(*[s.get_curve(name=n) for n in names])
+            data = await asyncio.gather(*[c.get_data(data_from=start) for c in curves])
+
+    Requires the ``aiohttp`` package.
+
+    Parameters
+    ----------
+
+    urlbase: url
+        Location of Volue Insight service
+    config_file: path
+        path to the config.ini file which contains your authentication
+        information.
+    client_id: str
+        Your client ID
+    client_secret:
+        Your client secret.
+    auth_urlbase: url
+        Location of Volue Insight authentication service
+    timeout: float
+        Timeout for REST calls, in seconds
+    stream_data: bool
+        Not supported, a :class:`wapi.session.ConfigException` is raised if
+        it is True.
+    json_codec: str or object
+        JSON codec used for request and response bodies
+    data_cache: str or object
+        Cache for curve data, read and written in the default executor of
+        the event loop
+    metadata_cache: bool, str or object
+        Cache for curve metadata
+    token_cache: str or object
+        File sharing the OAuth token between processes
+    retry_policy: object
+        Policy for retrying failed requests
+    connect_timeout: float
+        Timeout for connecting to the API, in seconds
+    keep_alive: bool
+        Keep connections open between requests
+    metrics: bool or object
+        Metrics recorded for the calls made
+    max_connections: int
+        Maximum number of simultaneous connections
+
+    Returns
+    -------
+    session: :class:`wapi.aio.AsyncSession` object
+
+    """
+
+    def __init__(self, urlbase=None, config_file=None, client_id=None, client_secret=None,
+                 auth_urlbase=None, timeout=None, retry_update_auth=False, stream_data=False,
+                 json_codec=None, data_cache=None, metadata_cache=None, token_cache=None,
+                 retry_policy=None, connect_timeout=None, keep_alive=None, metrics=None,
+                 max_connections=MAX_CONNECTIONS):
+        if aiohttp is None:
+            raise ImportError('AsyncSession requires the aiohttp package')
+        if stream_data:
+            raise session.ConfigException('stream_data is not supported by AsyncSession')
+        self.max_connections = max_connections
+        self._client = None
+        super(AsyncSession, self).__init__(urlbase=urlbase, config_file=config_file, client_id=client_id,
+                                           client_secret=client_secret, auth_urlbase=auth_urlbase,
+                                           timeout=timeout, retry_update_auth=retry_update_auth,
+                                           stream_data=stream_data, json_codec=json_codec,
+                                           data_cache=data_cache, metadata_cache=metadata_cache,
+                                           token_cache=token_cache, retry_policy=retry_policy,
+                                           connect_timeout=connect_timeout, keep_alive=keep_alive,
+                                           metrics=metrics)
+
+    _curve_types = {
+        util.TIME_SERIES:      TimeSeriesCurve,
+        util.TAGGED:           TaggedCurve,
+        util.INSTANCES:        InstanceCurve,
+        util.TAGGED_INSTANCES: TaggedInstanceCurve,
+    }
+
+    def _make_auth(self, client_id, client_secret, auth_urlbase):
+        return AsyncOAuth(self, client_id, client_secret, auth_urlbase, token_cache=self.token_cache)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def close(self):
+        """Close all connections held by the session"""
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+    def _get_client(self):
+        # The aiohttp session must be created from within the event loop
+        if self._client is None:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, force_close=not self.keep_alive)
+            timeout = aiohttp.ClientTimeout(total=self.timeout, connect=self.connect_timeout)
+            self._client = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._client
+
+    async def get_curve(self, id=None, name=None):
+        """Async version of :meth:`wapi.session.Session.get_curve`"""
+        url = self._get_curve_url(id, name)
+        metadata = self._cached_metadata(self._curve_cache_key(id, name))
+        if metadata is not None:
+            return self._build_curve(metadata, store=False)
+        response = await self.data_request('GET', self.urlbase, url)
+        return self.handle_single_curve_response(response)
+
+    async def search(self, *args, **kwargs):
+        """Async version of :meth:`wapi.session.Session.search`"""
+        url = self._search_url(*args, **kwargs)
+        metadata_list = self._cached_metadata(self._search_cache_key(url))
+        if metadata_list is not None:
+            return [self._build_curve(metadata, store=False) for metadata in metadata_list]
+        response = await self.data_request('GET', self.urlbase, url)
+        return self.handle_multi_curve_response(response, url)
+
+    async def get_curves(self, names, max_workers=None):
+        """Async version of :meth:`wapi.session.Session.get_curves`,
+        with at most ``max_workers`` searches in flight."""
+        found, batches = self._curves_to_search(names)
+        semaphore = asyncio.Semaphore(max_workers or self.max_workers)
+
+        async def search(batch):
+            async with semaphore:
+                return await self.search(name=batch)
+
+        for result in await asyncio.gather(*[search(batch) for batch in batches]):
+            found.extend(result)
+        return self._order_curves(names, found)
+
+    async def get_data_many(self, curves_or_names, data_from=None, data_to=None,
+                            max_workers=None, **kwargs):
+        """Async version of :meth:`wapi.session.Session.get_data_many`,
+        with at most ``max_workers`` requests in flight."""
+        names = [c for c in curves_or_names if isinstance(c, basestring)]
+        found = (await self.get_curves(names, max_workers))[0] if names else []
+        curve_list, errors = self._match_curves(curves_or_names, found)
+        semaphore = asyncio.Semaphore(max_workers or self.max_workers)
+
+        async def fetch(curve):
+            self._check_get_data(curve)
+            async with semaphore:
+                return await curve.get_data(data_from=data_from, data_to=data_to, **kwargs)
+
+        res = await asyncio.gather(*[fetch(curve) for name, curve in curve_list], return_exceptions=True)
+        results = {}
+        for (name, curve), r in zip(curve_list, res):
+            if isinstance(r, Exception):
+                errors[name] = r
+            else:
+                results[name] = r
+        return results, errors
+
+    async def get_attribute(self, attribute):
+        """Async version of :meth:`wapi.session.Session.get_attribute`"""
+        response = await self.data_request('GET', self.urlbase, self._attribute_url(attribute))
+        return self._handle_attribute_response(attribute, response)
+
+    def events(self, curve_list, start_time=None, timeout=None):
+        """
+        Not supported, raises :class:`wapi.session.SessionException`.  Use
+        :meth:`wapi.session.Session.events` for event listeners.
+        """
+        raise session.SessionException('Events are not supported by AsyncSession, use wapi.Session')
+
+    async def _get_auth_header_with_retry(self, databytes, retries=None):
+        attempt = 0
+        while True:
+            try:
+                await self.auth.validate_auth()
+                return self.auth.get_headers(databytes)
+            except Exception as e:
+                delay = self.retry_policy.retry_delay(attempt, error=e, retries=retries)
+                if delay is None:
+                    raise
+            attempt += 1
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def _validate_auth(self, data, databytes):
+        headers = {}
+
+        if data is not None:
+            headers['content-type'] = 'application/json'
+        if self.auth is not None:
+            if self.retry_update_auth:
+                headers.update(await self._get_auth_header_with_retry(databytes))
+            else:
+                await self.auth.validate_auth()
+                headers.update(self.auth.get_headers(databytes))
+        return headers
+
+    async def send_data_request(self, req_type, urlbase, url, data=None, rawdata=None, headers=None,
+                                authval=None, stream=False, retries=None):
+        """
+        Send a request to the API, retrying it according to the retry
+        policy.  The response is read in full, so ``stream`` must be False.
+        """
+        if stream:
+            raise ValueError('Streaming is not supported by AsyncSession')
+        if not urlbase:
+            urlbase = self.urlbase
+        longurl = urljoin(urlbase, url)
+
+        databytes = self._encode_data(data, rawdata)
+        if authval is not None:
+            headers = dict(headers or {})
+            credentials = '{}:{}'.format(*authval).encode()
+            headers['Authorization'] = 'Basic {}'.format(base64.b64encode(credentials).decode())
+        client = self._get_client()
+        self.retry_policy.start()
+        attempt = 0
+        while True:
+            timeout = None
+            res = None
+            start = time.time()
+            try:
+                async with client.request(req_type, longurl, data=databytes, headers=headers) as response:
+                    res = AsyncResponse(response.status, await response.read(), response.headers)
+            except asyncio.TimeoutError as e:
+                timeout = e
+            if self.metrics is not None:
+                self._observe_request(req_type, longurl, res, False, time.time() - start)
+            delay = self.retry_policy.retry_delay(attempt, res, timeout, retries)
+            if delay is None:
+                break
+            if self.metrics is not None:
+                self.metrics.observe_retry(metrics.endpoint(longurl))
+            attempt += 1
+            if delay > 0:
+                await asyncio.sleep(delay)
+        if timeout is not None:
+            raise timeout
+        return res
+
+    async def data_request(self, req_type, urlbase, url, data=None, rawdata=None, authval=None,
+                           stream=False, retries=None):
+        """Run a call to the backend, dealing with authentication etc."""
+        databytes = self._encode_data(data, rawdata)
+        start = time.time()
+        headers = await self._validate_auth(data, databytes)
+        if self.metrics is not None:
+            self.metrics.observe_stage('auth', metrics.endpoint(url), time.time() - start)
+        return await self.send_data_request(req_type, urlbase, url, None, databytes, headers, authval,
+                                            stream, retries)
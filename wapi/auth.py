@@ -2,7 +2,10 @@
 # Authentication support
 #
 
+import contextlib
 import json
+import os
+import tempfile
 import time
 import threading
 
@@ -11,44 +14,215 @@ try:
 except ImportError:
     from urlparse import urljoin
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 
 class AuthFailedException(Exception):
     pass
 
 
+REFRESH_AHEAD = 60  # Seconds before expiry to start refreshing the token in the background
+
+_TOKEN_FIELDS = ('token', 'token_type', 'valid_until', 'refresh_at')
+
+
+class TokenCache(object):
+    """
+    A file sharing OAuth tokens between processes, so that each of them
+    does not have to log in on its own.
+
+    Tokens are kept per client ID and authentication service.  The file is
+    locked while a token is fetched, so that when several processes start
+    at once, only the first one logs in, and the others use its token.
+    The file is only readable by its owner.  Locking is not supported on
+    Windows, where the processes may log in at the same time.
+
+    Parameters
+    ----------
+
+    path: str
+        The file holding the tokens, created if needed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    @staticmethod
+    def key(client_id, auth_urlbase):
+        """The key of the token for a client ID and authentication service"""
+        return '{} {}'.format(auth_urlbase, client_id)
+
+    @contextlib.contextmanager
+    def lock(self):
+        """Hold the lock of the cache, shared by all processes"""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def load(self, key):
+        """The token for a key, as a dict, or None if there is none"""
+        return self._read().get(key)
+
+    def store(self, key, token):
+        """Store the token for a key, dropping the expired ones"""
+        now = time.time()
+        tokens = {k: t for k, t in self._read().items() if t.get('valid_until', 0) > now}
+        tokens[key] = token
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(tokens, f)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                tokens = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        return tokens if isinstance(tokens, dict) else {}
+
+
 class OAuth:
     """
     Authentication based on OAuth client ID.
     This is the main authentication mechanism for customer access to the data center.
+
+    The token is refreshed by one thread at a time, while the others wait
+    for it.  Some time before the token expires, it is refreshed in the
+    background, so requests keep using the old token in the meantime.  If a
+    :class:`TokenCache` is given, a token found there is used instead of
+    logging in, and new tokens are stored there.
     """
 
-    def __init__(self, session, client_id, client_secret, auth_urlbase):
+    def __init__(self, session, client_id, client_secret, auth_urlbase, lazy=False, token_cache=None):
         self.client_id = client_id
         self.client_secret = client_secret
         self.auth_urlbase = auth_urlbase
         self.token = None
         self.token_type = None
         self.valid_until = None
+        self.refresh_at = None
         self.session = session
-        self._authenticate()
+        self.token_cache = token_cache
+        self._lock = threading.Lock()
+        # Guards _refreshing only, never held while logging in
+        self._refresh_lock = threading.Lock()
+        self._refreshing = False
+        # A lazy login is deferred until the first call to validate_auth
+        if not lazy:
+            self._authenticate()
 
     def validate_auth(self):
         """Check valid_until and fetch new token if needed"""
-        # To avoid sending duplicated authentication requests in other threads
-        with threading.Lock():
-            if (not self.valid_until) or time.time() > self.valid_until:
+        if not self._needs_refresh():
+            if self._refresh_due():
+                self._start_refresh()
+            return
+        # Only one thread refreshes the token, the others wait for it
+        with self._lock:
+            if self._needs_refresh():
                 self._authenticate()
 
+    def _needs_refresh(self):
+        return (not self.valid_until) or time.time() > self.valid_until
+
+    def _refresh_due(self):
+        return self.refresh_at is not None and time.time() > self.refresh_at
+
+    def _start_refresh(self):
+        with self._refresh_lock:
+            if self._refreshing or not self._refresh_due():
+                return
+            self._refreshing = True
+        worker = threading.Thread(target=self._refresh)
+        worker.daemon = True
+        worker.start()
+
+    def _refresh(self):
+        with self._lock:
+            old_token = (self.token, self.token_type, self.valid_until)
+            try:
+                if self._refresh_due():
+                    self._authenticate()
+            except Exception:
+                # Keep using the old token, and refresh it when it expires
+                self.token, self.token_type, self.valid_until = old_token
+                self.refresh_at = None
+            finally:
+                with self._refresh_lock:
+                    self._refreshing = False
+
     def _authenticate(self):
-        # Wipe out any old values before (re-)login
+        if self.token_cache is None:
+            self._login()
+            return
+        with self.token_cache.lock():
+            if not self._load_cached_token():
+                self._login()
+                self._store_cached_token()
+
+    def _load_cached_token(self):
+        # Use a token from the cache, unless it is due for a refresh
+        if self.token_cache is None:
+            return False
+        token = self.token_cache.load(self.token_cache.key(self.client_id, self.auth_urlbase))
+        if not token or token.get('refresh_at') is None or token['refresh_at'] <= time.time():
+            return False
+        self.token, self.token_type, self.valid_until, self.refresh_at = [token[k] for k in _TOKEN_FIELDS]
+        return True
+
+    def _store_cached_token(self):
+        if self.token_cache is None:
+            return
+        token = {k: getattr(self, k) for k in _TOKEN_FIELDS}
+        try:
+            self.token_cache.store(self.token_cache.key(self.client_id, self.auth_urlbase), token)
+        except (IOError, OSError):
+            # The token is still good for this process
+            pass
+
+    def _login(self):
+        now = time.time()
+        try:
+            response = self.session.send_data_request('POST', self.auth_urlbase, self._token_url(),
+                                                      rawdata=self._token_data(), authval=self._token_auth())
+            self._update_token(response, now)
+        except Exception:
+            # Wipe out the old values when the login fails
+            self._clear_token()
+            raise
+
+    def _clear_token(self):
         self.token = None
         self.token_type = None
         self.valid_until = None
-        now = time.time()
-        url = urljoin(self.auth_urlbase, '/oauth2/token')
-        auth = (self.client_id, self.client_secret)
-        data = {'grant_type': 'client_credentials'}
-        response = self.session.send_data_request('POST', self.auth_urlbase, url, rawdata=data, authval=auth)
+        self.refresh_at = None
+
+    def _token_url(self):
+        return urljoin(self.auth_urlbase, '/oauth2/token')
+
+    def _token_auth(self):
+        return (self.client_id, self.client_secret)
+
+    def _token_data(self):
+        return {'grant_type': 'client_credentials'}
+
+    def _update_token(self, response, now):
         if response.status_code != 200:
             raise AuthFailedException('Authentication failed: {}'.format(response.content))
         # Parse token
@@ -56,6 +230,7 @@ class OAuth:
         self.token = rsp['access_token']
         self.token_type = rsp['token_type']
         self.valid_until = now + int(rsp['expires_in'] * 0.95)
+        self.refresh_at = self.valid_until - min(REFRESH_AHEAD, (self.valid_until - now) / 2)
 
     def get_headers(self, data):
         """The web-token auth header is simple"""
@@ -0,0 +1,605 @@
+#
+# Local caching of curve data
+#
+
+import atexit
+import collections
+import datetime
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from . import events, util
+
+
+DEFAULT_MAX_SIZE = 1024 ** 3           # Default size limit for the disk cache, in bytes
+DEFAULT_MEMORY_SIZE = 256 * 1024 ** 2  # Default size limit for the memory cache, in bytes
+DEFAULT_MAX_ENTRIES = 10000            # Default number of entries in the metadata cache
+DEFAULT_METADATA_AGE = 24 * 3600       # Default time to keep curve metadata, in seconds
+
+# Limits used for open ends of ranges, in milliseconds
+_MIN = -2 ** 62
+_MAX = 2 ** 62
+
+# Options of a data request, which are part of the cache key
+_OPTIONS = ('time_zone', 'filter', 'function', 'frequency', 'output_time_zone')
+# Options which change the points, so that only results for the exact same
+# range can be reused
+_EXACT_OPTIONS = ('filter', 'function', 'frequency')
+# Attributes of the TS kept in the cache
+_META = ('id', 'name', 'frequency', 'time_zone', 'tag', 'issue_date', 'curve_type')
+
+
+def _subtract(begin, end, ranges):
+    # The parts of [begin, end) not covered by any of the ranges
+    missing = []
+    for first, last in sorted(ranges):
+        if last <= begin or first >= end:
+            continue
+        if first > begin:
+            missing.append((begin, first))
+        begin = max(begin, last)
+        if begin >= end:
+            break
+    if begin < end:
+        missing.append((begin, end))
+    return missing
+
+
+class _Entry(object):
+    # The cached data for one key: the ranges covered, as [begin, end,
+    # time fetched] in milliseconds and seconds, and the points within them.
+    def __init__(self, meta=None, ranges=None, timestamps=None, values=None):
+        self.meta = meta
+        self.ranges = ranges or []
+        self.timestamps = np.zeros(0, dtype=np.int64) if timestamps is None else timestamps
+        self.values = np.zeros(0, dtype=np.float64) if values is None else values
+
+    def copy(self):
+        return _Entry(self.meta, [list(r) for r in self.ranges], self.timestamps, self.values)
+
+    @property
+    def nbytes(self):
+        return self.timestamps.nbytes + self.values.nbytes
+
+    def missing(self, begin, end, max_age=None):
+        if max_age is None:
+            valid = [(b, e) for b, e, _ in self.ranges]
+        else:
+            oldest = time.time() - max_age
+            valid = [(b, e) for b, e, fetched in self.ranges if fetched >= oldest]
+        return _subtract(begin, end, valid)
+
+    def store(self, begin, end, ts, fetched=None, clip=True):
+        self.invalidate(begin, end)
+        self.ranges.append([begin, end, time.time() if fetched is None else fetched])
+        self.ranges.sort()
+        if ts is None:
+            return
+        self.meta = {k: getattr(ts, k, None) for k in _META}
+        if ts.values is None:
+            return
+        timestamps = ts.timestamps
+        if clip:
+            keep = (timestamps >= begin) & (timestamps < end)
+        else:
+            keep = np.ones(len(timestamps), dtype=bool)
+        timestamps = np.concatenate([self.timestamps, timestamps[keep]])
+        order = np.argsort(timestamps, kind='mergesort')
+        self.timestamps = timestamps[order]
+        self.values = np.concatenate([self.values, ts.values[keep]])[order]
+
+    def invalidate(self, begin=None, end=None):
+        if begin is None and end is None:
+            self.__init__(self.meta)
+            return
+        begin = _MIN if begin is None else begin
+        end = _MAX if end is None else end
+        ranges = []
+        for first, last, fetched in self.ranges:
+            ranges.extend([b, e, fetched] for b, e in _subtract(first, last, [(begin, end)]))
+        self.ranges = ranges
+        keep = (self.timestamps < begin) | (self.timestamps >= end)
+        self.timestamps = self.timestamps[keep]
+        self.values = self.values[keep]
+
+    def extract(self, begin=None, end=None):
+        if self.meta is None:
+            return None
+        if begin is None and end is None:
+            first, last = 0, len(self.timestamps)
+        else:
+            first, last = np.searchsorted(self.timestamps, [begin, end])
+        # Copies, so that changing the result leaves the cache alone
+        return util.TS(points=(self.timestamps[first:last].copy(), self.values[first:last].copy()), **self.meta)
+
+
+class RangeCache(object):
+    """
+    Base class for the caches of curve data.
+
+    Data is cached per curve, tag and request options (``time_zone``,
+    ``filter``, ``function``, ``frequency`` and ``output_time_zone``),
+    together with the time ranges it covers.  A request for a range which
+    is partly cached only fetches the missing parts from the API.  When
+    ``filter``, ``function`` or ``frequency`` are given, the points depend
+    on where the range starts and ends, so only results for the exact same
+    range are reused.  The same goes for instances, which are cached per
+    issue date.  Series are only cached when both ``data_from`` and
+    ``data_to`` are given, as the access range of a curve may have grown
+    since its metadata was read.
+
+    Parameters
+    ----------
+
+    max_age: float, optional
+        Data fetched more than this many seconds ago is fetched again.  By
+        default, cached data is used until it is invalidated.
+    """
+
+    def __init__(self, max_age=None):
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        # Number of invalidations per curve, to detect those made while
+        # data was being fetched
+        self._generations = collections.defaultdict(int)
+
+    def _load(self, key):
+        raise NotImplementedError()
+
+    def _save(self, key, entry):
+        raise NotImplementedError()
+
+    def _keys(self, curve_id):
+        raise NotImplementedError()
+
+    def _delete(self, key):
+        raise NotImplementedError()
+
+    @staticmethod
+    def _key(curve_id, tag, issue_date, begin, end, options, exact):
+        key = [curve_id, tag, issue_date] + [options.get(k) for k in _OPTIONS]
+        if exact:
+            key.extend([begin, end])
+        return tuple(key)
+
+    def plan(self, curve_id, tag, begin, end, options, fetch_plan, issue_date=None):
+        """
+        Plan a data request for a single series, as a list of queries and a
+        function combining their results (see :class:`wapi.curves.BaseCurve`).
+
+        begin and end are timezone aware datetimes, and fetch_plan(begin,
+        end) gives the plan fetching a range from the API.  For instances,
+        issue_date is given in milliseconds since the epoch, and begin and
+        end may be None.
+        """
+        exact = issue_date is not None or any(options.get(k) is not None for k in _EXACT_OPTIONS)
+        first = _MIN if begin is None else util.to_millis(begin)
+        last = _MAX if end is None else util.to_millis(end)
+        key = self._key(curve_id, tag, issue_date, first, last, options, exact)
+        with self._lock:
+            generation = self._generations[curve_id]
+            entry = self._load(key) or _Entry()
+            missing = entry.missing(first, last, self.max_age)
+            if missing:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if exact:
+            missing = [(first, last)] if missing else []
+            plans = [fetch_plan(begin, end)] if missing else []
+        else:
+            plans = [fetch_plan(util.from_millis(b, begin.tzinfo), util.from_millis(e, begin.tzinfo))
+                     for b, e in missing]
+        queries = [q for plan_queries, _ in plans for q in plan_queries]
+
+        def combine(results):
+            fetched = time.time()
+            with self._lock:
+                entry = self._load(key) or _Entry()
+                # Data fetched before an invalidation may be stale, and is
+                # returned but not kept
+                keep = generation == self._generations[curve_id]
+                if not keep:
+                    entry = entry.copy()
+                pos = 0
+                for (b, e), (plan_queries, plan_combine) in zip(missing, plans):
+                    entry.store(b, e, plan_combine(results[pos:pos + len(plan_queries)]), fetched,
+                                clip=not exact)
+                    pos += len(plan_queries)
+                if missing and keep:
+                    self._save(key, entry)
+                if exact:
+                    return entry.extract()
+                return entry.extract(first, last)
+        return queries, combine
+
+    def invalidate(self, curve_id, tag=None, begin=None, end=None, issue_date=None):
+        """
+        Drop cached data for a curve.  If given, only data for the tag (or
+        the default tag), for the instance with the given issue date, and
+        only the part of it in the range [begin, end), is dropped.  The
+        times are datetimes, or milliseconds since the epoch.
+        """
+        begin, end, issue_date = [util.to_millis(t) if isinstance(t, datetime.datetime) else t
+                                  for t in (begin, end, issue_date)]
+        with self._lock:
+            self._generations[curve_id] += 1
+            for key in self._keys(curve_id):
+                if tag is not None and key[1] not in (tag, None):
+                    continue
+                if issue_date is not None and key[2] != issue_date:
+                    continue
+                if begin is None and end is None:
+                    self._delete(key)
+                    continue
+                entry = self._load(key)
+                if entry is not None:
+                    entry.invalidate(begin, end)
+                    self._save(key, entry)
+
+    def handle_event(self, event):
+        """Invalidate the data changed by a :class:`wapi.events.CurveEvent`"""
+        if not isinstance(event, events.CurveEvent):
+            return
+        if event.range is None and 'range' in (event.json_data or {}):
+            # Nothing was changed
+            return
+        begin, end = event.range or (None, None)
+        self.invalidate(event.id, event.tag, begin, end, event.issue_date)
+
+    def watch(self, session, curve_list, start_time=None):
+        """
+        Keep the cached data for a list of curves up to date, by listening
+        to their events (see :meth:`wapi.session.Session.events`) and
+        invalidating the data changed.  Returns a :class:`CacheWatcher`,
+        which should be closed when no longer needed.  If the event stream
+        fails, all data for the curves is dropped and the watching stops.
+        """
+        return CacheWatcher(self, session, curve_list, start_time)
+
+
+class CacheWatcher(object):
+    """
+    Invalidates cached data as events for the watched curves arrive, see
+    :meth:`RangeCache.watch`.
+    """
+
+    def __init__(self, cache, session, curve_list, start_time=None):
+        self.cache = cache
+        self.error = None
+        if not hasattr(curve_list, '__iter__') or isinstance(curve_list, str):
+            curve_list = [curve_list]
+        self._ids = [getattr(c, 'id', c) for c in curve_list]
+        self._closed = False
+        self._listener = session.events(curve_list, start_time=start_time, timeout=1)
+        self._worker = threading.Thread(target=self._run)
+        self._worker.daemon = True
+        self._worker.start()
+
+    def _run(self):
+        while not self._closed:
+            try:
+                event = self._listener.get()
+            except Exception as e:
+                self.error = e
+                for curve_id in self._ids:
+                    self.cache.invalidate(curve_id)
+                return
+            self.cache.handle_event(event)
+
+    def close(self, timeout=1):
+        self._closed = True
+        self._listener.close(timeout)
+        self._worker.join(timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class MemoryCache(RangeCache):
+    """
+    A cache of curve data in memory, see :class:`RangeCache`.  The least
+    recently used data is evicted when the size of the cached points goes
+    above ``max_size`` bytes.
+
+    Combined with :meth:`~RangeCache.watch`, a long running service can
+    serve repeated reads from memory, and only fetch what has changed::
+
+        data_cache = MemoryCache()
+        session = wapi.Session(config_file=config_file, data_cache=data_cache)
+        curves = [session.get_curve(name=n) for n in names]
+        with data_cache.watch(session, curves):
+            ...
+
+    Parameters
+    ----------
+
+    max_size: int, optional
+        The maximum size of the cached points, in bytes.
+    max_age: float, optional
+        Data fetched more than this many seconds ago is fetched again.
+    """
+
+    def __init__(self, max_size=DEFAULT_MEMORY_SIZE, max_age=None):
+        super(MemoryCache, self).__init__(max_age)
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._sizes = {}
+
+    def _load(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def _save(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        self._sizes[key] = entry.nbytes
+        total = sum(self._sizes.values())
+        while total > self.max_size and len(self._entries) > 1:
+            oldest = next(iter(self._entries))
+            total -= self._sizes[oldest]
+            self._delete(oldest)
+
+    def _keys(self, curve_id):
+        return [k for k in self._entries if k[0] == curve_id]
+
+    def _delete(self, key):
+        self._entries.pop(key, None)
+        self._sizes.pop(key, None)
+
+    def clear(self):
+        """Remove all data from the cache"""
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+
+
+class DiskCache(RangeCache):
+    """
+    A cache of curve data on disk, see :class:`RangeCache`.  The least
+    recently used data is evicted when the size of the cache goes above
+    ``max_size`` bytes.
+
+    Give it (or just a directory name) as ``data_cache`` to
+    :class:`wapi.session.Session` to use it for
+    :meth:`wapi.curves.TimeSeriesCurve.get_data` and
+    :meth:`wapi.curves.TaggedCurve.get_data`::
+
+        session = wapi.Session(config_file=config_file, data_cache=DiskCache('/tmp/wapi-cache'))
+
+    Parameters
+    ----------
+
+    directory: str
+        The directory holding the cache, created if needed.
+    max_size: int, optional
+        The maximum size of the cache, in bytes.
+    max_age: float, optional
+        Data fetched more than this many seconds ago is fetched again.
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE, max_age=None):
+        super(DiskCache, self).__init__(max_age)
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        digest = hashlib.sha1(json.dumps(key).encode()).hexdigest()
+        return os.path.join(self.directory, '{}-{}.npz'.format(key[0], digest))
+
+    def _load(self, key):
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                ranges = data['ranges'].tolist()
+                meta = json.loads(str(data['meta']))
+                entry = _Entry(meta, ranges, data['timestamps'], data['values'])
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+        # Keep track of when the data was last used, for the eviction
+        os.utime(path, None)
+        return entry
+
+    def _save(self, key, entry):
+        path = self._path(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, key=np.array(json.dumps(key)), meta=np.array(json.dumps(entry.meta, default=str)),
+                         ranges=np.array(entry.ranges, dtype=np.float64).reshape((-1, 3)),
+                         timestamps=entry.timestamps, values=entry.values)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        self._evict()
+
+    def _keys(self, curve_id):
+        keys = []
+        for path in glob.glob(os.path.join(self.directory, '{}-*.npz'.format(curve_id))):
+            try:
+                with np.load(path) as data:
+                    keys.append(tuple(json.loads(str(data['key']))))
+            except (IOError, OSError, ValueError, KeyError):
+                pass
+        return keys
+
+    def _delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        files = []
+        for path in glob.glob(os.path.join(self.directory, '*.npz')):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        """Remove all data from the cache"""
+        with self._lock:
+            for path in glob.glob(os.path.join(self.directory, '*.npz')):
+                os.remove(path)
+
+
+class MetadataCache(object):
+    """
+    A cache of curve metadata, used by :meth:`wapi.session.Session.get_curve`
+    and :meth:`wapi.session.Session.search` to avoid looking up the same
+    curves again.  Every curve built by the session is added, so a search
+    for many curves makes later lookups of them by name free.
+
+    The least recently used entries are evicted when there are more than
+    ``max_entries``, and entries are looked up again after ``max_age``
+    seconds.  If a path is given, the cache is read from that file, and
+    written back to it by :meth:`save` and when the program exits::
+
+        session = wapi.Session(config_file=config_file,
+                               metadata_cache=MetadataCache('/var/cache/wapi-curves.json'))
+
+    Parameters
+    ----------
+
+    path: str, optional
+        File keeping the cache between runs.
+    max_entries: int, optional
+        The maximum number of curves and searches kept.
+    max_age: float, optional
+        Metadata older than this many seconds is looked up again.  If None,
+        it is kept until invalidated.
+    """
+
+    def __init__(self, path=None, max_entries=DEFAULT_MAX_ENTRIES, max_age=DEFAULT_METADATA_AGE):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        # Key to (time stored, metadata), least recently used first
+        self._entries = collections.OrderedDict()
+        self._dirty = False
+        if path is not None:
+            self._read()
+            atexit.register(self.save)
+
+    @staticmethod
+    def curve_key(id=None, name=None):
+        """The key of the metadata of a curve, looked up by id or name"""
+        if id is not None:
+            return 'id:{}'.format(id)
+        return 'name:{}'.format(name.lower())
+
+    @staticmethod
+    def search_key(url):
+        """The key of the result of a search"""
+        return 'search:{}'.format(url)
+
+    def get(self, key):
+        """Get the metadata for a key, or None if it is not cached"""
+        with self._lock:
+            item = self._entries.get(key)
+            if item is not None and self.max_age is not None and item[0] < time.time() - self.max_age:
+                del self._entries[key]
+                self._dirty = True
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, metadata):
+        """Store the metadata for a key"""
+        with self._lock:
+            self._entries[key] = (time.time(), metadata)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._dirty = True
+
+    def add_curve(self, metadata):
+        """Store the metadata of a curve, by both id and name"""
+        with self._lock:
+            self.put(self.curve_key(id=metadata['id']), metadata)
+            self.put(self.curve_key(name=metadata['name']), metadata)
+
+    def invalidate(self, id=None, name=None):
+        """
+        Drop the cached metadata of a curve, given by id or name, and the
+        searches which found it.  If no curve is given, everything is
+        dropped.
+        """
+        with self._lock:
+            if id is None and name is None:
+                self._entries.clear()
+                self._dirty = True
+                return
+            name = None if name is None else name.lower()
+            for key, (_, metadata) in list(self._entries.items()):
+                found = metadata if isinstance(metadata, list) else [metadata]
+                if any(m.get('id') == id or (name is not None and str(m.get('name')).lower() == name)
+                       for m in found):
+                    del self._entries[key]
+                    self._dirty = True
+
+    def clear(self):
+        """Remove all metadata from the cache"""
+        self.invalidate()
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        for key, stored, metadata in entries:
+            self._entries[key] = (stored, metadata)
+
+    def save(self):
+        """Write the cache to its file, if it has one and has changed"""
+        with self._lock:
+            if self.path is None or not self._dirty:
+                return
+            directory = os.path.dirname(os.path.abspath(self.path))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump([[key, stored, metadata] for key, (stored, metadata) in self._entries.items()], f)
+                os.replace(tmp_path, self.path)
+            except Exception:
+                os.remove(tmp_path)
+                raise
+            self._dirty = False
@@ -0,0 +1,68 @@
+#
+# JSON encoding and decoding of request and response bodies
+#
+
+import json
+
+
+class JsonCodec(object):
+    """
+    Encode and decode JSON with the json module of the standard library.
+
+    A codec has a ``dumps`` method returning the encoded bytes, and a
+    ``loads`` method taking bytes or str.  Give an object with these methods
+    as ``json_codec`` to :class:`wapi.session.Session` to use another JSON
+    library.
+    """
+    name = 'json'
+
+    def dumps(self, obj):
+        return json.dumps(obj).encode()
+
+    def loads(self, data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        return json.loads(data)
+
+
+class OrjsonCodec(JsonCodec):
+    """
+    Encode and decode JSON with the orjson package.
+    """
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def dumps(self, obj):
+        return self._orjson.dumps(obj)
+
+    def loads(self, data):
+        return self._orjson.loads(data)
+
+
+_codecs = {
+    'json': JsonCodec,
+    'orjson': OrjsonCodec,
+}
+
+
+def get_codec(codec=None):
+    """
+    Get a JSON codec.  codec is either a codec object, which is returned as
+    is, the name of a codec ('json' or 'orjson'), or 'auto' to use orjson
+    if it is installed.  The default is the standard library json module.
+    """
+    if codec is None:
+        return JsonCodec()
+    if codec == 'auto':
+        try:
+            return OrjsonCodec()
+        except ImportError:
+            return JsonCodec()
+    if codec in _codecs:
+        return _codecs[codec]()
+    if hasattr(codec, 'loads') and hasattr(codec, 'dumps'):
+        return codec
+    raise ValueError('Unknown JSON codec: {}'.format(codec))
@@ -1,22 +1,177 @@
 from past.types import basestring
+from concurrent import futures
+import collections
+import itertools
+import time
 import warnings
+import numpy as np
 
-from . import util
+from . import metrics, stream, util
 
 
-class BaseCurve:
+def _single_ts(curve_type, **kwargs):
+    return lambda result: util.TS(input_dict=result, curve_type=curve_type, **kwargs)
+
+
+def _ts_list(curve_type, unwrap=False, **kwargs):
+    def convert(result):
+        res = [util.TS(input_dict=r, curve_type=curve_type, **kwargs) for r in result]
+        if unwrap and len(res) == 1:
+            res = res[0]
+        return res
+    return convert
+
+
+def _first(results):
+    return results[0]
+
+
+def _join_ts(fragments):
+    # Join consecutive fragments of a series into the first one, copying
+    # the data arrays once.
+    fragments = [f for f in fragments if f is not None]
+    if not fragments:
+        return None
+    ts = fragments[0]
+    with_data = [f for f in fragments if f.values is not None]
+    if len(with_data) > 1:
+        ts.points = (np.concatenate([f.timestamps for f in with_data]),
+                     np.concatenate([f.values for f in with_data]))
+    elif with_data:
+        ts.points = (with_data[0].timestamps, with_data[0].values)
+    return ts
+
+
+def _ts_size(ts):
+    return 0 if ts is None or ts.values is None else len(ts.values)
+
+
+def _join_tagged(results):
+    # Each result is a TS (single tag) or a list of TS (one per tag), and
+    # an empty list when there is no data
+    results = [None if isinstance(r, list) and not r else r for r in results]
+    if all(r is None or isinstance(r, util.TS) for r in results):
+        ts = _join_ts(results)
+        return [] if ts is None else ts
+    by_tag = {}
+    for r in results:
+        for ts in r or []:
+            by_tag.setdefault(ts.tag, []).append(ts)
+    return [_join_ts(fragments) for fragments in by_tag.values()]
+
+
+def _tag_plan(plan):
+    # The plan for a single tag, as kept by the data cache: its result is a
+    # TS, or None rather than an empty list when there is no data.
+    queries, combine = plan
+
+    def single(results):
+        res = combine(results)
+        if isinstance(res, list):
+            return res[0] if res else None
+        return res
+    return queries, single
+
+
+def _tagged_plan(plan):
+    # The plan for a single tag, with an empty list for no data, as the API
+    # returns it.
+    queries, combine = plan
+
+    def tagged(results):
+        res = combine(results)
+        return [] if res is None else res
+    return queries, tagged
+
+
+def _join_plans(plans):
+    # Run several plans as one, combining to the list of their results,
+    # leaving out the empty ones.
+    queries = [q for plan_queries, _ in plans for q in plan_queries]
+
+    def combine(results):
+        combined = []
+        pos = 0
+        for plan_queries, plan_combine in plans:
+            res = plan_combine(results[pos:pos + len(plan_queries)])
+            pos += len(plan_queries)
+            if res is not None:
+                combined.append(res)
+        return combined
+    return queries, combine
+
+
+def _history_pages(instances, instance_size, max_points, issue_date_to=None):
+    # Group the issue dates of the instances, oldest first, into pages of at
+    # most max_points data points.  Returns a list of (issue dates,
+    # issue_date_from, issue_date_to) for each page.
+    issue_dates = list(collections.OrderedDict.fromkeys(i.issue_date for i in instances or []))
+    issue_dates.sort(key=util.parsetime)
+    per_page = max(1, max_points // max(1, instance_size))
+    pages = [issue_dates[n:n + per_page] for n in range(0, len(issue_dates), per_page)]
+    return [(page, page[0], pages[n + 1][0] if n + 1 < len(pages) else issue_date_to)
+            for n, page in enumerate(pages)]
+
+
+def _page_in_order(result, issue_dates, tags=None):
+    # Sort the instances of a page on issue date (and tag), dropping any
+    # instances not part of the page.
+    order = {d: n for n, d in enumerate(issue_dates)}
+    tag_order = {t: n for n, t in enumerate(tags or [])}
+    found = [ts for ts in result or [] if ts.issue_date in order]
+    return sorted(found, key=lambda ts: (order[ts.issue_date], tag_order.get(ts.tag, 0)))
+
+
+class BaseCurve(object):
+    # The metadata of a curve is available as attributes, looked up in the
+    # metadata dict on access rather than copied to each object, so that
+    # searches returning many curves stay cheap.
+    __slots__ = ('id', '_metadata', '_session', '_tz', '_last_response')
+
     def __init__(self, id, metadata, session):
         self._metadata = metadata
         self._session = session
-        self.time_zone = 'CET'
-        if metadata is None:
-            self.hasMetadata = False
-        else:
-            self.hasMetadata = True
-            for key, val in metadata.items():
-                setattr(self, key, val)
+        self._tz = None
         self.id = id
-        self.tz = util.parse_tz(self.time_zone)
+
+    def __getattr__(self, key):
+        # Only called for attributes not found otherwise
+        if key in BaseCurve.__slots__:
+            raise AttributeError(key)
+        metadata = self._metadata
+        if metadata is not None and key in metadata:
+            return metadata[key]
+        raise AttributeError("'{}' object has no attribute '{}'".format(type(self).__name__, key))
+
+    def __setattr__(self, key, value):
+        if key in BaseCurve.__slots__ or hasattr(type(self), key):
+            object.__setattr__(self, key, value)
+            return
+        # Other attributes are metadata, copied on write since the dict may
+        # be shared with the metadata cache of the session
+        metadata = dict(self._metadata or {})
+        metadata[key] = value
+        self._metadata = metadata
+        if key == 'time_zone':
+            self._tz = None
+
+    def __dir__(self):
+        return sorted(set(dir(type(self))) | set(BaseCurve.__slots__) | set(self._metadata or ()))
+
+    @property
+    def hasMetadata(self):
+        return self._metadata is not None
+
+    @property
+    def tz(self):
+        if self._tz is None:
+            # CET when the time zone is not in the metadata
+            self._tz = util.parse_tz(getattr(self, 'time_zone', 'CET'))
+        return self._tz
+
+    @tz.setter
+    def tz(self, tz):
+        self._tz = tz
 
     def __str__(self):
         if hasattr(self, 'curve_type'):
@@ -50,22 +205,140 @@ class BaseCurve:
     def _load_data(self, url, failmsg, urlbase=None):
         if urlbase is None:
             urlbase = self._session.urlbase
-        response = self._session.data_request('GET', urlbase, url)
+        response = self._session.data_request('GET', urlbase, url, stream=self._session.stream_data)
+        if self._session.metrics is None:
+            return self._handle_data_response(response, failmsg)
+        start = time.time()
+        result = self._handle_data_response(response, failmsg)
+        self._observe_decode(url, result, time.time() - start)
+        return result
+
+    def _observe_decode(self, url, result, seconds):
+        endpoint = metrics.endpoint(url)
+        self._session.metrics.observe_stage('decode', endpoint, seconds)
+        if result is not None:
+            self._session.metrics.observe_points(endpoint, metrics.count_points(result))
+
+    def _handle_data_response(self, response, failmsg):
         self._last_response = response
         if response.status_code == 200:
-            return response.json()
+            if self._session.stream_data:
+                return stream.decode(response.iter_content(stream.CHUNK_SIZE), self._session.json_codec.loads)
+            return self._session.json_codec.loads(response.content)
         elif response.status_code == 204 or response.status_code == 404:
             return None
         raise util.CurveException('{}: {} ({})'.format(failmsg, response.content, response.status_code))
 
+    def _run_query(self, query):
+        # A query is a tuple of (url, failure message, conversion function),
+        # where the conversion is applied to a successful result.
+        url, failmsg, convert = query
+        result = self._load_data(url, failmsg)
+        if result is None or convert is None:
+            return result
+        if self._session.metrics is None:
+            return convert(result)
+        start = time.time()
+        converted = convert(result)
+        self._session.metrics.observe_stage('convert', metrics.endpoint(url), time.time() - start)
+        return converted
+
+    def _run_queries(self, queries):
+        if len(queries) == 1:
+            return [self._run_query(queries[0])]
+        with futures.ThreadPoolExecutor(max_workers=self._session.max_workers) as executor:
+            return list(executor.map(self._run_query, queries))
+
+    def _iter_queries(self, queries, lookahead=None):
+        # Run the queries in the background, with at most lookahead of them
+        # in flight, and yield the results in order.
+        if lookahead is None:
+            lookahead = self._session.max_workers
+        queries = iter(queries)
+        executor = futures.ThreadPoolExecutor(max_workers=lookahead)
+        pending = collections.deque(executor.submit(self._run_query, q)
+                                    for q in itertools.islice(queries, lookahead))
+        try:
+            while pending:
+                result = pending.popleft().result()
+                for q in itertools.islice(queries, 1):
+                    pending.append(executor.submit(self._run_query, q))
+                yield result
+        finally:
+            for job in pending:
+                job.cancel()
+            executor.shutdown(wait=False)
+
+    def _data_range(self, data_from, data_to):
+        # The (begin, end) datetimes of a data request, filling in missing
+        # ends from the access range of the curve.  None if not known.
+        access_range = getattr(self, 'accessRange', None) or {}
+        if data_from is None:
+            data_from = access_range.get('begin')
+        if data_to is None:
+            data_to = access_range.get('end')
+        begin = util.to_datetime(data_from, self.tz)
+        end = util.to_datetime(data_to, self.tz)
+        if begin is None or end is None:
+            return None
+        return begin, end
+
+    def _split_data_range(self, data_from, data_to, frequency, max_points, required=False):
+        # Find the (from, to) pairs needed to read the range with at most
+        # max_points per request.  None if the range cannot be split.  If
+        # required, a range which is not known is an error rather than a
+        # single request for all the data.
+        if not max_points:
+            return None
+        data_range = self._data_range(data_from, data_to)
+        if data_range is None:
+            if required:
+                raise util.CurveException('Cannot split the data of curve {} into requests of at most {} points: '
+                                          'give data_from and data_to, the access range of the curve is not '
+                                          'known'.format(self.id, max_points))
+            return None
+        begin, end = data_range
+        return util.split_range(begin, end, frequency or getattr(self, 'frequency', None), max_points)
+
+    def _cached_plan(self, tag, data_from, data_to, options, fetch_plan):
+        # Plan a request for a single series through the data cache of the
+        # session, or None if it is not used.  Open ended ranges are not
+        # cached, as the access range of the curve may be out of date.
+        cache = self._session.data_cache
+        if cache is None or data_from is None or data_to is None:
+            return None
+        data_range = self._data_range(data_from, data_to)
+        if data_range is None or data_range[0] >= data_range[1]:
+            return None
+        begin, end = data_range
+        return cache.plan(self.id, tag, begin, end, options, fetch_plan)
+
+    def _cached_instance_plan(self, tag, issue_date, data_from, data_to, options, fetch_plan):
+        # Plan a request for a single instance through the data cache of
+        # the session, or None if it is not used.
+        cache = self._session.data_cache
+        if cache is None:
+            return None
+        issue_date = util.to_datetime(issue_date, self.tz)
+        begin = util.to_datetime(data_from, self.tz)
+        end = util.to_datetime(data_to, self.tz)
+        if issue_date is None or (begin is None) != (data_from is None) or (end is None) != (data_to is None):
+            return None
+        return cache.plan(self.id, tag, begin, end, options, fetch_plan, issue_date=util.to_millis(issue_date))
+
     def access(self):
+        return self._run_query(self._access_query())
+
+    def _access_query(self):
         url = '/api/curves/{}/access'.format(self.id)
-        return self._load_data(url, 'Failed to load curve access')
+        return url, 'Failed to load curve access', None
 
 
 class TimeSeriesCurve(BaseCurve):
+    __slots__ = ()
+
     def get_data(self, data_from=None, data_to=None, time_zone=None, filter=None,
-                 function=None, frequency=None, output_time_zone=None):
+                 function=None, frequency=None, output_time_zone=None, max_points_per_request=None):
         """ Getting data from Time Series curves
 
         A Time Series curves holds a single time series.
@@ -130,11 +403,88 @@ class TimeSeriesCurve(BaseCurve):
             Change curve time zone AFTER performing an aggregation/split
             or applying a filter.
 
+        max_points_per_request: int, optional
+            If given, long ranges are split into fragments of at most this
+            many points, which are fetched in parallel and joined. Missing
+            ``data_from`` or ``data_to`` are taken from the access range of
+            the curve, and if that is not known either,
+            :class:`wapi.util.CurveException` is raised.
+
         Returns
         -------
         :class:`wapi.util.TS` object
         """
+        queries, combine = self._get_data_plan(data_from, data_to, time_zone, filter, function, frequency,
+                                               output_time_zone, max_points_per_request)
+        return combine(self._run_queries(queries))
+
+    def iter_data(self, data_from=None, data_to=None, time_zone=None, filter=None, function=None,
+                  frequency=None, output_time_zone=None, chunk=util.MAX_POINTS_PER_REQUEST, prefetch=1):
+        """ Iterate over the data of a Time Series curve, in chunks
+
+        Splits the range into chunks of at most ``chunk`` data points, and
+        yields a :class:`wapi.util.TS` for each of them, in time order.
+        While a chunk is being processed, the next ``prefetch`` chunks are
+        fetched in the background, so only a few chunks are held in memory
+        at a time, whatever the length of the range.
+
+        Parameters
+        ----------
+
+        data_from, data_to: time-stamp, optional
+            The range of data to fetch, as in
+            :meth:`wapi.curves.TimeSeriesCurve.get_data`.  Missing ends are
+            taken from the access range of the curve, and if they are not
+            known either, all the data is fetched as a single chunk.
+
+        time_zone, filter, function, frequency, output_time_zone: optional
+            Processing of the data, see
+            :meth:`wapi.curves.TimeSeriesCurve.get_data`.
 
+        chunk: int, optional
+            The maximum number of data points in each chunk.
+
+        prefetch: int, optional
+            The number of chunks fetched ahead of the one being consumed.
+
+        Returns
+        -------
+        generator of :class:`wapi.util.TS` objects, in time order.
+        """
+        options = dict(time_zone=time_zone, filter=filter, function=function, frequency=frequency,
+                       output_time_zone=output_time_zone)
+        for ts in self._iter_queries(self._iter_data_queries(data_from, data_to, options, chunk), prefetch):
+            if ts is not None:
+                yield ts
+
+    def _iter_data_queries(self, data_from, data_to, options, chunk):
+        windows = self._split_data_range(data_from, data_to, options['frequency'], chunk)
+        if windows is None:
+            return [self._get_data_query(data_from, data_to, **options)]
+        return [self._get_data_query(begin, end, **options) for begin, end in windows]
+
+    def _get_data_plan(self, data_from=None, data_to=None, time_zone=None, filter=None, function=None,
+                       frequency=None, output_time_zone=None, max_points_per_request=None):
+        # A plan is a list of queries and a function combining their results
+        options = dict(time_zone=time_zone, filter=filter, function=function, frequency=frequency,
+                       output_time_zone=output_time_zone)
+
+        def fetch_plan(begin, end):
+            return self._fetch_data_plan(begin, end, options, max_points_per_request)
+        plan = self._cached_plan(None, data_from, data_to, options, fetch_plan)
+        if plan is None:
+            plan = fetch_plan(data_from, data_to)
+        return plan
+
+    def _fetch_data_plan(self, data_from, data_to, options, max_points_per_request):
+        windows = self._split_data_range(data_from, data_to, options['frequency'], max_points_per_request,
+                                          required=True)
+        if windows is None:
+            return [self._get_data_query(data_from, data_to, **options)], _first
+        return [self._get_data_query(begin, end, **options) for begin, end in windows], _join_ts
+
+    def _get_data_query(self, data_from=None, data_to=None, time_zone=None, filter=None,
+                        function=None, frequency=None, output_time_zone=None):
         args = []
         astr = ''
         self._add_from_to(args, data_from, data_to)
@@ -142,13 +492,12 @@ class TimeSeriesCurve(BaseCurve):
         if len(args) > 0:
             astr = '?{}'.format('&'.join(args))
         url = '/api/series/{}{}'.format(self.id, astr)
-        result = self._load_data(url, 'Failed to load curve data')
-        if result is None:
-            return result
-        return util.TS(input_dict=result, curve_type=util.TIME_SERIES)
+        return url, 'Failed to load curve data', _single_ts(util.TIME_SERIES)
 
 
 class TaggedCurve(BaseCurve):
+    __slots__ = ()
+
     def get_tags(self):
         """ Get list of available tags for this curve
 
@@ -157,11 +506,14 @@ class TaggedCurve(BaseCurve):
         list
             Returns a list of all available tags for a Tagged Instance curve.
         """
+        return self._run_query(self._get_tags_query())
+
+    def _get_tags_query(self):
         url = '/api/series/tagged/{}/tags'.format(self.id)
-        return self._load_data(url, 'Failed to fetch tags')
+        return url, 'Failed to fetch tags', None
 
     def get_data(self, tag=None, data_from=None, data_to=None, time_zone=None, filter=None,
-                 function=None, frequency=None, output_time_zone=None):
+                 function=None, frequency=None, output_time_zone=None, max_points_per_request=None):
         """ Getting data from TAGGED curves
 
         A tagged curve holds a set of closely related time series, each
@@ -235,10 +587,97 @@ class TaggedCurve(BaseCurve):
             Change curve time zone AFTER performing an aggregation/split
             or applying a filter.
 
+        max_points_per_request: int, optional
+            If given, long ranges are split into fragments of at most this
+            many points per tag, which are fetched in parallel and joined.
+            Missing ``data_from`` or ``data_to`` are taken from the access
+            range of the curve, and if that is not known either,
+            :class:`wapi.util.CurveException` is raised.
+
         Returns
         -------
         :class:`wapi.util.TS` object
         """
+        queries, combine = self._get_data_plan(tag, data_from, data_to, time_zone, filter, function, frequency,
+                                               output_time_zone, max_points_per_request)
+        return combine(self._run_queries(queries))
+
+    def iter_data(self, tag=None, data_from=None, data_to=None, time_zone=None, filter=None, function=None,
+                  frequency=None, output_time_zone=None, chunk=util.MAX_POINTS_PER_REQUEST, prefetch=1):
+        """ Iterate over the data of a TAGGED curve, in chunks
+
+        Splits the range into chunks of at most ``chunk`` data points per
+        tag, and yields the data of each of them, in time order.  While a
+        chunk is being processed, the next ``prefetch`` chunks are fetched
+        in the background, so only a few chunks are held in memory at a
+        time, whatever the length of the range.
+
+        Parameters
+        ----------
+
+        tag: str or list, optional
+            tag or tags to get the data for, as in
+            :meth:`wapi.curves.TaggedCurve.get_data`.
+
+        data_from, data_to: time-stamp, optional
+            The range of data to fetch, as in
+            :meth:`wapi.curves.TaggedCurve.get_data`.  Missing ends are
+            taken from the access range of the curve, and if they are not
+            known either, all the data is fetched as a single chunk.
+
+        time_zone, filter, function, frequency, output_time_zone: optional
+            Processing of the data, see
+            :meth:`wapi.curves.TaggedCurve.get_data`.
+
+        chunk: int, optional
+            The maximum number of data points per tag in each chunk.
+
+        prefetch: int, optional
+            The number of chunks fetched ahead of the one being consumed.
+
+        Returns
+        -------
+        generator of :class:`wapi.util.TS` objects, or of lists of them
+        (one per tag) if a list of tags is given, in time order.
+        """
+        options = dict(time_zone=time_zone, filter=filter, function=function, frequency=frequency,
+                       output_time_zone=output_time_zone)
+        for res in self._iter_queries(self._iter_data_queries(tag, data_from, data_to, options, chunk), prefetch):
+            if res is not None:
+                yield res
+
+    def _iter_data_queries(self, tag, data_from, data_to, options, chunk):
+        windows = self._split_data_range(data_from, data_to, options['frequency'], chunk)
+        if windows is None:
+            return [self._get_data_query(tag, data_from, data_to, **options)]
+        return [self._get_data_query(tag, begin, end, **options) for begin, end in windows]
+
+    def _get_data_plan(self, tag=None, data_from=None, data_to=None, time_zone=None, filter=None,
+                       function=None, frequency=None, output_time_zone=None, max_points_per_request=None):
+        options = dict(time_zone=time_zone, filter=filter, function=function, frequency=frequency,
+                       output_time_zone=output_time_zone)
+
+        def fetch_plan(tag, begin, end):
+            return self._fetch_data_plan(tag, begin, end, options, max_points_per_request)
+        if self._session.data_cache is not None:
+            # Cache each tag on its own
+            single = tag is None or isinstance(tag, basestring)
+            plans = [self._cached_plan(t, data_from, data_to, options,
+                                       lambda begin, end, t=t: _tag_plan(fetch_plan(t, begin, end)))
+                     for t in ([tag] if single else tag)]
+            if plans and all(plan is not None for plan in plans):
+                return _tagged_plan(plans[0]) if single else _join_plans(plans)
+        return fetch_plan(tag, data_from, data_to)
+
+    def _fetch_data_plan(self, tag, data_from, data_to, options, max_points_per_request):
+        windows = self._split_data_range(data_from, data_to, options['frequency'], max_points_per_request,
+                                          required=True)
+        if windows is None:
+            return [self._get_data_query(tag, data_from, data_to, **options)], _first
+        return [self._get_data_query(tag, begin, end, **options) for begin, end in windows], _join_tagged
+
+    def _get_data_query(self, tag=None, data_from=None, data_to=None, time_zone=None, filter=None,
+                        function=None, frequency=None, output_time_zone=None):
         unwrap = False
         if tag is None:
             args = []
@@ -251,16 +690,12 @@ class TaggedCurve(BaseCurve):
         self._add_functions(args, time_zone, filter, function, frequency, output_time_zone)
         astr = '&'.join(args)
         url = '/api/series/tagged/{}?{}'.format(self.id, astr)
-        result = self._load_data(url, 'Failed to load tagged curve data')
-        if result is None:
-            return result
-        res = [util.TS(input_dict=r, curve_type=util.TAGGED) for r in result]
-        if unwrap and len(res) == 1:
-            res = res[0]
-        return res
+        return url, 'Failed to load tagged curve data', _ts_list(util.TAGGED, unwrap=unwrap)
 
 
 class InstanceCurve(BaseCurve):
+    __slots__ = ()
+
     def search_instances(self, issue_date_from=None, issue_date_to=None,
                          issue_dates=None, issue_weekdays=None, issue_days=None, issue_months=None,
                          issue_times=None, with_data=False, data_from=None, data_to=None,
@@ -375,8 +810,20 @@ class InstanceCurve(BaseCurve):
         -------
         :class:`wapi.util.TS` object
         """
+        return self._run_query(self._search_instances_query(issue_date_from, issue_date_to, issue_dates,
+                                                            issue_weekdays, issue_days, issue_months,
+                                                            issue_times, with_data, data_from, data_to,
+                                                            time_zone, filter, function, frequency,
+                                                            output_time_zone, only_accessible,
+                                                            modified_since))
+
+    def _search_instances_query(self, issue_date_from=None, issue_date_to=None,
+                                issue_dates=None, issue_weekdays=None, issue_days=None, issue_months=None,
+                                issue_times=None, with_data=False, data_from=None, data_to=None,
+                                time_zone=None, filter=None, function=None, frequency=None,
+                                output_time_zone=None, only_accessible=None, modified_since=None):
         if only_accessible is not None:
-            warnings.warn("only_accessible parameter will be removed soon.", FutureWarning, stacklevel=2)
+            warnings.warn("only_accessible parameter will be removed soon.", FutureWarning, stacklevel=3)
         args=[util.make_arg('with_data', '{}'.format(with_data).lower())]
         self._add_from_to(args, issue_date_from, issue_date_to, prefix='issue_date_')
         if with_data:
@@ -396,10 +843,7 @@ class InstanceCurve(BaseCurve):
             args.append(util.make_arg('modified_since', modified_since))
         astr = '&'.join(args)
         url = '/api/instances/{}?{}'.format(self.id, astr)
-        result = self._load_data(url, 'Failed to find instances')
-        if result is None:
-            return result
-        return [util.TS(input_dict=r, curve_type=util.INSTANCES) for r in result]
+        return url, 'Failed to find instances', _ts_list(util.INSTANCES)
 
     def get_instance(self, issue_date, with_data=True, data_from=None, data_to=None,
                      time_zone=None, filter=None, function=None, frequency=None,
@@ -481,8 +925,30 @@ class InstanceCurve(BaseCurve):
         -------
         :class:`wapi.util.TS` object
         """
+        queries, combine = self._get_instance_plan(issue_date, with_data, data_from, data_to, time_zone,
+                                                   filter, function, frequency, output_time_zone,
+                                                   only_accessible)
+        return combine(self._run_queries(queries))
+
+    def _get_instance_plan(self, issue_date, with_data=True, data_from=None, data_to=None,
+                           time_zone=None, filter=None, function=None, frequency=None,
+                           output_time_zone=None, only_accessible=None):
         if only_accessible is not None:
-            warnings.warn("only_accessible parameter will be removed soon.", FutureWarning, stacklevel=2)
+            warnings.warn("only_accessible parameter will be removed soon.", FutureWarning, stacklevel=3)
+        options = dict(time_zone=time_zone, filter=filter, function=function, frequency=frequency,
+                       output_time_zone=output_time_zone)
+
+        def fetch_plan(begin, end):
+            return [self._get_instance_query(issue_date, with_data, begin, end, **options)], _first
+        if with_data:
+            plan = self._cached_instance_plan(None, issue_date, data_from, data_to, options, fetch_plan)
+            if plan is not None:
+                return plan
+        return fetch_plan(data_from, data_to)
+
+    def _get_instance_query(self, issue_date, with_data=True, data_from=None, data_to=None,
+                            time_zone=None, filter=None, function=None, frequency=None,
+                            output_time_zone=None):
         args=[util.make_arg('with_data', '{}'.format(with_data).lower()),
               util.make_arg('issue_date', issue_date)]
         if with_data:
@@ -490,10 +956,7 @@ class InstanceCurve(BaseCurve):
             self._add_functions(args, time_zone, filter, function, frequency, output_time_zone)
         astr = '&'.join(args)
         url = '/api/instances/{}/get?{}'.format(self.id, astr)
-        result = self._load_data(url, 'Failed to load instance')
-        if result is None:
-            return result
-        return util.TS(input_dict=result, issue_date=issue_date, curve_type=util.INSTANCES)
+        return url, 'Failed to load instance', _single_ts(util.INSTANCES, issue_date=issue_date)
 
     def get_latest(self, issue_date_from=None, issue_date_to=None, issue_dates=None,
                    with_data=True, data_from=None, data_to=None, time_zone=None, filter=None,
@@ -588,8 +1051,15 @@ class InstanceCurve(BaseCurve):
         -------
         :class:`wapi.util.TS` object
         """
+        return self._run_query(self._get_latest_query(issue_date_from, issue_date_to, issue_dates, with_data,
+                                                      data_from, data_to, time_zone, filter, function,
+                                                      frequency, output_time_zone, only_accessible))
+
+    def _get_latest_query(self, issue_date_from=None, issue_date_to=None, issue_dates=None,
+                          with_data=True, data_from=None, data_to=None, time_zone=None, filter=None,
+                          function=None, frequency=None, output_time_zone=None, only_accessible=None):
         if only_accessible is not None:
-            warnings.warn("only_accessible parameter will be removed soon.", FutureWarning, stacklevel=2)
+            warnings.warn("only_accessible parameter will be removed soon.", FutureWarning, stacklevel=3)
         args=[util.make_arg('with_data', '{}'.format(with_data).lower())]
         self._add_from_to(args, issue_date_from, issue_date_to, prefix='issue_date_')
         if with_data:
@@ -599,10 +1069,7 @@ class InstanceCurve(BaseCurve):
             args.append(util.make_arg('issue_date', issue_dates))
         astr = '&'.join(args)
         url = '/api/instances/{}/latest?{}'.format(self.id, astr)
-        result = self._load_data(url, 'Failed to load instance')
-        if result is None:
-            return result
-        return util.TS(input_dict=result, curve_type=util.INSTANCES)
+        return url, 'Failed to load instance', _single_ts(util.INSTANCES)
 
     def get_relative(self, data_offset, data_max_length=None, issue_date_from=None, issue_date_to=None,
                      issue_dates=None, issue_weekdays=None, issue_days=None, issue_months=None, issue_times=None,
@@ -715,6 +1182,17 @@ class InstanceCurve(BaseCurve):
         -------
         :class:`wapi.util.TS` object
         """
+        return self._run_query(self._get_relative_query(data_offset, data_max_length, issue_date_from,
+                                                        issue_date_to, issue_dates, issue_weekdays,
+                                                        issue_days, issue_months, issue_times, data_from,
+                                                        data_to, time_zone, filter, function, frequency,
+                                                        output_time_zone))
+
+    def _get_relative_query(self, data_offset, data_max_length=None, issue_date_from=None,
+                            issue_date_to=None, issue_dates=None, issue_weekdays=None, issue_days=None,
+                            issue_months=None, issue_times=None, data_from=None, data_to=None,
+                            time_zone=None, filter=None, function=None, frequency=None,
+                            output_time_zone=None):
         args = [util.make_arg('data_offset', '{}'.format(data_offset))]
         self._add_from_to(args, issue_date_from, issue_date_to, prefix='issue_date_')
         self._add_from_to(args, data_from, data_to, prefix='data_')
@@ -733,10 +1211,7 @@ class InstanceCurve(BaseCurve):
             args.append(util.make_arg('issue_time', issue_times))
         astr = '&'.join(args)
         url = '/api/instances/{}/relative?{}'.format(self.id, astr)
-        result = self._load_data(url, 'Failed to find instances')
-        if result is None:
-            return result
-        return util.TS(input_dict=result, curve_type=util.INSTANCES)
+        return url, 'Failed to find instances', _single_ts(util.INSTANCES)
 
     def get_absolute(self, data_date, issue_frequency=None, issue_date_from=None, issue_date_to=None):
         """ Get an absolute forecast from the INSTANCE curve
@@ -779,19 +1254,75 @@ class InstanceCurve(BaseCurve):
         -------
         :class:`wapi.util.TS` object
         """
+        return self._run_query(self._get_absolute_query(data_date, issue_frequency, issue_date_from,
+                                                        issue_date_to))
+
+    def _get_absolute_query(self, data_date, issue_frequency=None, issue_date_from=None, issue_date_to=None):
         args = [util.make_arg('data_date', data_date)]
         if issue_frequency is not None:
             args.append(util.make_arg('issue_frequency', issue_frequency))
         self._add_from_to(args, issue_date_from, issue_date_to, prefix='issue_date_')
         astr = '&'.join(args)
         url = '/api/instances/{}/absolute?{}'.format(self.id, astr)
-        result = self._load_data(url, 'Failed to find instances')
-        if result is None:
-            return result
-        return util.TS(input_dict=result, curve_type=util.INSTANCES)
+        return url, 'Failed to find instances', _single_ts(util.INSTANCES)
+
+    def iter_history(self, issue_date_from=None, issue_date_to=None, data_from=None, data_to=None,
+                     time_zone=None, filter=None, function=None, frequency=None, output_time_zone=None,
+                     max_points_per_request=util.MAX_POINTS_PER_REQUEST):
+        """ Iterate over the instances of an INSTANCE curve, oldest first
+
+        Fetches the history of a forecast with data, in batches of as many
+        instances as fit within ``max_points_per_request`` data points. The
+        batch size is estimated from the size of the latest instance, and
+        a few batches are fetched in parallel ahead of the one being
+        consumed, keeping the memory use bounded.
+
+        Parameters
+        ----------
+
+        issue_date_from: time-stamp, optional
+            Limits the timerange of the issue_dates to return.
+            The time-stamp can be provided in any of the following types :
+
+            * datestring in format '%Y-%M-%DT%h:%m:%sZ',
+              eg '2017-01-01' or '2018-12-16T13:45:00Z'
+            * pandas.Timestamp object
+            * datetime.datetime object
+
+        issue_date_to: time-stamp, optional
+            Limits the timerange of the issue_dates to return.
+            The time-stamp can be provided in the same types as
+            "issue_date_from".
+
+        data_from, data_to, time_zone, filter, function, frequency, output_time_zone: optional
+            Selection and processing of the data of each instance, see
+            :meth:`wapi.curves.InstanceCurve.search_instances`.
+
+        max_points_per_request: int, optional
+            The maximum number of data points fetched in one request.
+
+        Returns
+        -------
+        generator of :class:`wapi.util.TS` objects, in issue_date order.
+        """
+        data_args = dict(data_from=data_from, data_to=data_to, time_zone=time_zone, filter=filter,
+                         function=function, frequency=frequency, output_time_zone=output_time_zone)
+        latest, instances = self._run_queries([
+            self._get_latest_query(issue_date_from=issue_date_from, issue_date_to=issue_date_to, **data_args),
+            self._search_instances_query(issue_date_from=issue_date_from, issue_date_to=issue_date_to)])
+        if latest is None:
+            return
+        pages = _history_pages(instances, _ts_size(latest), max_points_per_request, issue_date_to)
+        queries = [self._search_instances_query(issue_date_from=first, issue_date_to=last, with_data=True,
+                                                **data_args) for issue_dates, first, last in pages]
+        for (issue_dates, first, last), result in zip(pages, self._iter_queries(queries)):
+            for ts in _page_in_order(result, issue_dates):
+                yield ts
 
 
 class TaggedInstanceCurve(BaseCurve):
+    __slots__ = ()
+
     def get_tags(self):
         """ Get list of available tags for this curve
 
@@ -800,8 +1331,11 @@ class TaggedInstanceCurve(BaseCurve):
         list
             Returns a list of all available tags for a Tagged Instance curve.
         """
+        return self._run_query(self._get_tags_query())
+
+    def _get_tags_query(self):
         url = '/api/instances/tagged/{}/tags'.format(self.id)
-        return self._load_data(url, 'Failed to fetch tags')
+        return url, 'Failed to fetch tags', None
 
     def search_instances(self, tags=None, issue_date_from=None, issue_date_to=None,
                          issue_dates=None, issue_weekdays=None, issue_days=None, issue_months=None,
@@ -927,8 +1461,20 @@ class TaggedInstanceCurve(BaseCurve):
         -------
         :class:`wapi.util.TS` object
         """
+        return self._run_query(self._search_instances_query(tags, issue_date_from, issue_date_to, issue_dates,
+                                                            issue_weekdays, issue_days, issue_months,
+                                                            issue_times, with_data, data_from, data_to,
+                                                            time_zone, filter, function, frequency,
+                                                            output_time_zone, only_accessible,
+                                                            modified_since))
+
+    def _search_instances_query(self, tags=None, issue_date_from=None, issue_date_to=None,
+                                issue_dates=None, issue_weekdays=None, issue_days=None, issue_months=None,
+                                issue_times=None, with_data=False, data_from=None, data_to=None,
+                                time_zone=None, filter=None, function=None, frequency=None,
+                                output_time_zone=None, only_accessible=None, modified_since=None):
         if only_accessible is not None:
-            warnings.warn("only_accessible parameter will be removed soon.", FutureWarning, stacklevel=2)
+            warnings.warn("only_accessible parameter will be removed soon.", FutureWarning, stacklevel=3)
         args=[util.make_arg('with_data', '{}'.format(with_data).lower())]
         if tags is not None:
             args.append(util.make_arg('tag', tags))
@@ -950,10 +1496,7 @@ class TaggedInstanceCurve(BaseCurve):
             args.append(util.make_arg('modified_since', modified_since))
         astr = '&'.join(args)
         url = '/api/instances/tagged/{}?{}'.format(self.id, astr)
-        result = self._load_data(url, 'Failed to find tagged instances')
-        if result is None:
-            return result
-        return [util.TS(input_dict=r, curve_type=util.TAGGED_INSTANCES) for r in result]
+        return url, 'Failed to find tagged instances', _ts_list(util.TAGGED_INSTANCES)
 
     def get_instance(self, issue_date, tag=None, with_data=True, data_from=None, data_to=None,
                      time_zone=None, filter=None, function=None, frequency=None,
@@ -1045,9 +1588,34 @@ class TaggedInstanceCurve(BaseCurve):
         -------
         :class:`wapi.util.TS` object
         """
-
+        queries, combine = self._get_instance_plan(issue_date, tag, with_data, data_from, data_to,
+                                                   time_zone, filter, function, frequency,
+                                                   output_time_zone, only_accessible)
+        return combine(self._run_queries(queries))
+
+    def _get_instance_plan(self, issue_date, tag=None, with_data=True, data_from=None, data_to=None,
+                           time_zone=None, filter=None, function=None, frequency=None,
+                           output_time_zone=None, only_accessible=None):
         if only_accessible is not None:
-            warnings.warn("only_accessible parameter will be removed soon.", FutureWarning, stacklevel=2)
+            warnings.warn("only_accessible parameter will be removed soon.", FutureWarning, stacklevel=3)
+        options = dict(time_zone=time_zone, filter=filter, function=function, frequency=frequency,
+                       output_time_zone=output_time_zone)
+
+        def fetch_plan(tag, begin, end):
+            return [self._get_instance_query(issue_date, tag, with_data, begin, end, **options)], _first
+        if with_data and self._session.data_cache is not None:
+            # Cache each tag on its own
+            single = tag is None or isinstance(tag, basestring)
+            plans = [self._cached_instance_plan(t, issue_date, data_from, data_to, options,
+                                                lambda begin, end, t=t: _tag_plan(fetch_plan(t, begin, end)))
+                     for t in ([tag] if single else tag)]
+            if plans and all(plan is not None for plan in plans):
+                return _tagged_plan(plans[0]) if single else _join_plans(plans)
+        return fetch_plan(tag, data_from, data_to)
+
+    def _get_instance_query(self, issue_date, tag=None, with_data=True, data_from=None, data_to=None,
+                            time_zone=None, filter=None, function=None, frequency=None,
+                            output_time_zone=None):
         args=[util.make_arg('with_data', '{}'.format(with_data).lower()),
               util.make_arg('issue_date', issue_date)]
         unwrap = False
@@ -1062,13 +1630,8 @@ class TaggedInstanceCurve(BaseCurve):
             self._add_functions(args, time_zone, filter, function, frequency, output_time_zone)
         astr = '&'.join(args)
         url = '/api/instances/tagged/{}/get?{}'.format(self.id, astr)
-        result = self._load_data(url, 'Failed to load tagged instance')
-        if result is None:
-            return result
-        res = [util.TS(input_dict=r, issue_date=issue_date, curve_type=util.TAGGED_INSTANCES) for r in result]
-        if unwrap and len(res) == 1:
-            res = res[0]
-        return res
+        return url, 'Failed to load tagged instance', _ts_list(util.TAGGED_INSTANCES, unwrap=unwrap,
+                                                               issue_date=issue_date)
 
     def get_latest(self, tags=None, issue_date_from=None, issue_date_to=None, issue_dates=None,
                    with_data=True, data_from=None, data_to=None, time_zone=None, filter=None,
@@ -1178,9 +1741,15 @@ class TaggedInstanceCurve(BaseCurve):
         -------
         :class:`wapi.util.TS` object
         """
+        return self._run_query(self._get_latest_query(tags, issue_date_from, issue_date_to, issue_dates,
+                                                      with_data, data_from, data_to, time_zone, filter,
+                                                      function, frequency, output_time_zone, only_accessible))
 
+    def _get_latest_query(self, tags=None, issue_date_from=None, issue_date_to=None, issue_dates=None,
+                          with_data=True, data_from=None, data_to=None, time_zone=None, filter=None,
+                          function=None, frequency=None, output_time_zone=None, only_accessible=None):
         if only_accessible is not None:
-            warnings.warn("only_accessible parameter will be removed soon.", FutureWarning, stacklevel=2)
+            warnings.warn("only_accessible parameter will be removed soon.", FutureWarning, stacklevel=3)
         args=[util.make_arg('with_data', '{}'.format(with_data).lower())]
         if tags is not None:
             args.append(util.make_arg('tag', tags))
@@ -1192,10 +1761,7 @@ class TaggedInstanceCurve(BaseCurve):
             args.append(util.make_arg('issue_date', issue_dates))
         astr = '&'.join(args)
         url = '/api/instances/tagged/{}/latest?{}'.format(self.id, astr)
-        result = self._load_data(url, 'Failed to load tagged instance')
-        if result is None:
-            return result
-        return util.TS(input_dict=result, curve_type=util.TAGGED_INSTANCES)
+        return url, 'Failed to load tagged instance', _single_ts(util.TAGGED_INSTANCES)
 
 
     def get_relative(self, data_offset, data_max_length=None, tag=None, issue_date_from=None, issue_date_to=None,
@@ -1312,6 +1878,17 @@ class TaggedInstanceCurve(BaseCurve):
         -------
         :class:`wapi.util.TS` object
         """
+        return self._run_query(self._get_relative_query(data_offset, data_max_length, tag, issue_date_from,
+                                                        issue_date_to, issue_dates, issue_weekdays,
+                                                        issue_days, issue_months, issue_times, data_from,
+                                                        data_to, time_zone, filter, function, frequency,
+                                                        output_time_zone))
+
+    def _get_relative_query(self, data_offset, data_max_length=None, tag=None, issue_date_from=None,
+                            issue_date_to=None, issue_dates=None, issue_weekdays=None, issue_days=None,
+                            issue_months=None, issue_times=None, data_from=None, data_to=None,
+                            time_zone=None, filter=None, function=None, frequency=None,
+                            output_time_zone=None):
         args = [util.make_arg('data_offset', '{}'.format(data_offset))]
         self._add_from_to(args, issue_date_from, issue_date_to, prefix='issue_date_')
         self._add_from_to(args, data_from, data_to, prefix='data_')
@@ -1332,10 +1909,7 @@ class TaggedInstanceCurve(BaseCurve):
             args.append(util.make_arg('issue_time', issue_times))
         astr = '&'.join(args)
         url = '/api/instances/tagged/{}/relative?{}'.format(self.id, astr)
-        result = self._load_data(url, 'Failed to find instances')
-        if result is None:
-            return result
-        return util.TS(input_dict=result, curve_type=util.TAGGED_INSTANCES)
+        return url, 'Failed to find instances', _single_ts(util.TAGGED_INSTANCES)
 
     def get_absolute(self, data_date, issue_frequency=None, tag=None, issue_date_from=None, issue_date_to=None):
         """ Get an absolute forecast from the INSTANCE curve
@@ -1381,6 +1955,11 @@ class TaggedInstanceCurve(BaseCurve):
         -------
         :class:`wapi.util.TS` object
         """
+        return self._run_query(self._get_absolute_query(data_date, issue_frequency, tag, issue_date_from,
+                                                        issue_date_to))
+
+    def _get_absolute_query(self, data_date, issue_frequency=None, tag=None, issue_date_from=None,
+                            issue_date_to=None):
         args = [util.make_arg('data_date', data_date)]
         if issue_frequency is not None:
             args.append(util.make_arg('issue_frequency', issue_frequency))
@@ -1389,7 +1968,71 @@ class TaggedInstanceCurve(BaseCurve):
         self._add_from_to(args, issue_date_from, issue_date_to, prefix='issue_date_')
         astr = '&'.join(args)
         url = '/api/instances/tagged/{}/absolute?{}'.format(self.id, astr)
-        result = self._load_data(url, 'Failed to find instances')
-        if result is None:
-            return result
-        return util.TS(input_dict=result, curve_type=util.TAGGED_INSTANCES)
+        return url, 'Failed to find instances', _single_ts(util.TAGGED_INSTANCES)
+
+    def iter_history(self, tags=None, issue_date_from=None, issue_date_to=None, data_from=None, data_to=None,
+                     time_zone=None, filter=None, function=None, frequency=None, output_time_zone=None,
+                     max_points_per_request=util.MAX_POINTS_PER_REQUEST):
+        """ Iterate over the instances of a TAGGED_INSTANCE curve, oldest first
+
+        Fetches the history of a forecast with data, in batches of as many
+        instances as fit within ``max_points_per_request`` data points for
+        all tags. The batch size is estimated from the size of the latest
+        instance, and a few batches are fetched in parallel ahead of the one
+        being consumed, keeping the memory use bounded.
+
+        Parameters
+        ----------
+
+        tags: str or list, optional
+            tag or tags to fetch. If None (default), all available tags are
+            fetched.
+
+        issue_date_from: time-stamp, optional
+            Limits the timerange of the issue_dates to return.
+            The time-stamp can be provided in any of the following types :
+
+            * datestring in format '%Y-%M-%DT%h:%m:%sZ',
+              eg '2017-01-01' or '2018-12-16T13:45:00Z'
+            * pandas.Timestamp object
+            * datetime.datetime object
+
+        issue_date_to: time-stamp, optional
+            Limits the timerange of the issue_dates to return.
+            The time-stamp can be provided in the same types as
+            "issue_date_from".
+
+        data_from, data_to, time_zone, filter, function, frequency, output_time_zone: optional
+            Selection and processing of the data of each instance, see
+            :meth:`wapi.curves.TaggedInstanceCurve.search_instances`.
+
+        max_points_per_request: int, optional
+            The maximum number of data points fetched in one request.
+
+        Returns
+        -------
+        generator of :class:`wapi.util.TS` objects, in issue_date and tag order.
+        """
+        if tags is None:
+            tags = self.get_tags()
+        elif isinstance(tags, basestring):
+            tags = [tags]
+        if not tags:
+            return
+        data_args = dict(data_from=data_from, data_to=data_to, time_zone=time_zone, filter=filter,
+                         function=function, frequency=frequency, output_time_zone=output_time_zone)
+        latest, instances = self._run_queries([
+            self._get_latest_query(tags=tags[0], issue_date_from=issue_date_from, issue_date_to=issue_date_to,
+                                   **data_args),
+            self._search_instances_query(tags=tags[0], issue_date_from=issue_date_from,
+                                         issue_date_to=issue_date_to)])
+        if latest is None:
+            return
+        pages = _history_pages(instances, _ts_size(latest) * len(tags), max_points_per_request,
+                               issue_date_to)
+        queries = [self._search_instances_query(tags=tags, issue_date_from=first, issue_date_to=last,
+                                                with_data=True, **data_args)
+                   for issue_dates, first, last in pages]
+        for (issue_dates, first, last), result in zip(pages, self._iter_queries(queries)):
+            for ts in _page_in_order(result, issue_dates, tags):
+                yield ts
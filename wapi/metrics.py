@@ -0,0 +1,203 @@
+#
+# Instrumentation of requests to the API
+#
+
+import bisect
+import re
+import threading
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse
+
+
+# Upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_ID = re.compile(r'/\d+(?=/|$)')
+
+# Name, type and help text of each metric
+_METRICS = (
+    ('wapi_requests_total', 'counter', 'Requests sent to the API, by endpoint, method and status.'),
+    ('wapi_request_seconds', 'histogram', 'Time waiting for the API, per attempt.'),
+    ('wapi_stage_seconds', 'histogram',
+     'Time spent in each stage of a call: auth, decode (of the JSON response) and convert (to TS).'),
+    ('wapi_response_bytes_total', 'counter', 'Bytes received from the API.'),
+    ('wapi_retries_total', 'counter', 'Requests retried.'),
+    ('wapi_points_total', 'counter', 'Data points received.'),
+)
+
+
+def endpoint(url):
+    """The endpoint of a URL: its path, with curve ids replaced by {id}"""
+    return _ID.sub('/{id}', urlparse(url).path) or '/'
+
+
+def count_points(result):
+    """The number of data points in a decoded data response"""
+    items = result if isinstance(result, list) else [result]
+    count = 0
+    for item in items:
+        points = item.get('points') if isinstance(item, dict) else None
+        if isinstance(points, tuple):
+            count += len(points[0])
+        elif points is not None:
+            count += len(points)
+    return count
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=None):
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v)) for k, v in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metrics(object):
+    """
+    Collects metrics on the calls made by a session.
+
+    Give it as ``metrics`` to :class:`wapi.session.Session` to record, per
+    endpoint (the URL path with curve ids replaced by ``{id}``):
+
+    * ``wapi_requests_total``: requests, by method and status code, or
+      ``timeout``
+    * ``wapi_request_seconds``: histogram of the time waiting for each
+      attempt of a request
+    * ``wapi_stage_seconds``: histogram of the time spent validating
+      authentication (``auth``), decoding the JSON (``decode``) and
+      building :class:`wapi.util.TS` objects (``convert``)
+    * ``wapi_response_bytes_total``, ``wapi_retries_total`` and
+      ``wapi_points_total``
+
+    :meth:`to_prometheus` gives them in the Prometheus text format, and
+    :meth:`serve` makes them available for scraping over HTTP.  To send
+    them elsewhere, override the ``observe_*`` methods.
+
+    Parameters
+    ----------
+
+    buckets: tuple, optional
+        Upper bounds of the histogram buckets, in seconds.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def _inc(self, name, labels, value=1):
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def _observe(self, name, labels, seconds):
+        key = (name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            histogram[0][bisect.bisect_left(self.buckets, seconds)] += 1
+            histogram[1] += seconds
+
+    def observe_request(self, endpoint, method, status, seconds, nbytes=None):
+        """Record an attempt of a request, with its status code (or 'timeout')"""
+        self._inc('wapi_requests_total', (('endpoint', endpoint), ('method', method), ('status', str(status))))
+        self._observe('wapi_request_seconds', (('endpoint', endpoint), ('method', method)), seconds)
+        if nbytes:
+            self._inc('wapi_response_bytes_total', (('endpoint', endpoint),), nbytes)
+
+    def observe_retry(self, endpoint):
+        """Record the retry of a request"""
+        self._inc('wapi_retries_total', (('endpoint', endpoint),))
+
+    def observe_stage(self, stage, endpoint, seconds):
+        """Record the time spent in a stage of a call: auth, decode or convert"""
+        self._observe('wapi_stage_seconds', (('stage', stage), ('endpoint', endpoint)), seconds)
+
+    def observe_points(self, endpoint, count):
+        """Record the number of data points received"""
+        self._inc('wapi_points_total', (('endpoint', endpoint),), count)
+
+    def get(self, name, **labels):
+        """
+        The value of a counter, or the number of observations in a
+        histogram, summed over the series matching the labels given.
+        """
+        with self._lock:
+            total = 0
+            for (key_name, key_labels), value in self._counters.items():
+                if key_name == name and set(labels.items()) <= set(key_labels):
+                    total += value
+            for (key_name, key_labels), (counts, _) in self._histograms.items():
+                if key_name == name and set(labels.items()) <= set(key_labels):
+                    total += sum(counts)
+            return total
+
+    def clear(self):
+        """Reset all metrics"""
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def to_prometheus(self):
+        """The metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for name, kind, text in _METRICS:
+                lines.append('# HELP {} {}'.format(name, text))
+                lines.append('# TYPE {} {}'.format(name, kind))
+                if kind == 'counter':
+                    for (key_name, labels), value in sorted(self._counters.items()):
+                        if key_name == name:
+                            lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(value)))
+                    continue
+                for (key_name, labels), (counts, total) in sorted(self._histograms.items()):
+                    if key_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(self.buckets + (float('inf'),), counts):
+                        cumulative += count
+                        lines.append('{}_bucket{} {}'.format(name, _format_labels(labels, ('le', _format_value(bound))),
+                                                             cumulative))
+                    lines.append('{}_sum{} {}'.format(name, _format_labels(labels), _format_value(total)))
+                    lines.append('{}_count{} {}'.format(name, _format_labels(labels), cumulative))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port=0, addr='127.0.0.1'):
+        """
+        Serve the metrics in the Prometheus text format over HTTP, from a
+        background thread.  Returns the server; its ``server_port`` is the
+        port used, and ``shutdown()`` stops it.
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.to_prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = HTTPServer((addr, port), Handler)
+        worker = threading.Thread(target=server.serve_forever)
+        worker.daemon = True
+        worker.start()
+        return server
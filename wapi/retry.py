@@ -0,0 +1,142 @@
+#
+# Retrying failed requests
+#
+
+import datetime
+import email.utils
+import random
+import threading
+
+
+RETRY_STATUSES = frozenset([408, 429])  # Retried as well as all 5xx responses
+
+
+def retry_after(response):
+    """
+    The delay asked for by the Retry-After header of a response, in
+    seconds, or None if there is none.
+    """
+    headers = getattr(response, 'headers', None)
+    value = headers.get('Retry-After') if headers is not None else None
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (date - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+class RetryPolicy(object):
+    """
+    Decides which failed requests are retried, and how long to wait first.
+
+    Timeouts, 408, 429 and 5xx responses are retried, with exponential
+    backoff: the n'th retry waits up to ``backoff * 2**n`` seconds, at most
+    ``max_delay``.  With jitter, the actual wait is random within that
+    limit, so that many clients failing at once do not all retry at the
+    same time.  A longer wait asked for by a Retry-After header is
+    honored, but if it is longer than ``max_delay`` the response is
+    returned without retrying.
+
+    Retries are limited by a budget shared by all requests of the session.
+    Each request adds ``budget_ratio`` to it, up to ``budget``, and each
+    retry takes one from it.  When the API is down, this keeps the extra
+    load from retries to a fraction of the normal traffic.
+
+    The counters ``requests``, ``retries``, ``exhausted`` (failures
+    returned after all retries were used) and ``throttled`` (failures
+    returned because the budget was used up) are kept, see :meth:`stats`.
+
+    Parameters
+    ----------
+
+    retries: int, optional
+        The number of times to retry a request.
+    backoff: float, optional
+        The wait before the first retry, in seconds.
+    max_delay: float, optional
+        The longest wait before a retry, in seconds.
+    jitter: bool, optional
+        Wait a random time up to the backoff delay.
+    budget: float, optional
+        The most retries available at once, or None for no budget.
+    budget_ratio: float, optional
+        The number of retries earned by each request.
+    """
+
+    def __init__(self, retries=4, backoff=0.5, max_delay=30.0, jitter=True, budget=10.0, budget_ratio=0.2):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.budget = budget
+        self.budget_ratio = budget_ratio
+        self.requests = 0
+        self.retries_taken = 0
+        self.exhausted = 0
+        self.throttled = 0
+        self._tokens = budget
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_retryable(response=None, error=None):
+        """Whether a request which failed with a response or an error may be retried"""
+        if error is not None:
+            return True
+        if response is None:
+            return False
+        return response.status_code in RETRY_STATUSES or 500 <= response.status_code < 600
+
+    def start(self):
+        """Count a request, adding to the retry budget"""
+        with self._lock:
+            self.requests += 1
+            if self.budget is not None:
+                self._tokens = min(self.budget, self._tokens + self.budget_ratio)
+
+    def retry_delay(self, attempt, response=None, error=None, retries=None):
+        """
+        The number of seconds to wait before retrying a request for the
+        (attempt + 1)'th time, after failing with a response or an error.
+        Returns None if the request should not be retried.  retries
+        overrides the number of retries of the policy.
+        """
+        if not self.is_retryable(response, error):
+            return None
+        if retries is None:
+            retries = self.retries
+        if attempt >= retries:
+            with self._lock:
+                self.exhausted += 1
+            return None
+        delay = min(self.max_delay, self.backoff * 2 ** attempt)
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        wait = retry_after(response)
+        if wait is not None:
+            if wait > self.max_delay:
+                with self._lock:
+                    self.exhausted += 1
+                return None
+            delay = max(delay, wait)
+        with self._lock:
+            if self.budget is not None:
+                if self._tokens < 1:
+                    self.throttled += 1
+                    return None
+                self._tokens -= 1
+            self.retries_taken += 1
+        return delay
+
+    def stats(self):
+        """The counters of the policy, as a dict"""
+        with self._lock:
+            return {'requests': self.requests, 'retries': self.retries_taken,
+                    'exhausted': self.exhausted, 'throttled': self.throttled}
@@ -4,19 +4,24 @@ except ImportError:
     from urlparse import urljoin
 
 import requests
-import json
 import time
 import warnings
+from concurrent import futures
 from past.types import basestring
 import configparser
 
-from . import auth, curves, events, util
+from . import auth, cache, codec, curves, events, retry, util
+from .metrics import Metrics, endpoint
 from .util import CurveException
 
 
-RETRY_COUNT = 4    # Number of times to retry
-RETRY_DELAY = 0.5  # Delay between retried calls, in seconds.
+RETRY_COUNT = 4    # Default number of times to retry
+RETRY_DELAY = 0.5  # Default delay before the first retry, in seconds.
 TIMEOUT = 300      # Default timeout for web calls, in seconds.
+POOL_CONNECTIONS = 10  # Default number of hosts to keep connections to.
+POOL_MAXSIZE = 32  # Default number of connections kept to each host.
+MAX_WORKERS = 8    # Default number of parallel requests in bulk calls.
+MAX_URL_LENGTH = 4000  # Longest URL used when searching for many curves at once.
 API_URLBASE = 'https://api.volueinsight.com'
 AUTH_URLBASE = 'https://auth.volueinsight.com'
 
@@ -29,6 +34,11 @@ class MetadataException(Exception):
     pass
 
 
+class SessionException(Exception):
+    """Raised when a session does not support the call made"""
+    pass
+
+
 class Session(object):
     """ Establish a connection to Volue Insight API
 
@@ -55,7 +65,51 @@ class Session(object):
     auth_urlbase: url
         Location of Volue Insight authentication service
     timeout: float
-        Timeout for REST calls, in seconds
+        Timeout for REST calls, in seconds.  This is the read timeout if
+        ``connect_timeout`` is given.
+    connect_timeout: float
+        Timeout for connecting to the API, in seconds.  By default the
+        ``timeout`` is used.
+    pool_connections: int
+        Number of hosts to keep connections to.
+    pool_maxsize: int
+        Number of connections kept to each host.  Raise this when more
+        threads than this share the session, e.g. with a large
+        ``max_workers``, so that each gets its own connection.
+    keep_alive: bool
+        Keep connections open between requests.  Defaults to True.
+    metrics: bool or object
+        Records the latency, status codes, sizes, retries and decode times
+        of the calls made, see :class:`wapi.metrics.Metrics`.  If True, a
+        new :class:`~wapi.metrics.Metrics` is used.
+    stream_data: bool
+        Decode the data responses as they are read, with the points parsed
+        straight into NumPy arrays.  This keeps the memory use down when
+        reading large series.
+    json_codec: str or object
+        JSON codec used for request and response bodies: 'json' (the
+        default), 'orjson', 'auto' to use orjson if installed, or an object
+        with ``dumps`` and ``loads`` methods, see :mod:`wapi.codec`.
+    data_cache: str or object
+        Cache for the data read by :meth:`wapi.curves.TimeSeriesCurve.get_data`
+        and :meth:`wapi.curves.TaggedCurve.get_data`, see :mod:`wapi.cache`.
+        If a directory name is given, a :class:`wapi.cache.DiskCache` in
+        that directory is used.
+    metadata_cache: bool, str or object
+        Cache for the curve metadata looked up by :meth:`get_curve` and
+        :meth:`search`, see :class:`wapi.cache.MetadataCache`.  If True, an
+        in-memory cache is used, and if a file name is given, the cache is
+        kept in that file between runs.
+    token_cache: str or object
+        File sharing the OAuth token between processes, or a
+        :class:`wapi.auth.TokenCache`.  Processes using the same file only
+        log in when the token there is about to expire.  It can also be
+        given as ``token_cache`` in the ``OAuth`` section of the config
+        file.
+    retry_policy: object
+        The :class:`wapi.retry.RetryPolicy` deciding which failed requests
+        are retried and when.  The default retries ``RETRY_COUNT`` times,
+        with exponential backoff from ``RETRY_DELAY`` seconds.
 
     Returns
     -------
@@ -64,10 +118,37 @@ class Session(object):
     """
 
     def __init__(self, urlbase=None, config_file=None, client_id=None, client_secret=None,
-                 auth_urlbase=None, timeout=None, retry_update_auth=False):
+                 auth_urlbase=None, timeout=None, retry_update_auth=False, stream_data=False,
+                 json_codec=None, data_cache=None, metadata_cache=None, token_cache=None,
+                 retry_policy=None, connect_timeout=None, pool_connections=None, pool_maxsize=None,
+                 keep_alive=None, metrics=None):
         self.urlbase = API_URLBASE
         self.auth = None
         self.timeout = TIMEOUT
+        self.connect_timeout = None
+        self.pool_connections = POOL_CONNECTIONS
+        self.pool_maxsize = POOL_MAXSIZE
+        self.keep_alive = True
+        self.max_workers = MAX_WORKERS
+        self.stream_data = stream_data
+        self.json_codec = codec.get_codec(json_codec)
+        if isinstance(data_cache, basestring):
+            data_cache = cache.DiskCache(data_cache)
+        self.data_cache = data_cache
+        if metadata_cache is True:
+            metadata_cache = cache.MetadataCache()
+        elif isinstance(metadata_cache, basestring):
+            metadata_cache = cache.MetadataCache(metadata_cache)
+        self.metadata_cache = metadata_cache or None
+        if isinstance(token_cache, basestring):
+            token_cache = auth.TokenCache(token_cache)
+        self.token_cache = token_cache
+        if retry_policy is None:
+            retry_policy = retry.RetryPolicy(retries=RETRY_COUNT, backoff=RETRY_DELAY)
+        self.retry_policy = retry_policy
+        if metrics is True:
+            metrics = Metrics()
+        self.metrics = metrics or None
         self._session = requests.Session()
         self.retry_update_auth = retry_update_auth
         if config_file is not None:
@@ -78,6 +159,30 @@ class Session(object):
             self.urlbase = urlbase
         if timeout is not None:
             self.timeout = timeout
+        if connect_timeout is not None:
+            self.connect_timeout = connect_timeout
+        if pool_connections is not None:
+            self.pool_connections = pool_connections
+        if pool_maxsize is not None:
+            self.pool_maxsize = pool_maxsize
+        if keep_alive is not None:
+            self.keep_alive = keep_alive
+        self._mount_adapters()
+
+    def _mount_adapters(self):
+        # Set up the connection pools of the underlying requests session
+        for prefix in ('https://', 'http://'):
+            self._session.mount(prefix, requests.adapters.HTTPAdapter(pool_connections=self.pool_connections,
+                                                                      pool_maxsize=self.pool_maxsize))
+        if self.keep_alive:
+            self._session.headers.pop('Connection', None)
+        else:
+            self._session.headers['Connection'] = 'close'
+
+    def _request_timeout(self):
+        if self.connect_timeout is None:
+            return self.timeout
+        return (self.connect_timeout, self.timeout)
 
     def read_config_file(self, config_file):
         """Set up according to configuration file with hosts and access details"""
@@ -100,10 +205,20 @@ class Session(object):
             client_id = config.get(auth_type, 'id')
             client_secret = config.get(auth_type, 'secret')
             auth_urlbase = config.get(auth_type, 'auth_urlbase', fallback=AUTH_URLBASE)
-            self.auth = auth.OAuth(self, client_id, client_secret, auth_urlbase)
+            token_cache = config.get(auth_type, 'token_cache', fallback=None)
+            if token_cache is not None and self.token_cache is None:
+                self.token_cache = auth.TokenCache(token_cache)
+            self.auth = self._make_auth(client_id, client_secret, auth_urlbase)
         timeout = config.get('common', 'timeout', fallback=None)
         if timeout is not None:
             self.timeout = float(timeout)
+        connect_timeout = config.get('common', 'connect_timeout', fallback=None)
+        if connect_timeout is not None:
+            self.connect_timeout = float(connect_timeout)
+        self.pool_connections = config.getint('common', 'pool_connections', fallback=self.pool_connections)
+        self.pool_maxsize = config.getint('common', 'pool_maxsize', fallback=self.pool_maxsize)
+        self.keep_alive = config.getboolean('common', 'keep_alive', fallback=self.keep_alive)
+        self._mount_adapters()
 
     def configure(self, client_id, client_secret, auth_urlbase=None):
         """Programmatically set authentication parameters"""
@@ -111,7 +226,10 @@ class Session(object):
             raise ConfigException('Session configuration is already done')
         if auth_urlbase is None:
             auth_urlbase = AUTH_URLBASE
-        self.auth = auth.OAuth(self, client_id, client_secret, auth_urlbase)
+        self.auth = self._make_auth(client_id, client_secret, auth_urlbase)
+
+    def _make_auth(self, client_id, client_secret, auth_urlbase):
+        return auth.OAuth(self, client_id, client_secret, auth_urlbase, token_cache=self.token_cache)
 
     def get_curve(self, id=None, name=None):
         """Getting a curve object
@@ -137,8 +255,16 @@ class Session(object):
             :class:`~wapi.curves.InstanceCurve`,
             :class:`~wapi.curves.TaggedInstanceCurve`.
         """
+        url = self._get_curve_url(id, name)
+        metadata = self._cached_metadata(self._curve_cache_key(id, name))
+        if metadata is not None:
+            return self._build_curve(metadata, store=False)
+        response = self.data_request('GET', self.urlbase, url)
+        return self.handle_single_curve_response(response)
+
+    def _get_curve_url(self, id=None, name=None):
         if id is not None:
-            warnings.warn("Looking up a curve by ID will be removed in the future.", FutureWarning, stacklevel=2)
+            warnings.warn("Looking up a curve by ID will be removed in the future.", FutureWarning, stacklevel=3)
         if id is None and name is None:
             raise MetadataException('No curve specified')
 
@@ -146,8 +272,7 @@ class Session(object):
             arg = util.make_arg('id', id)
         else:
             arg = util.make_arg('name', name)
-        response = self.data_request('GET', self.urlbase, '/api/curves/get?{}'.format(arg))
-        return self.handle_single_curve_response(response)
+        return '/api/curves/get?{}'.format(arg)
 
     def search(self, query=None, id=None, name=None, commodity=None, category=None, area=None, station=None,
                source=None, scenario=None, unit=None, time_zone=None, version=None, frequency=None, data_type=None,
@@ -262,6 +387,37 @@ class Session(object):
             :class:`~wapi.curves.InstanceCurve`,
             :class:`~wapi.curves.TaggedInstanceCurve`.
         """
+        url = self._search_url(query=query, id=id, name=name, commodity=commodity, category=category,
+                               area=area, station=station, source=source, scenario=scenario, unit=unit,
+                               time_zone=time_zone, version=version, frequency=frequency,
+                               data_type=data_type, curve_state=curve_state, modified_since=modified_since,
+                               only_accessible=only_accessible)
+        metadata_list = self._cached_metadata(self._search_cache_key(url))
+        if metadata_list is not None:
+            return [self._build_curve(metadata, store=False) for metadata in metadata_list]
+        # Now run the search, and try to produce a list of curves
+        response = self.data_request('GET', self.urlbase, url)
+        return self.handle_multi_curve_response(response, url)
+
+    def _curve_cache_key(self, id=None, name=None):
+        if self.metadata_cache is None:
+            return None
+        return self.metadata_cache.curve_key(id, name)
+
+    def _search_cache_key(self, url):
+        if self.metadata_cache is None:
+            return None
+        return self.metadata_cache.search_key(url)
+
+    def _cached_metadata(self, key):
+        if key is None:
+            return None
+        return self.metadata_cache.get(key)
+
+    def _search_url(self, query=None, id=None, name=None, commodity=None, category=None, area=None,
+                    station=None, source=None, scenario=None, unit=None, time_zone=None, version=None,
+                    frequency=None, data_type=None, curve_state=None, modified_since=None,
+                    only_accessible=None):
         search_terms = {
             'query': query,
             'id': id,
@@ -282,7 +438,7 @@ class Session(object):
             'only_accessible': only_accessible,
         }
         if id is not None:
-            warnings.warn("Searching for curves by ID will be removed in the future.", FutureWarning, stacklevel=2)
+            warnings.warn("Searching for curves by ID will be removed in the future.", FutureWarning, stacklevel=3)
         args = []
         astr = ''
         for key, val in search_terms.items():
@@ -291,9 +447,157 @@ class Session(object):
             args.append(util.make_arg(key, val))
         if len(args):
             astr = "?{}".format("&".join(args))
-        # Now run the search, and try to produce a list of curves
-        response = self.data_request('GET', self.urlbase, '/api/curves{}'.format(astr))
-        return self.handle_multi_curve_response(response)
+        return '/api/curves{}'.format(astr)
+
+    def get_curves(self, names, max_workers=None):
+        """
+        Get the curves for a list of names.
+
+        The names are looked up with as few searches as possible, each with
+        a URL of at most ``MAX_URL_LENGTH`` characters, running in parallel
+        over a pool of ``max_workers`` threads.  Names are matched without
+        regard to case.
+
+        Parameters
+        ----------
+
+        names: list
+            list of curve names
+
+        max_workers: int, optional
+            number of searches to run in parallel, defaults to the
+            ``max_workers`` attribute of the session.
+
+        Returns
+        -------
+        (list, list)
+            The curves found, in the order of the names, and the names not
+            found.
+        """
+        found, batches = self._curves_to_search(names)
+        if len(batches) == 1:
+            found.extend(self.search(name=batches[0]))
+        elif batches:
+            with futures.ThreadPoolExecutor(max_workers=max_workers or self.max_workers) as executor:
+                for result in executor.map(lambda batch: self.search(name=batch), batches):
+                    found.extend(result)
+        return self._order_curves(names, found)
+
+    def _curves_to_search(self, names):
+        # Split the names into the curves already in the metadata cache,
+        # and batches of names to search for, each giving a URL of at most
+        # MAX_URL_LENGTH characters.
+        found = []
+        batches = []
+        seen = set()
+        limit = MAX_URL_LENGTH - len(urljoin(self.urlbase, self._search_url())) - 1
+        size = 0
+        for name in names:
+            if name.lower() in seen:
+                continue
+            seen.add(name.lower())
+            metadata = self._cached_metadata(self._curve_cache_key(name=name))
+            if metadata is not None:
+                found.append(self._build_curve(metadata, store=False))
+                continue
+            length = len(util.make_arg('name', name)) + 1
+            if not batches or size + length > limit:
+                batches.append([])
+                size = 0
+            batches[-1].append(name)
+            size += length
+        return found, batches
+
+    @staticmethod
+    def _order_curves(names, found):
+        by_name = {c.name.lower(): c for c in found}
+        curve_list = []
+        missing = []
+        for name in names:
+            curve = by_name.get(name.lower())
+            if curve is None:
+                missing.append(name)
+            else:
+                curve_list.append(curve)
+        return curve_list, missing
+
+    def get_data_many(self, curves_or_names, data_from=None, data_to=None, max_workers=None, **kwargs):
+        """
+        Fetch data for many curves concurrently.
+
+        Curve names are resolved with :meth:`get_curves`, and the data
+        requests are run over a pool of ``max_workers`` threads sharing
+        the connections of this session.  A failure for one curve does not
+        abort the others, the exception is returned instead.
+
+        Parameters
+        ----------
+
+        curves_or_names: list
+            list of curve objects and/or curve names. Only curves with a
+            ``get_data`` method (time series and tagged curves) are supported.
+
+        data_from: time-stamp, optional
+            start date (and time) of data to be fetched, see
+            :meth:`wapi.curves.TimeSeriesCurve.get_data`.
+
+        data_to: time-stamp, optional
+            end date (and time) of data to be fetched, see
+            :meth:`wapi.curves.TimeSeriesCurve.get_data`.
+
+        max_workers: int, optional
+            number of requests to run in parallel, defaults to the
+            ``max_workers`` attribute of the session.
+
+        kwargs:
+            further arguments passed on to ``get_data`` for each curve,
+            e.g. ``function`` and ``frequency``.
+
+        Returns
+        -------
+        (dict, dict)
+            Two dicts keyed by curve name, the first holding the result of
+            ``get_data`` for each successful curve, the second holding the
+            exception raised for each failed curve.
+        """
+        results = {}
+        names = [c for c in curves_or_names if isinstance(c, basestring)]
+        found = self.get_curves(names, max_workers)[0] if names else []
+        curve_list, errors = self._match_curves(curves_or_names, found)
+
+        def fetch(curve):
+            self._check_get_data(curve)
+            return curve.get_data(data_from=data_from, data_to=data_to, **kwargs)
+
+        with futures.ThreadPoolExecutor(max_workers=max_workers or self.max_workers) as executor:
+            jobs = {name: executor.submit(fetch, curve) for name, curve in curve_list}
+            for name, job in jobs.items():
+                try:
+                    results[name] = job.result()
+                except Exception as e:
+                    errors[name] = e
+        return results, errors
+
+    @staticmethod
+    def _match_curves(curves_or_names, found):
+        # Pair up the requested names with the curves found, giving a list of
+        # (name, curve) and a dict of errors for the names not found.
+        curve_list = []
+        errors = {}
+        by_name = {c.name.lower(): c for c in found}
+        for c in curves_or_names:
+            if not isinstance(c, basestring):
+                curve_list.append((getattr(c, 'name', str(c.id)), c))
+            elif c.lower() in by_name:
+                curve_list.append((c, by_name[c.lower()]))
+            else:
+                errors[c] = MetadataException('Curve {} not found'.format(c))
+        return curve_list, errors
+
+    @staticmethod
+    def _check_get_data(curve):
+        if not hasattr(curve, 'get_data'):
+            raise CurveException('Curve type {} does not support get_data'.format(curve.curve_type))
 
     def make_curve(self, id, curve_type):
         """Return a mostly uninitialized curve object of the correct type.
@@ -402,11 +706,17 @@ class Session(object):
 
     def get_attribute(self, attribute):
         """Get valid values for an attribute."""
+        response = self.data_request('GET', self.urlbase, self._attribute_url(attribute))
+        return self._handle_attribute_response(attribute, response)
+
+    def _attribute_url(self, attribute):
         if attribute not in self._attributes:
             raise MetadataException('Attribute {} is not valid'.format(attribute))
-        response = self.data_request('GET', self.urlbase, '/api/{}'.format(attribute))
+        return '/api/{}'.format(attribute)
+
+    def _handle_attribute_response(self, attribute, response):
         if response.status_code == 200:
-            return response.json()
+            return self.json_codec.loads(response.content)
         elif response.status_code == 204:
             return None
         raise MetadataException('Failed loading {}: {}'.format(attribute,
@@ -421,39 +731,48 @@ class Session(object):
 
     _meta_keys = ('id', 'name', 'frequency', 'time_zone', 'curve_type')
 
-    def _build_curve(self, metadata):
+    def _build_curve(self, metadata, store=True):
         for key in self._meta_keys:
             if key not in metadata:
                 raise MetadataException('Mandatory key {} not found in metadata'.format(key))
         curve_id = int(metadata['id'])
         if metadata['curve_type'] in self._curve_types:
             c = self._curve_types[metadata['curve_type']](curve_id, metadata, self)
+            if store and self.metadata_cache is not None:
+                self.metadata_cache.add_curve(metadata)
             return c
         raise CurveException('Unknown curve type ({})'.format(metadata['curve_type']))
 
-    def _get_auth_header_with_retry(self, databytes, retries=RETRY_COUNT):
-        try:
-            self.auth.validate_auth()
-            return self.auth.get_headers(databytes)
-        except Exception as e:
-            if retries <= 0:
-                raise e
-            if RETRY_DELAY > 0:
-                time.sleep(RETRY_DELAY)
-            return self._get_auth_header_with_retry(databytes, retries - 1)
-
-    def _validate_auth(self, data, rawdata):
-        headers = {}
-
+    def _get_auth_header_with_retry(self, databytes, retries=None):
+        attempt = 0
+        while True:
+            try:
+                self.auth.validate_auth()
+                return self.auth.get_headers(databytes)
+            except Exception as e:
+                delay = self.retry_policy.retry_delay(attempt, error=e, retries=retries)
+                if delay is None:
+                    raise
+            attempt += 1
+            if delay > 0:
+                time.sleep(delay)
+
+    def _encode_data(self, data, rawdata):
         databytes = None
         if data is not None:
-            headers['content-type'] = 'application/json'
             if isinstance(data, basestring):
                 databytes = data.encode()
             else:
-                databytes = json.dumps(data).encode()
+                databytes = self.json_codec.dumps(data)
         if data is None and rawdata is not None:
             databytes = rawdata
+        return databytes
+
+    def _validate_auth(self, data, databytes):
+        headers = {}
+
+        if data is not None:
+            headers['content-type'] = 'application/json'
         if self.auth is not None:
             # Beta-feature: Only update auth with retry if explicitly requested
             if self.retry_update_auth:
@@ -466,55 +785,82 @@ class Session(object):
         return headers
     
     def send_data_request(self, req_type, urlbase, url, data=None, rawdata=None, headers=None, authval=None,
-                     stream=False, retries=RETRY_COUNT):
+                     stream=False, retries=None):
         if not urlbase:
             urlbase = self.urlbase
         longurl = urljoin(urlbase, url)
 
-        databytes = None
-        if data is not None:
-            if isinstance(data, basestring):
-                databytes = data.encode()
-            else:
-                databytes = json.dumps(data).encode()
-        if data is None and rawdata is not None:
-            databytes = rawdata
-        timeout = None
-        try:
-            res = self._session.request(method=req_type, url=longurl, data=databytes,
-                                        headers=headers, auth=authval, stream=stream, timeout=self.timeout)
-        except requests.exceptions.Timeout as e:
-            timeout = e
+        databytes = self._encode_data(data, rawdata)
+        self.retry_policy.start()
+        attempt = 0
+        while True:
+            timeout = None
             res = None
-        if (timeout is not None or (500 <= res.status_code < 600) or res.status_code == 408) and retries > 0:
-            if RETRY_DELAY > 0:
-                time.sleep(RETRY_DELAY)
-            return self.send_data_request(req_type, urlbase, url, data, rawdata, headers, authval, stream, retries-1)
+            start = time.time()
+            try:
+                res = self._session.request(method=req_type, url=longurl, data=databytes,
+                                            headers=headers, auth=authval, stream=stream,
+                                            timeout=self._request_timeout())
+            except requests.exceptions.Timeout as e:
+                timeout = e
+            if self.metrics is not None:
+                self._observe_request(req_type, longurl, res, stream, time.time() - start)
+            delay = self.retry_policy.retry_delay(attempt, res, timeout, retries)
+            if delay is None:
+                break
+            if res is not None:
+                # Give the connection back to the pool, a streamed body is
+                # never read
+                res.close()
+            if self.metrics is not None:
+                self.metrics.observe_retry(endpoint(longurl))
+            attempt += 1
+            if delay > 0:
+                time.sleep(delay)
         if timeout is not None:
             raise timeout
         return res
 
+    def _observe_request(self, req_type, longurl, res, stream, seconds):
+        if res is None:
+            self.metrics.observe_request(endpoint(longurl), req_type, 'timeout', seconds)
+            return
+        if stream:
+            # The body is not read yet, go by the header
+            nbytes = int(getattr(res, 'headers', {}).get('Content-Length') or 0)
+        else:
+            nbytes = len(res.content or b'')
+        self.metrics.observe_request(endpoint(longurl), req_type, res.status_code, seconds, nbytes)
+
     def data_request(self, req_type, urlbase, url, data=None, rawdata=None, authval=None,
-                     stream=False, retries=RETRY_COUNT):
+                     stream=False, retries=None):
         """Run a call to the backend, dealing with authentication etc."""
-        headers = self._validate_auth(data, rawdata)
-        res = self.send_data_request(req_type, urlbase, url, data, rawdata, headers, authval, stream, retries)
+        # Encode the body once, for both the authentication and the request
+        databytes = self._encode_data(data, rawdata)
+        start = time.time()
+        headers = self._validate_auth(data, databytes)
+        if self.metrics is not None:
+            self.metrics.observe_stage('auth', endpoint(url), time.time() - start)
+        res = self.send_data_request(req_type, urlbase, url, None, databytes, headers, authval, stream, retries)
         return res
 
     def handle_single_curve_response(self, response):
         if not response.ok:
             raise MetadataException('Failed to load curve: {}'
                                     .format(response.content.decode()))
-        metadata = response.json()
+        metadata = self.json_codec.loads(response.content)
         return self._build_curve(metadata)
 
-    def handle_multi_curve_response(self, response):
+    def handle_multi_curve_response(self, response, url=None):
         if not response.ok:
             raise MetadataException('Curve search failed: {}'
                                     .format(response.content.decode()))
-        metadata_list = response.json()
+        metadata_list = self.json_codec.loads(response.content)
 
         result = []
         for metadata in metadata_list:
             result.append(self._build_curve(metadata))
+        key = self._search_cache_key(url) if url is not None else None
+        if key is not None:
+            self.metadata_cache.put(key, metadata_list)
         return result
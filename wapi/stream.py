@@ -0,0 +1,173 @@
+#
+# Streaming decoding of data responses
+#
+
+import json
+import re
+
+import numpy as np
+
+
+CHUNK_SIZE = 256 * 1024  # Size of the chunks read from the response
+
+_KEY = b'"points"'
+_STRING = re.compile(br'"(?:[^"\\]|\\.)*"')
+_AFTER_KEY = re.compile(br'\s*:\s*\[')
+_PARTIAL_AFTER_KEY = re.compile(br'\s*(:\s*)?\Z')
+_POINTS_END = re.compile(br'\]\s*\]')
+_IGNORED = b'[] \t\r\n'
+
+
+class _Buffer(object):
+    # A growing float64 array of [timestamp, value] rows
+    def __init__(self, capacity=4096):
+        self.data = np.empty((capacity, 2), dtype=np.float64)
+        self.size = 0
+
+    def extend(self, rows):
+        end = self.size + len(rows)
+        if end > len(self.data):
+            data = np.empty((max(end, 2 * len(self.data)), 2), dtype=np.float64)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+        self.data[self.size:end] = rows
+        self.size = end
+
+    def arrays(self):
+        rows = self.data[:self.size]
+        return rows[:, 0].astype(np.int64), np.ascontiguousarray(rows[:, 1])
+
+
+class PointsDecoder(object):
+    """
+    Incremental decoder for the JSON responses holding time series data.
+
+    The ``points`` arrays are parsed into NumPy arrays as the data arrives,
+    and replaced by a ``(timestamps, values)`` tuple of arrays in the
+    decoded result, ready to be given to :class:`wapi.util.TS`.  Everything
+    else is decoded with loads when the document is complete.
+    """
+
+    def __init__(self, loads=json.loads):
+        self._loads = loads
+        self._meta = []
+        self._unscanned = []
+        self._tail = b''
+        self._points = []
+        self._pending = b''
+        self._buffer = None
+
+    def feed(self, data):
+        data = self._pending + data
+        self._pending = b''
+        while data:
+            if self._buffer is None:
+                data = self._feed_meta(data)
+            else:
+                data = self._feed_points(data)
+
+    def close(self):
+        if self._buffer is not None:
+            raise ValueError('Points have unexpected contents')
+        self._meta.extend(self._unscanned)
+        self._meta.append(self._pending)
+        result = self._loads(b''.join(self._meta))
+        if isinstance(result, list):
+            for item in result:
+                self._insert_points(item)
+        else:
+            self._insert_points(result)
+        return result
+
+    def _insert_points(self, item):
+        if isinstance(item, dict):
+            index = item.get('points')
+            if isinstance(index, int) and not isinstance(index, bool):
+                item['points'] = self._points[index]
+
+    def _feed_meta(self, data):
+        # Pass everything on to the metadata, until a "points" key is found.
+        # Returns the data not used, or None if more data is needed.  The
+        # data always starts outside of a string, and is only scanned for
+        # strings once it may hold the key.
+        if _KEY not in data and _KEY not in self._tail + data[:len(_KEY)]:
+            self._unscanned.append(data)
+            self._tail = (self._tail + data)[-len(_KEY):]
+            return None
+        data = b''.join(self._unscanned) + data
+        self._unscanned = []
+        self._tail = b''
+        pos = 0
+        while True:
+            quote = data.find(b'"', pos)
+            if quote < 0:
+                self._meta.append(data)
+                return None
+            match = _STRING.match(data, quote)
+            if match is None:
+                # The string continues in the next chunk
+                return self._wait(data, quote)
+            pos = match.end()
+            if match.group() != _KEY:
+                continue
+            after = _AFTER_KEY.match(data, pos)
+            if after is None:
+                if _PARTIAL_AFTER_KEY.match(data, pos):
+                    return self._wait(data, quote)
+                continue
+            self._meta.append(data[:pos])
+            self._meta.append(':{}'.format(len(self._points)).encode())
+            self._buffer = _Buffer()
+            return data[after.end():]
+
+    def _feed_points(self, data):
+        # Parse the rows of a points array, until the end of it.  Returns
+        # the data after the array, or None if more data is needed.
+        if data.lstrip().startswith(b']'):
+            # End of the array, after the last row or with no rows at all
+            return self._end_points(data[data.index(b']') + 1:])
+        end = _POINTS_END.search(data)
+        if end is not None:
+            self._parse_rows(data[:end.start() + 1])
+            return self._end_points(data[end.end():])
+        last = data.rfind(b']')
+        if last >= 0:
+            self._parse_rows(data[:last + 1])
+        self._pending = data[last + 1:]
+        return None
+
+    def _end_points(self, data):
+        self._points.append(self._buffer.arrays())
+        self._buffer = None
+        return data
+
+    def _parse_rows(self, data):
+        fields = data.replace(b'null', b'nan').translate(None, _IGNORED).strip(b',')
+        if not fields:
+            return
+        try:
+            rows = np.array(fields.split(b','), dtype=np.float64)
+        except ValueError:
+            raise ValueError('Points have unexpected contents')
+        # Each row is opened by a bracket, and has two fields
+        if len(rows) != 2 * data.count(b'['):
+            raise ValueError('Points have unexpected contents')
+        self._buffer.extend(rows.reshape((-1, 2)))
+
+    def _wait(self, data, pos):
+        self._meta.append(data[:pos])
+        self._pending = data[pos:]
+        return None
+
+
+def decode(chunks, loads=json.loads):
+    """
+    Decode a JSON data response from an iterable of byte chunks, with the
+    ``points`` arrays parsed into ``(timestamps, values)`` NumPy arrays.
+    The rest of the document is decoded with loads.
+    """
+    decoder = PointsDecoder(loads)
+    for chunk in chunks:
+        if chunk:
+            decoder.feed(chunk)
+    return decoder.close()
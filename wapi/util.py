@@ -3,11 +3,11 @@
 # the data from the backend
 #
 
-import calendar
 import datetime
+import functools
 import dateutil.parser
+import dateutil.relativedelta
 import pytz
-import pandas as pd
 import numpy as np
 from past.types import basestring
 try:
@@ -22,32 +22,72 @@ TAGGED = 'TAGGED'
 INSTANCES = 'INSTANCES'
 TAGGED_INSTANCES = 'TAGGED_INSTANCES'
 
+# Maximum number of data points to fetch in one request, kept well within
+# the limits of the service.
+MAX_POINTS_PER_REQUEST = 250000
 
-# Frequency mapping from TS to Pandas
+
+_pd = None
+
+
+def _pandas():
+    """
+    The pandas module, imported on first use, since importing it takes
+    longer than the rest of wapi together.
+    """
+    global _pd
+    if _pd is None:
+        import pandas
+        _TS_FREQ_TABLE['Y'] = _pandas_alias(pandas, 'YS', 'AS')
+        _map_freq.cache_clear()
+        _pd = pandas
+    return _pd
+
+
+def _pandas_alias(pd, *aliases):
+    # Some frequency aliases were renamed in pandas 2.2, use the first one
+    # known by the installed version
+    for alias in aliases:
+        try:
+            pd.tseries.frequencies.to_offset(alias)
+            return alias
+        except ValueError:
+            pass
+    return aliases[-1]
+
+
+# Frequency mapping from TS to Pandas, the yearly alias is set when pandas
+# is imported
 _TS_FREQ_TABLE = {
-    'Y': 'AS',
+    'Y': 'YS',
     'S': '2QS',
     'Q': 'QS',
     'M': 'MS',
     'W': 'W-MON',
-    'H12': '12H',
-    'H6': '6H',
-    'H3': '3H',
-    'MIN30': '30T',
-    'MIN15': '15T',
-    'MIN5': '5T',
-    'MIN': 'T',
+    'H12': '12h',
+    'H6': '6h',
+    'H3': '3h',
+    'H': 'h',
+    'MIN30': '30min',
+    'MIN15': '15min',
+    'MIN5': '5min',
+    'MIN': 'min',
 }
 # Mapping from Pandas to TS is built from map above, with some additions
+# for the aliases used by older versions of pandas
 _PANDAS_FREQ_TABLE = {
+    'AS': 'Y',
     'AS-JAN': 'Y',
-    'YS': 'Y',
+    'YS-JAN': 'Y',
     '2QS-JAN': 'S',
     'QS-JAN': 'Q',
-    'min': 'MIN',
+    '30T': 'MIN30',
+    '15T': 'MIN15',
+    '5T': 'MIN5',
+    'T': 'MIN',
 }
 for k, v in _TS_FREQ_TABLE.items():
-    _PANDAS_FREQ_TABLE[v] = k
+    _PANDAS_FREQ_TABLE[v.upper()] = k
 
 
 class CurveException(Exception):
@@ -57,6 +97,21 @@ class CurveException(Exception):
 class TS(object):
     """
     A class to hold a basic time series.
+
+    The data is held in two arrays, ``timestamps`` with the milliseconds
+    since the epoch (int64) and ``values`` (float64, NaN for missing values).
+    ``points`` gives the same data as a list of ``[timestamp, value]`` pairs,
+    built on first access.  Once it has been handed out, the list may be
+    changed in place, and the arrays are rebuilt from it when next used, so
+    setting ``points`` or the arrays is the faster way to change the data.
+
+    Points which are not ``[timestamp, value]`` pairs of numbers (or None
+    for missing values) raise a ValueError when they are set, rather than
+    when the series is converted.
+
+    When the timestamps follow the frequency of the series without gaps,
+    only the first one is kept, and the ``timestamps`` array is generated
+    on first access.
     """
     def __init__(self, id=None, name=None, frequency=None, time_zone=None, tag=None, issue_date=None,
                  curve_type=None, points=None, input_dict=None):
@@ -67,6 +122,10 @@ class TS(object):
         self.tag = tag
         self.issue_date = issue_date
         self.curve_type = curve_type
+        self._points = None
+        self._timestamps = None
+        self._values = None
+        self._regular = None
         self.points = points
         #
         # input_dict is the json dict from WAPI
@@ -84,13 +143,103 @@ class TS(object):
         # Validation
         if self.frequency is None:
             raise CurveException('TS must have frequency')
+        self._make_regular()
 
     def __str__(self):
+        self._sync_points()
         size = ''
-        if self.points:
-            size = ' size: {}'.format(len(self.points))
+        if self._values is not None and len(self._values) > 0:
+            size = ' size: {}'.format(len(self._values))
         return 'TS: {}{}'.format(self.fullname, size)
 
+    @property
+    def points(self):
+        if self._points is None and self._values is not None:
+            values = self._values.astype(object)
+            values[np.isnan(self._values)] = None
+            self._points = [list(p) for p in zip(self.timestamps.tolist(), values.tolist())]
+        return self._points
+
+    @points.setter
+    def points(self, points):
+        self._set_points(points)
+
+    def _set_points(self, points):
+        # Accepts a list of [timestamp, value] pairs, or a tuple of the
+        # timestamp and value arrays
+        if points is None:
+            self._set_arrays(None, None)
+        elif isinstance(points, tuple):
+            self._set_arrays(*points)
+        else:
+            try:
+                # None values become NaN, and the timestamps are exact in a float64
+                data = np.asarray(points, dtype=np.float64)
+            except (TypeError, ValueError):
+                raise ValueError('Points have unexpected contents')
+            if len(data) == 0:
+                data = data.reshape((0, 2))
+            if data.ndim != 2 or data.shape[1] != 2:
+                raise ValueError('Points have unexpected contents')
+            self._set_arrays(data[:, 0], np.ascontiguousarray(data[:, 1]))
+
+    def _sync_points(self):
+        # The list handed out by points may have been changed in place, so
+        # the arrays are rebuilt from it, and it is kept.
+        points = self._points
+        if points is not None:
+            self._set_points(points)
+            self._points = points
+
+    @property
+    def timestamps(self):
+        self._sync_points()
+        if self._timestamps is None and self._regular is not None:
+            # Generated on first access, and kept
+            start, frequency, tz = self._regular
+            self._timestamps = regular_timestamps(start, len(self._values), frequency, tz)
+        return self._timestamps
+
+    @timestamps.setter
+    def timestamps(self, timestamps):
+        self._sync_points()
+        self._set_arrays(timestamps, self._values)
+
+    @property
+    def values(self):
+        self._sync_points()
+        return self._values
+
+    @values.setter
+    def values(self, values):
+        self._sync_points()
+        if self._regular is not None and values is not None and len(values) == len(self._values):
+            # The same timestamps, which are still regular
+            self._points = None
+            self._values = np.asarray(values, dtype=np.float64)
+            return
+        self._set_arrays(self.timestamps, values)
+
+    def _set_arrays(self, timestamps, values):
+        self._points = None
+        self._regular = None
+        self._timestamps = None if timestamps is None else np.asarray(timestamps, dtype=np.int64)
+        self._values = None if values is None else np.asarray(values, dtype=np.float64)
+        if hasattr(self, 'tz'):
+            self._make_regular()
+
+    def _make_regular(self):
+        # Drop the timestamps if they can be generated from the first one
+        timestamps = self._timestamps
+        if timestamps is None or self._values is None or len(timestamps) == 0 \
+                or len(timestamps) != len(self._values):
+            return
+        start = int(timestamps[0])
+        expected = regular_timestamps(start, len(timestamps), self.frequency, self.tz)
+        if expected is not None and np.array_equal(timestamps, expected):
+            self._regular = (start, self.frequency, self.tz)
+            self._timestamps = None
+
     @property
     def fullname(self):
         attrs = []
@@ -118,36 +267,36 @@ class TS(object):
         -------
         pandas.Series
         """
+        pd = _pandas()
         if name is None:
             name = self.fullname
-        if self.points is None or len(self.points) == 0:
+        self._sync_points()
+        if self._values is None or len(self._values) == 0:
             return pd.Series(name=name)
 
-        index = []
-        values = []
-        for row in self.points:
-            if len(row) != 2:
-                raise ValueError('Points have unexpected contents')
-            dt = datetime.datetime.fromtimestamp(row[0] / 1000.0, self.tz)
-            index.append(dt)
-            values.append(row[1])
-        res = pd.Series(name=name, index=index, data=values)
-        return res.asfreq(self._map_freq(self.frequency))
+        frequency = self._map_freq(self.frequency)
+        if self._regular is not None and _FREQ_STEP[self._regular[1].upper()][0] == 'seconds':
+            # Fixed steps, the same in pandas whatever the time zone
+            start, _, tz = self._regular
+            start = pd.Timestamp(start, unit='ms', tz=pytz.utc).tz_convert(tz)
+            index = pd.date_range(start=start, periods=len(self._values), freq=frequency)
+            return pd.Series(name=name, index=index, data=self._values)
+        index = pd.to_datetime(self.timestamps, unit='ms', utc=True)
+        res = pd.Series(name=name, index=index.tz_convert(self.tz), data=self._values)
+        return res.asfreq(frequency)
 
     @staticmethod
     def from_pandas(pd_series):
         # Clean up some of the more common Pandas/Wapi problems
         pd_series = pd_series.astype(np.float64)
-        pd_series.replace({np.nan: None}, inplace=True)
 
         name = pd_series.name
         frequency = TS._rev_map_freq(pd_series.index.freqstr)
 
-        points = []
-        for i in pd_series.index:
-            t = i.astimezone(pytz.utc)
-            timestamp = int(calendar.timegm(t.timetuple()) * 1000)
-            points.append([timestamp, pd_series[i]])
+        # Whole seconds since the epoch, whatever the resolution of the index
+        utc = pd_series.index.tz_convert(pytz.utc).tz_localize(None)
+        timestamps = utc.values.astype('datetime64[s]').astype(np.int64) * 1000
+        points = (timestamps, pd_series.values)
 
         if is_integer(name):
             return TS(id=int(name), frequency=frequency, points=points)
@@ -156,15 +305,11 @@ class TS(object):
 
     @staticmethod
     def _map_freq(frequency):
-        if frequency.upper() in _TS_FREQ_TABLE:
-            frequency = _TS_FREQ_TABLE[frequency.upper()]
-        return frequency
+        return _map_freq(frequency)
 
     @staticmethod
     def _rev_map_freq(frequency):
-        if frequency.upper() in _PANDAS_FREQ_TABLE:
-            frequency = _PANDAS_FREQ_TABLE[frequency.upper()]
-        return frequency
+        return _rev_map_freq(frequency)
 
     @staticmethod
     def sum(ts_list, name):
@@ -230,6 +375,18 @@ class TS(object):
         return _generated_series_to_TS(df.median(axis=1), name)
 
 
+@functools.lru_cache(maxsize=1024)
+def _map_freq(frequency):
+    if frequency.upper() in _TS_FREQ_TABLE:
+        frequency = _TS_FREQ_TABLE[frequency.upper()]
+    return frequency
+
+
+@functools.lru_cache(maxsize=1024)
+def _rev_map_freq(frequency):
+    return _PANDAS_FREQ_TABLE.get(frequency.upper(), frequency.upper())
+
+
 def _generated_series_to_TS(series, name):
     series.name = name
     return TS.from_pandas(series)
@@ -240,14 +397,14 @@ def _ts_list_to_dataframe(ts_list):
     for ts in ts_list:
         pd_list.append(ts.to_pandas())
 
-    return pd.concat(pd_list, axis=1)
+    return _pandas().concat(pd_list, axis=1)
 
 
 def tags_to_DF(tagged_list):
     """
     Given a list of tagged series/instances, create a DataFrame with the tag of each as column name
     """
-    return pd.DataFrame({s.tag: s.to_pandas() for s in tagged_list})
+    return _pandas().DataFrame({s.tag: s.to_pandas() for s in tagged_list})
 
 
 #
@@ -255,12 +412,27 @@ def tags_to_DF(tagged_list):
 #
 
 
+def _parse_iso(datestr):
+    # The API gives ISO 8601 time-stamps, which datetime parses much faster
+    # than dateutil.  None for anything else.
+    if len(datestr) < 10 or datestr[4] != '-' or datestr[7] != '-':
+        return None
+    if datestr[-1] in 'Zz':
+        datestr = datestr[:-1] + '+00:00'
+    try:
+        return datetime.datetime.fromisoformat(datestr)
+    except ValueError:
+        return None
+
+
 def parsetime(datestr, tz=None):
     """
     Parse the input date and optionally convert to correct time zone
     """
 
-    d = dateutil.parser.parse(datestr)
+    d = _parse_iso(datestr) if isinstance(datestr, basestring) else None
+    if d is None:
+        d = dateutil.parser.parse(datestr)
 
     if tz is not None:
         if not isinstance(tz, datetime.tzinfo):
@@ -274,7 +446,7 @@ def parsetime(datestr, tz=None):
     else:
         # If datestr does not have tzinfo and no tz given, assume CET
         if d.tzinfo is None:
-            d = pytz.timezone('CET').localize(d)
+            d = parse_tz('CET').localize(d)
     return d
 
 
@@ -293,6 +465,174 @@ def parserange(rangeobj, tz=None):
     return (begin, end)
 
 
+# Length of each frequency step.  Sub-daily steps are in seconds, longer
+# steps are in calendar days or months of the local time zone.
+_FREQ_STEP = {
+    'MIN': ('seconds', 60),
+    'MIN5': ('seconds', 300),
+    'MIN15': ('seconds', 900),
+    'MIN30': ('seconds', 1800),
+    'H': ('seconds', 3600),
+    'H3': ('seconds', 3 * 3600),
+    'H6': ('seconds', 6 * 3600),
+    'H12': ('seconds', 12 * 3600),
+    'D': ('days', 1),
+    'W': ('days', 7),
+    'M': ('months', 1),
+    'Q': ('months', 3),
+    'S': ('months', 6),
+    'Y': ('months', 12),
+}
+
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+
+def to_millis(dt):
+    """Convert a timezone aware datetime to milliseconds since the epoch"""
+    delta = dt - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000 + delta.microseconds // 1000
+
+
+def from_millis(timestamp, tz):
+    """Convert milliseconds since the epoch to a datetime in the time zone tz"""
+    return (_EPOCH + datetime.timedelta(milliseconds=int(timestamp))).astimezone(tz)
+
+
+def regular_timestamps(start, size, frequency, tz):
+    """
+    Generate size timestamps (milliseconds since the epoch, as an int64
+    array) of the given frequency, from the timestamp start.  Steps of a day
+    or longer follow the calendar of the time zone tz, also across changes
+    to daylight saving time.  Returns None if the frequency is not known.
+    """
+    if frequency is None or frequency.upper() not in _FREQ_STEP:
+        return None
+    unit, step = _FREQ_STEP[frequency.upper()]
+    if unit == 'seconds':
+        return start + np.arange(size, dtype=np.int64) * (step * 1000)
+    # The local times, in milliseconds as if the time zone was UTC
+    local = start + _utc_offsets(tz, np.array([start], dtype=np.int64))[0][0]
+    if unit == 'days':
+        local = local + np.arange(size, dtype=np.int64) * (step * _DAY)
+    else:
+        day, time_of_day = divmod(int(local), _DAY)
+        date = np.datetime64(day, 'D')
+        month = date.astype('datetime64[M]')
+        months = month + np.arange(size, dtype=np.int64) * step
+        # Keep the day of the month, or use the last day of shorter months
+        month_days = ((months + 1).astype('datetime64[D]') - months.astype('datetime64[D]')).astype(np.int64)
+        days = np.minimum((date - month.astype('datetime64[D]')).astype(np.int64), month_days - 1)
+        local = (months.astype('datetime64[D]').astype(np.int64) + days) * _DAY + time_of_day
+    return local - _local_offsets(tz, local)
+
+
+_DAY = 86400000
+_OFFSET_WINDOW = 18 * 3600000  # Longer than any change of offset, shorter than the time between two changes
+
+
+@functools.lru_cache(maxsize=256)
+def _tz_transitions(tz):
+    # The UTC times (in milliseconds) from which each offset (in
+    # milliseconds) of a pytz time zone applies, and whether it is daylight
+    # saving time
+    times = getattr(tz, '_utc_transition_times', None)
+    if not times:
+        offset = tz.utcoffset(datetime.datetime(2000, 1, 1)) // datetime.timedelta(milliseconds=1)
+        return np.array([np.iinfo(np.int64).min]), np.array([offset]), np.array([False])
+    epoch = datetime.datetime(1970, 1, 1)
+    starts = np.array([(t - epoch) // datetime.timedelta(milliseconds=1) for t in times], dtype=np.int64)
+    offsets = np.array([i[0] // datetime.timedelta(milliseconds=1) for i in tz._transition_info], dtype=np.int64)
+    dst = np.array([bool(i[1]) for i in tz._transition_info])
+    return starts, offsets, dst
+
+
+def _utc_offsets(tz, utc):
+    # The offsets of tz, and whether they are daylight saving time, at the
+    # UTC times (milliseconds since the epoch) given
+    starts, offsets, dst = _tz_transitions(tz)
+    index = np.maximum(np.searchsorted(starts, utc, side='right') - 1, 0)
+    return offsets[index], dst[index]
+
+
+def _local_offsets(tz, local):
+    # The offsets of tz at the local times given, choosing like
+    # tz.localize(is_dst=False): standard time for times which happen
+    # twice, and the offset before the change for times which are skipped.
+    early, early_dst = _utc_offsets(tz, local - _OFFSET_WINDOW)
+    late, late_dst = _utc_offsets(tz, local + _OFFSET_WINDOW)
+    early_valid = _utc_offsets(tz, local - early)[0] == early
+    late_valid = _utc_offsets(tz, local - late)[0] == late
+    use_late = late_valid & (~early_valid | (early_dst & ~late_dst))
+    return np.where(use_late, late, early)
+
+
+def to_datetime(value, tz):
+    """
+    Convert a time-stamp argument (date string, datetime or date) to a
+    datetime in the given time zone.  Returns None for other types.
+    """
+    if isinstance(value, basestring):
+        return parsetime(value, tz=tz)
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            return tz.localize(value)
+        return value.astimezone(tz)
+    if isinstance(value, datetime.date):
+        return tz.localize(datetime.datetime(value.year, value.month, value.day))
+    return None
+
+
+def split_range(begin, end, frequency, max_points):
+    """
+    Split the range [begin, end) into consecutive (begin, end) pairs,
+    each holding at most max_points values of the given frequency.
+    Splits are made on whole days (or months) of the local time of begin,
+    so that aggregations are not cut, unless a day of a frequency shorter
+    than a day holds more than max_points values.  The range is then split
+    into windows of max_points whole periods.  Returns None if the
+    frequency is not known.
+    """
+    if max_points < 1:
+        raise ValueError('max_points must be at least 1, not {}'.format(max_points))
+    if frequency is None or frequency.upper() not in _FREQ_STEP:
+        return None
+    unit, size = _FREQ_STEP[frequency.upper()]
+    if unit == 'seconds' and max_points < 25 * 3600 // size:
+        return _split_fixed(begin, end, datetime.timedelta(seconds=max_points * size))
+    if unit == 'seconds':
+        # Allow for 25 hour days when changing from daylight saving time
+        step = dateutil.relativedelta.relativedelta(days=max(1, max_points // (25 * 3600 // size)))
+    elif unit == 'days':
+        step = dateutil.relativedelta.relativedelta(days=max(1, max_points) * size)
+    else:
+        step = dateutil.relativedelta.relativedelta(months=max(1, max_points) * size)
+    tz = begin.tzinfo
+    start = begin.replace(tzinfo=None)
+    windows = []
+    n = 0
+    while True:
+        n += 1
+        window_end = tz.localize(start + step * n)
+        if window_end >= end:
+            windows.append((begin, end))
+            return windows
+        windows.append((begin, window_end))
+        begin = window_end
+
+
+def _split_fixed(begin, end, step):
+    # Split [begin, end) into windows of a fixed duration
+    tz = begin.tzinfo
+    windows = []
+    while begin + step < end:
+        window_end = tz.normalize(begin + step)
+        windows.append((begin, window_end))
+        begin = window_end
+    windows.append((begin, end))
+    return windows
+
+
 _tzmap = {
     'CEGT': 'CET',
     'WEGT': 'WET',
@@ -304,6 +644,7 @@ _tzmap = {
 }
 
 
+@functools.lru_cache(maxsize=1024)
 def parse_tz(time_zone):
     try:
         if time_zone in _tzmap: